@@ -37,6 +37,13 @@ inTR="null"
 saveTS="null"
 noMat="null"
 addLin="null"
+runFused="null"
+noBold="null"
+memBUDGET="null"
+doCensor="null"
+stageCACHE="null"
+doProfile="null"
+workerQUEUE="null"
 inDISCARD="null"
 inSPACE="null"
 # regSTRATEGY="null"
@@ -89,6 +96,7 @@ if [[ -f config.json ]] ; then
   	# set flags for app
 	saveTS=`jq -r '.savets' config.json`
   	noMat=`jq -r '.nomatrix' config.json`
+  	runFused=`jq -r '.fused' config.json`
 
   	echo "RUNNING ON BRAINLIFE"
   	runBL="true"
@@ -140,6 +148,26 @@ else
 					;;
 	       	-a | -addlin )			        addLin="true"
 					;;
+	       	-fused )			        runFused="true"
+					;;
+	       	-nobold )			        noBold="true"
+					;;
+	        -membudget )	shift
+							memBUDGET=$1
+	        ;;
+	       	-censor )			        doCensor="true"
+					;;
+	       	-profile )			        doProfile="true"
+					;;
+	        -worker )		shift
+							# queue of a running src/worker.py serve
+							workerQUEUE=$1
+	        ;;
+	        -stagecache )	shift
+							# implies -fused
+							stageCACHE=$1
+							runFused="true"
+	        ;;
 	        -h | --help )             echo "see script"
 	                                  exit 1
 	        ;;
@@ -187,6 +215,11 @@ if [[ ${inSPACE} = "null" ]] ; then
 	inSPACE="data"
 fi
 
+if [[ ${stageCACHE} != "null" ]] && [[ -n ${memBUDGET} ]] && [[ ${memBUDGET} != "null" ]] ; then
+	echo "ERROR: -stagecache does not go with -membudget" >&2;
+	exit 1
+fi
+
 if [[ ${inSPACE} != "data" ]] && [[ ${inSPACE} != "labels" ]] ; then
 	echo "ERROR: space can only be 'data' or 'labels'" >&2; 
 	exit 1
@@ -213,45 +246,110 @@ fi
 # run it
 
 mkdir -p ${inOUTBASE}/output_regress/
+mkdir -p ${inOUTBASE}/output_makemat/
 
-cmd="${py_bin} ${EXEDIR}/src/regress.py \
-		-out ${inOUTBASE}/output_regress/out \
-		-discardvols ${inDISCARD} \
-		${REXTRA} \
-		${inFMRI} \
-		${inCONF} \
-	"
+regOPTS="-discardvols ${inDISCARD} ${REXTRA}"
 if [[ -n ${inMASK} ]] && [[ ${inMASK} != "null" ]] ; then
-  cmd="${cmd} -mask ${inMASK}"
+  regOPTS="${regOPTS} -mask ${inMASK}"
 fi
 if [[ -n ${inTR} ]] && [[ ${inTR} != "null" ]] ; then
-  cmd="${cmd} -tr ${inTR}"
+  regOPTS="${regOPTS} -tr ${inTR}"
 fi
 if [[ -n ${regSTRATEGY} ]] &&  [[ ${regSTRATEGY} != "null" ]] ; then
-  cmd="${cmd} -strategy ${regSTRATEGY}"
+  regOPTS="${regOPTS} -strategy ${regSTRATEGY}"
 fi
 if [[ -n ${inCONFJSON} ]] && [[ ${inCONFJSON} != "null" ]] ; then
-  cmd="${cmd} -confjson ${inCONFJSON}"
+  regOPTS="${regOPTS} -confjson ${inCONFJSON}"
 fi
 if [[ -n ${spikeTHR} ]] && [[ ${spikeTHR} != "null" ]] ; then
-  cmd="${cmd} -spikethr ${spikeTHR}"
+  regOPTS="${regOPTS} -spikethr ${spikeTHR}"
 fi
 if [[ -n ${inLOWPASS} ]] && [[ ${inLOWPASS} != "null" ]] ; then
-  cmd="${cmd} -lowpass ${inLOWPASS}"
+  regOPTS="${regOPTS} -lowpass ${inLOWPASS}"
 fi
 if [[ -n ${inHIGHPASS} ]] && [[ ${inHIGHPASS} != "null" ]] ; then
-  cmd="${cmd} -highpass ${inHIGHPASS}"
+  regOPTS="${regOPTS} -highpass ${inHIGHPASS}"
 fi
 if [[ -n ${inSMOOTH} ]] && [[ ${inSMOOTH} != "null" ]] ; then
-  cmd="${cmd} -fwhm ${inSMOOTH}"
+  regOPTS="${regOPTS} -fwhm ${inSMOOTH}"
 fi
 if [[ -n ${addLin} ]] && [[ ${addLin} = "true" ]] ; then
-  cmd="$cmd -add_linear"
+  regOPTS="${regOPTS} -add_linear"
+fi
+if [[ ${doCensor} = "true" ]] ; then
+  regOPTS="${regOPTS} -censor"
+fi
+if [[ -n ${memBUDGET} ]] && [[ ${memBUDGET} != "null" ]] ; then
+  # streamed regression, writes an uncompressed nifti
+  regOPTS="${regOPTS} -chunked -membudget ${memBUDGET}"
+fi
+
+matOPTS="-space ${inSPACE} -type correlation ${MEXTRA}"
+if [[ ${saveTS} = "true" ]] ; then
+  # the tsv.gz + json are what goes to brainlife (out_ts)
+  matOPTS="${matOPTS} -savetimeseries -savetsv"
+fi
+if [[ ${noMat}  = "true" ]] ; then
+  matOPTS="${matOPTS} -nomatrix"
+fi
+
+# the python scripts, or jobs for a warm worker (src/worker.py) with the
+# libraries already loaded; with no worker serving the queue, submit runs it
+regressPY="${py_bin} ${EXEDIR}/src/regress.py"
+makematPY="${py_bin} ${EXEDIR}/src/makemat.py"
+pipelinePY="${py_bin} ${EXEDIR}/src/pipeline.py"
+if [[ ${workerQUEUE} != "null" ]] ; then
+  submitPY="${py_bin} ${EXEDIR}/src/worker.py submit -queue ${workerQUEUE} -wait"
+  regressPY="${submitPY} regress"
+  makematPY="${submitPY} makemat"
+  pipelinePY="${submitPY} pipeline"
 fi
-echo $cmd
-eval $cmd
 
 regressFMRI=${inOUTBASE}/output_regress/out_nuisance.nii.gz
+if [[ -n ${memBUDGET} ]] && [[ ${memBUDGET} != "null" ]] ; then
+  regressFMRI=${inOUTBASE}/output_regress/out_nuisance.nii
+fi
+
+if [[ ${runFused} = "true" ]] ; then
+
+	# regression and matrices in one python call, cleaned image stays in
+	# memory between the two and is (optionally) written in the background
+	# inputs first, -type takes one or more values
+	cmd="${pipelinePY} \
+		${inFMRI} \
+		${inCONF} \
+		-out ${inOUTBASE}/output_makemat/out \
+		-regressout ${inOUTBASE}/output_regress/out \
+		${regOPTS} \
+		${matOPTS} \
+		-parcs ${inPARC[*]} \
+	"
+	if [[ ${noBold} != "true" ]] ; then
+	  cmd="${cmd} -savenuisance"
+	fi
+	if [[ ${stageCACHE} != "null" ]] ; then
+	  # re-runs only remake the stages whose inputs changed
+	  cmd="${cmd} -stagecache ${stageCACHE}"
+	fi
+	if [[ ${doProfile} = "true" ]] ; then
+	  cmd="${cmd} -profile ${inOUTBASE}/output_makemat/out_profile.json"
+	fi
+	echo $cmd
+	eval $cmd
+
+else
+
+cmd="${regressPY} \
+		-out ${inOUTBASE}/output_regress/out \
+		${regOPTS} \
+		${inFMRI} \
+		${inCONF} \
+	"
+if [[ ${doProfile} = "true" ]] ; then
+  cmd="${cmd} -profile ${inOUTBASE}/output_regress/out_profile.json"
+fi
+echo $cmd
+eval $cmd
 
 if [[ ! -f ${regressFMRI} ]] ; then
 	echo "ERROR: something wrong with nusiance regression" >&2; 
@@ -263,28 +361,27 @@ fi
 # loop through the pars provided. output is storred based on name of parc
 # for (( i=0; i<${#inPARC[@]}; i++ )) ; do
 
-mkdir -p ${inOUTBASE}/output_makemat/
-
 # echo ; echo "making matrix $((i+1)) from parc: ${inPARC[i]}" ; echo
 
-cmd="${py_bin} ${EXEDIR}/src/makemat.py \
-    -space ${inSPACE} \
-    -type correlation \
-    -out ${inOUTBASE}/output_makemat/out \
-    ${MEXTRA} \
+# inputs first, -type takes one or more values
+cmd="${makematPY} \
     ${regressFMRI} \
     ${inMASK} \
+    -out ${inOUTBASE}/output_makemat/out \
+    ${matOPTS} \
     -parcs ${inPARC[*]} \
   "
-if [[ ${saveTS} = "true" ]] ; then
-  cmd="${cmd} -savetimeseries"
+if [[ ${doProfile} = "true" ]] ; then
+  cmd="${cmd} -profile ${inOUTBASE}/output_makemat/out_profile.json"
 fi
-if [[ ${noMat}  = "true" ]] ; then
-  cmd="${cmd} -nomatrix"
+if [[ ${doCensor} = "true" ]] ; then
+  cmd="${cmd} -censorfile ${inOUTBASE}/output_regress/out_censor.csv"
 fi
 echo $cmd
 eval $cmd
 
+fi
+
 # done # for (( i=0; i<${#inPARC[@]}; i++ ))
 
 # check if mat is made...
@@ -303,8 +400,11 @@ fi
 ###############################################################################
 # map output for bl
 
-mv ${inOUTBASE}/output_regress/out_nuisance.nii.gz \
-	${inOUTBASE}/output_regress/bold.nii.gz 
+if [[ -f ${regressFMRI} ]] ; then
+	# keep the extension, .nii or .nii.gz
+	mv ${regressFMRI} \
+		${inOUTBASE}/output_regress/bold${regressFMRI#*out_nuisance}
+fi
 
 # if we are running on brainlife, lets format!
 # and if we making a matrix
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+many subjects through pipeline.py, in a pool of worker processes
+
+    batch.py manifest.tsv [-nprocs 8] [-maxmem 64000] [pipeline.py options]
+
+the manifest (tsv, or json: a list of objects) has a row per subject with
+the columns fmri, confounds, mask, out, and parcs (space or comma separated
+in a tsv, or a list in json). an id column names the subject in the report
+(default: out). any other column is passed on as a pipeline.py option for
+that subject, e.g. a column tr with 2.0 becomes -tr 2.0 (true/false for the
+flags). options given to batch.py that it does not know itself are passed
+on to every subject, e.g. -space data -strategy 36P
+
+the workers are started once and each runs many subjects, so the python /
+nilearn startup is paid once per worker, not once per subject. subjects are
+started as long as the sum of their estimated peak memory (voxels x volumes
+x the bytes of the subject's -dtype, times -memfactor) stays under -maxmem.
+a subject that fails (exits or raises) is recorded as such and the batch
+goes on; so is one whose worker dies (e.g. killed for running out of
+memory), and a fresh worker takes its place. each subject
+logs to <out>_log.txt, and the status of all subjects goes to -report.
+with -preflight the inputs of every subject are checked from their headers
+first (see preflight.py) and the subjects that fail are not run
+
+@author: jfaskowi
+
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+pd = lazy_import('pandas')
+
+BLASVARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+            'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+MANIFESTCOLS = ['id', 'fmri', 'confounds', 'mask', 'out', 'parcs']
+
+
+def read_manifest(fname):
+    """
+    returns a list of dicts, one per subject, with parcs as a list
+    """
+    if fname.endswith('.json'):
+        with open(fname, 'r') as f:
+            rows = json.load(f)
+    else:
+        df = pd.read_csv(fname, sep='\t', dtype=str, keep_default_na=False)
+        rows = df.to_dict('records')
+
+    for n, row in enumerate(rows):
+        for col in ['fmri', 'confounds', 'mask', 'out']:
+            if not row.get(col):
+                print("manifest row {} has no {}. exiting".format(n, col))
+                exit(1)
+        parcs = row.get('parcs', [])
+        if isinstance(parcs, str):
+            parcs = [p for p in re.split(r'[,\s]+', parcs) if p]
+        row['parcs'] = parcs
+        if not row.get('id'):
+            row['id'] = row['out']
+
+    return rows
+
+
+def manifest_argv(row, shared):
+    """
+    the pipeline.py command line of a manifest row, with the shared options
+    """
+    argv = [row['fmri'], row['confounds'], '-mask', row['mask'],
+            '-out', row['out']]
+
+    for col, val in row.items():
+        if col in MANIFESTCOLS:
+            continue
+        val = str(val)
+        if val.lower() in ['', 'false', 'no', 'nan']:
+            continue
+        argv.append(''.join(['-', col]))
+        if val.lower() not in ['true', 'yes']:
+            argv.append(val)
+
+    argv += shared
+
+    # parcs take the rest of the line
+    if row['parcs']:
+        argv += ['-parcs'] + row['parcs']
+
+    return argv
+
+
+def argv_dtype(argv):
+    """
+    the -dtype of a pipeline.py command line (the last one given wins)
+    """
+    dtype = 'float64'
+    for n, arg in enumerate(argv[:-1]):
+        if arg == '-dtype':
+            dtype = argv[n + 1]
+
+    return dtype
+
+
+def estimate_mem(fmri, memfactor=4.0, dtype='float64'):
+    """
+    estimated peak memory (bytes) of one subject, from the image header: the
+    image in dtype, times memfactor for the copies along the way
+    """
+    shape = nib.load(fmri).shape
+    return int(np.prod(shape, dtype=np.float64) * np.dtype(dtype).itemsize * memfactor)
+
+
+def physical_mem():
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def run_subject(argv, logname):
+    """
+    pool worker: run pipeline.py on argv, logging to logname
+
+    returns status ('ok' or 'failed'), seconds, and an error message
+    """
+    # imported here, once per worker, after the blas env is set
+    from pipeline import get_parser, pipeline_from_args
+
+    start = time.time()
+    status = 'ok'
+    error = ''
+    with open(logname, 'w') as logf, redirect_stdout(logf), redirect_stderr(logf):
+        try:
+            print("ARGV: {}".format(' '.join(argv)))
+            pipeline_from_args(get_parser().parse_args(argv))
+        except SystemExit as e:
+            # argparse errors and the exit(1)s
+            if e.code:
+                status = 'failed'
+                error = 'exited with {} (see log)'.format(e.code)
+        except Exception as e:
+            status = 'failed'
+            error = repr(e)
+            traceback.print_exc()
+
+    return status, time.time() - start, error
+
+
+def worker_loop(conn):
+    """
+    worker process: run_subject on each (argv, logname) that comes down conn,
+    sending back the result, until None comes
+    """
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        conn.send(run_subject(*job))
+
+
+def start_worker(ctx):
+    """
+    a worker process and the parent end of its pipe
+    """
+    conn, childconn = ctx.Pipe()
+    proc = ctx.Process(target=worker_loop, args=(childconn,), daemon=True)
+    proc.start()
+    childconn.close()
+
+    return {'proc': proc, 'conn': conn, 'job': None}
+
+
+def write_report(report, fname):
+
+    pd.DataFrame(report, columns=['id', 'status', 'seconds', 'estmem_mb', 'log',
+                                  'error']).to_csv(fname, sep='\t', index=False)
+
+
+def run_batch(rows, shared, nprocs, maxmem, memfactor=4.0, report='batch_status.tsv',
+              poll=0.5, preflight=False):
+    """
+    run the manifest rows in a pool of nprocs workers, keeping the sum of the
+    estimated memory of the running subjects under maxmem (bytes). a subject
+    estimated over maxmem on its own is run alone. with preflight, subjects
+    that fail preflight.check_argv are not run
+
+    returns the number of failed subjects
+    """
+    if preflight:
+        from preflight import check_argv
+
+    status = []
+    jobs = []
+    for row in rows:
+        logname = ''.join([row['out'], '_log.txt'])
+        entry = {'id': row['id'], 'status': 'pending', 'seconds': np.nan,
+                 'estmem_mb': np.nan, 'log': logname, 'error': ''}
+        status.append(entry)
+        argv = manifest_argv(row, shared)
+        try:
+            mem = estimate_mem(row['fmri'], memfactor, argv_dtype(argv))
+        except Exception as e:
+            entry['status'] = 'failed'
+            entry['error'] = 'could not read image header: {}'.format(repr(e))
+            continue
+        entry['estmem_mb'] = mem / (1024 * 1024)
+        if preflight:
+            errors, _ = check_argv(argv)
+            if errors:
+                entry['status'] = 'failed'
+                entry['error'] = 'preflight: {}'.format('; '.join(errors))
+                print("{} failed preflight: {}".format(entry['id'], '; '.join(errors)))
+                continue
+        outdir = os.path.dirname(row['out'])
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        jobs.append((entry, argv, mem))
+
+    write_report(status, report)
+
+    # spawn, so that the workers import numpy with the blas env of the parent.
+    # a worker per process of our own, not a Pool, so that one that dies
+    # (oom killer, kill -9) is seen and its subject marked failed
+    ctx = multiprocessing.get_context('spawn')
+    workers = [start_worker(ctx) for _ in range(min(nprocs, max(len(jobs), 1)))]
+
+    usedmem = 0
+    while jobs or any(worker['job'] for worker in workers):
+
+        # start whatever fits
+        for n, worker in enumerate(workers):
+            if worker['job'] is not None:
+                continue
+            if not worker['proc'].is_alive():
+                # went down between subjects
+                worker['proc'].join()
+                workers[n] = worker = start_worker(ctx)
+            running = any(other['job'] for other in workers)
+            for m, (entry, argv, mem) in enumerate(jobs):
+                if usedmem + mem <= maxmem or not running:
+                    print("starting {} (~{:.0f} MB)".format(entry['id'], entry['estmem_mb']))
+                    worker['conn'].send((argv, entry['log']))
+                    worker['job'] = (entry, mem, time.time())
+                    entry['status'] = 'running'
+                    usedmem += mem
+                    del jobs[m]
+                    break
+
+        time.sleep(poll)
+
+        # collect whatever finished, or whose worker went down
+        for n, worker in enumerate(workers):
+            if worker['job'] is None:
+                continue
+            entry, mem, start = worker['job']
+            died = False
+            if worker['conn'].poll():
+                try:
+                    entry['status'], entry['seconds'], entry['error'] = worker['conn'].recv()
+                except EOFError:
+                    died = True
+            elif worker['proc'].is_alive():
+                continue
+            else:
+                died = True
+
+            if died:
+                worker['proc'].join()
+                entry['status'] = 'failed'
+                entry['seconds'] = time.time() - start
+                entry['error'] = 'worker died (exit code {}, killed or out of memory?)'.format(
+                                 worker['proc'].exitcode)
+                worker['conn'].close()
+                workers[n] = worker = start_worker(ctx)
+            worker['job'] = None
+            usedmem -= mem
+            print("{} {} ({:.1f}s)".format(entry['id'], entry['status'], entry['seconds']))
+            write_report(status, report)
+
+    for worker in workers:
+        worker['conn'].send(None)
+        worker['proc'].join()
+    write_report(status, report)
+
+    return sum(entry['status'] != 'ok' for entry in status)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='pipeline.py over a manifest of subjects',
+                                     allow_abbrev=False)
+    parser.add_argument('manifest', type=str, help='tsv or json manifest of subjects')
+    parser.add_argument('-nprocs', type=int, help='number of worker processes',
+                        default=os.cpu_count())
+    parser.add_argument('-maxmem', type=float, help='memory (MB) the running subjects can use '
+                        'together (default: 80%% of physical memory)', default=None)
+    parser.add_argument('-memfactor', type=float, help='peak memory of a subject, in copies of '
+                        "the image in the subject's -dtype", default=4.0)
+    parser.add_argument('-blasthreads', type=int, help='blas threads per worker (default: cpus '
+                        '/ nprocs)', default=None)
+    parser.add_argument('-report', type=str, help='per subject status tsv',
+                        default='batch_status.tsv')
+    parser.add_argument('-preflight', help='check the inputs of every subject from their headers '
+                        'first, and do not run those that fail', action='store_true')
+
+    # parse, the rest goes to every subject
+    args, shared = parser.parse_known_args()
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("shared {}".format(' '.join(shared)))
+    print("END ARGS\n")
+
+    if args.maxmem is None:
+        maxmem = 0.8 * physical_mem()
+    else:
+        maxmem = args.maxmem * 1024 * 1024
+
+    blasthreads = args.blasthreads
+    if blasthreads is None:
+        blasthreads = max(1, os.cpu_count() // args.nprocs)
+    for var in BLASVARS:
+        os.environ[var] = str(blasthreads)
+
+    rows = read_manifest(args.manifest)
+    print("{} subjects, {} workers, {} blas threads each, {:.0f} MB".format(
+          len(rows), args.nprocs, blasthreads, maxmem / (1024 * 1024)))
+
+    nfailed = run_batch(rows, shared, args.nprocs, maxmem,
+                        memfactor=args.memfactor, report=args.report,
+                        preflight=args.preflight)
+
+    print("\n{} of {} subjects failed, see {}".format(nfailed, len(rows), args.report))
+    if nfailed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
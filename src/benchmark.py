@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks of the regress / makemat hot paths on synthetic data, so that no
+real data is needed and the speed of two commits can be compared
+
+    benchmark.py run [-nvox 20000 100000] [-nvols 200 600] [-nrois 100 400]
+                     [-nparcs 1 3] [-nspikes 0 20] [-names new old]
+                     [-repeats 3] -out bench.json
+
+makes, for every combination of the values, a 4D bold (a cube of ~nvox
+voxels in the mask), a mask, nparcs label images of nrois regions, and an
+fmriprep style confounds tsv + json (old CamelCase or new snake_case column
+names, with nspikes framewise displacement spikes), then times
+
+    get_confounds       36P, and 24aCompCor (the json path)
+    nuisance_regress    the masker path and the fused operator path
+    extract_mat         one parc (-space data)
+    extract_mats        all the parcs at once (-space data)
+    writers             cleaned image (nii.gz; float32 nii.gz in 4 threads;
+                        float32 nii), csv matrix, npy matrix, time series
+                        store, bids tsv
+
+taking the min and median of -repeats runs of each. the results go to a
+json (with the git commit, versions and host) and
+
+    benchmark.py compare old.json new.json [-thr 1.2]
+
+lines up the cases of two of them, printing the new / old time ratios and
+exiting 1 if any is over -thr
+
+@author: jfaskowi
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+import tempfile
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from regress import get_confounds, nuisance_regress, save_nuisance_img
+from makemat import extract_mat, extract_mats, get_con_df
+from connio import save_conn
+from tsstore import save_timeseries, write_tsv
+
+OLDNAMES = {'trans_x': 'X', 'trans_y': 'Y', 'trans_z': 'Z',
+            'rot_x': 'RotX', 'rot_y': 'RotY', 'rot_z': 'RotZ',
+            'csf': 'CSF', 'white_matter': 'WhiteMatter',
+            'global_signal': 'GlobalSignal',
+            'framewise_displacement': 'FramewiseDisplacement'}
+
+TR = 2.0
+
+
+def make_bold(nvox, nvols, rng):
+    """
+    a 4D image of a cube of about nvox voxels (plus a border of zeros), low
+    frequency signal + noise, float32, and its mask
+    """
+    side = int(np.ceil(nvox ** (1. / 3)))
+    shape = (side + 4, side + 4, side + 4)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[2:-2, 2:-2, 2:-2] = 1
+
+    # a few slow shared signals, mixed differently in every voxel
+    t = np.arange(nvols)[:, None] * TR
+    slow = np.sin(2 * np.pi * t * rng.uniform(0.01, 0.1, (1, 5)) + rng.uniform(0, 6.3, (1, 5)))
+    data = np.zeros(shape + (nvols,), dtype=np.float32)
+    inmask = mask.astype(bool)
+    nin = int(inmask.sum())
+    data[inmask] = (100. + slow.dot(rng.randn(5, nin)).T
+                    + rng.randn(nin, nvols)).astype(np.float32)
+
+    affine = np.diag([3., 3., 3., 1.])
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_zooms((3., 3., 3., TR))
+
+    return img, nib.Nifti1Image(mask, affine)
+
+
+def make_parcs(maskimg, nrois, nparcs, rng):
+    """
+    nparcs label images of nrois regions each (nearest of nrois random seed
+    voxels in the mask). the outer layer of the mask is left unlabeled, like
+    the white matter of a real atlas
+    """
+    from scipy.ndimage import binary_erosion
+    mask = np.asanyarray(maskimg.dataobj).astype(bool)
+    coords = np.argwhere(binary_erosion(mask))
+    parcs = []
+    for _ in range(nparcs):
+        seeds = coords[rng.choice(len(coords), size=min(nrois, len(coords)), replace=False)]
+        labels = np.zeros(mask.shape, dtype=np.int16)
+        # nearest seed, in blocks of voxels to keep the distances small
+        for v0 in range(0, len(coords), 4096):
+            block = coords[v0:v0 + 4096]
+            dist = ((block[:, None, :] - seeds[None, :, :]) ** 2).sum(axis=2)
+            labels[tuple(block.T)] = np.argmin(dist, axis=1) + 1
+        parcs.append(nib.Nifti1Image(labels, maskimg.affine))
+
+    return parcs
+
+
+def make_confounds(nvols, nspikes, names, rng, ncompcor=12):
+    """
+    an fmriprep style confounds table (new or old column names) with nspikes
+    framewise displacement spikes, and the json of its compcor components
+
+    returns the data frame and the json dict
+    """
+    df = pd.DataFrame({col: np.cumsum(rng.randn(nvols)) * 0.01
+                       for col in ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']})
+    for col in ['csf', 'white_matter', 'global_signal']:
+        df[col] = 100. + rng.randn(nvols)
+
+    fd = np.abs(rng.randn(nvols)) * 0.05
+    fd[rng.choice(np.arange(1, nvols), size=min(nspikes, nvols - 1), replace=False)] = 1.0
+    fd[0] = np.nan
+    df['framewise_displacement'] = fd
+
+    compcorprefix = 'a_comp_cor_' if names == 'new' else 'aCompCor'
+    confjson = {}
+    varex = np.sort(rng.uniform(0, 0.2, ncompcor))[::-1]
+    for n in range(ncompcor):
+        col = '{}{:0>2}'.format(compcorprefix, n)
+        df[col] = rng.randn(nvols)
+        confjson[col] = {'Mask': 'combined', 'VarianceExplained': float(varex[n])}
+
+    if names == 'old':
+        df = df.rename(columns=OLDNAMES)
+
+    return df, confjson
+
+
+def timed(func, repeats, *args, **kwargs):
+    """
+    run func repeats times, returns the times and the last result
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        out = func(*args, **kwargs)
+        times.append(time.time() - start)
+
+    return times, out
+
+
+def run_case(params, repeats, workdir, seed=0):
+    """
+    make the synthetic data of one case and time the hot paths on it
+
+    returns a dict of name: list of seconds
+    """
+    rng = np.random.RandomState(seed)
+    img, maskimg = make_bold(params['nvox'], params['nvols'], rng)
+    parcs = make_parcs(maskimg, params['nrois'], params['nparcs'], rng)
+    confdf, confjson = make_confounds(params['nvols'], params['nspikes'], params['names'], rng)
+
+    conffile = os.path.join(workdir, 'confounds.tsv')
+    jsonfile = os.path.join(workdir, 'confounds.json')
+    confdf.to_csv(conffile, sep='\t', index=False, na_rep='n/a')
+    with open(jsonfile, 'w') as f:
+        json.dump(confjson, f)
+
+    times = {}
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        # the functions print a lot, keep the table readable
+        sys.stdout = devnull
+        try:
+            times['get_confounds_36P'], _ = timed(
+                get_confounds, repeats, conffile, kind='36P', spikereg_threshold=0.5)
+            times['get_confounds_24aCompCor_json'], _ = timed(
+                get_confounds, repeats, conffile, kind='24aCompCor', spikereg_threshold=0.5,
+                confounds_json=jsonfile)
+
+            regressargs = {'inputtr': TR, 'conftype': '36P', 'spikethr': 0.5,
+                           'discardvols': 4}
+            times['nuisance_regress'], (nrimg, _, _) = timed(
+                nuisance_regress, repeats, img, conffile, maskimg, **regressargs)
+            times['nuisance_regress_fusedop'], _ = timed(
+                nuisance_regress, repeats, img, conffile, maskimg, fusedop=True,
+                **regressargs)
+
+            matargs = {'conntype': 'correlation', 'dtr': True, 'stdz': True, 'savets': True}
+            times['extract_mat'], (connmats, timeseries, regions) = timed(
+                extract_mat, repeats, nrimg, maskimg, parcs[0], space='data', **matargs)
+            times['extract_mats_all_parcs'], _ = timed(
+                extract_mats, repeats, nrimg, maskimg, parcs, **matargs)
+
+            outbase = os.path.join(workdir, 'out')
+            times['write_nuisance_niigz'], _ = timed(save_nuisance_img, repeats, nrimg, outbase)
+            times['write_nuisance_niigz_float32_mt'], _ = timed(
+                save_nuisance_img, repeats, nrimg, outbase, outdtype='float32', nthreads=4)
+            times['write_nuisance_nii_float32'], _ = timed(
+                save_nuisance_img, repeats, nrimg, outbase, outformat='nii', outdtype='float32')
+            connmat = connmats['correlation']
+            times['write_matrix_csv'], _ = timed(
+                lambda: get_con_df(connmat, [str(r) for r in regions]).to_csv(
+                    ''.join([outbase, '_connMatdf.csv']), float_format='%.3g'), repeats)
+            times['write_matrix_npy'], _ = timed(
+                save_conn, repeats, outbase, connmat, regions, 'correlation')
+            times['write_timeseries_hdf5'], _ = timed(
+                save_timeseries, repeats, ''.join([outbase, '_timeseries.hdf5']),
+                timeseries, regions)
+            times['write_timeseries_tsv'], _ = timed(
+                write_tsv, repeats, ''.join([outbase, '_timeseries']), timeseries, regions)
+        finally:
+            sys.stdout = stdout
+
+    return times
+
+
+def git_commit():
+    """
+    the commit of the repo this file is in, None if not a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_name(params):
+
+    return ' '.join(['{}={}'.format(k, params[k]) for k in sorted(params)])
+
+
+def run_benchmarks(args):
+    """
+    every combination of the case values in args, returns the results dict
+    """
+    import nilearn
+    import scipy
+
+    results = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'host': socket.gethostname(), 'cpus': os.cpu_count(),
+               'python': sys.version.split()[0], 'numpy': np.__version__,
+               'scipy': scipy.__version__, 'nilearn': nilearn.__version__,
+               'nibabel': nib.__version__, 'repeats': args.repeats, 'cases': []}
+
+    keys = ['nvox', 'nvols', 'nrois', 'nparcs', 'nspikes', 'names']
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    for values in itertools.product(*[getattr(args, k) for k in keys]):
+        params = dict(zip(keys, values))
+        print("\n{}".format(case_name(params)))
+        times = run_case(params, args.repeats, workdir)
+        timings = {}
+        for name, secs in times.items():
+            timings[name] = {'min': min(secs), 'median': float(np.median(secs)), 'all': secs}
+            print("    {:<32} {:>8.3f}s".format(name, min(secs)))
+        results['cases'].append({'params': params, 'timings': timings})
+
+    for fname in os.listdir(workdir):
+        os.remove(os.path.join(workdir, fname))
+    os.rmdir(workdir)
+
+    return results
+
+
+def compare(old, new, thr=1.2):
+    """
+    print the new / old (min) time ratio of every timing of the cases in
+    both results, returns the number of ratios over thr
+    """
+    oldcases = {case_name(c['params']): c['timings'] for c in old['cases']}
+    nslower = 0
+    print("old {} ({})\nnew {} ({})\n".format(old.get('commit'), old.get('date'),
+                                               new.get('commit'), new.get('date')))
+    for case in new['cases']:
+        name = case_name(case['params'])
+        if name not in oldcases:
+            print("{}: not in old, skipping".format(name))
+            continue
+        print(name)
+        for timing, vals in case['timings'].items():
+            if timing not in oldcases[name]:
+                continue
+            oldmin = oldcases[name][timing]['min']
+            ratio = vals['min'] / oldmin if oldmin > 0 else np.inf
+            flag = ''
+            if ratio > thr:
+                flag = '  SLOWER'
+                nslower += 1
+            elif ratio < 1. / thr:
+                flag = '  faster'
+            print("    {:<32} {:>8.3f}s -> {:>8.3f}s  {:>5.2f}x{}".format(
+                  timing, oldmin, vals['min'], ratio, flag))
+
+    return nslower
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='benchmarks on synthetic data')
+    subparsers = parser.add_subparsers(dest='command')
+
+    runparser = subparsers.add_parser('run', help='time the hot paths on synthetic data')
+    runparser.add_argument('-nvox', type=int, nargs='+', help='voxels in the mask', default=[20000])
+    runparser.add_argument('-nvols', type=int, nargs='+', help='volumes', default=[200])
+    runparser.add_argument('-nrois', type=int, nargs='+', help='regions per parc', default=[100])
+    runparser.add_argument('-nparcs', type=int, nargs='+', help='number of parcs', default=[2])
+    runparser.add_argument('-nspikes', type=int, nargs='+', help='framewise displacement spikes',
+                           default=[10])
+    runparser.add_argument('-names', type=str, nargs='+', help='confound column names',
+                           choices=['new', 'old'], default=['new'])
+    runparser.add_argument('-repeats', type=int, help='runs of each timing', default=3)
+    runparser.add_argument('-workdir', type=str, help='where to write the synthetic data '
+                           '(default: the temp dir)', default=None)
+    runparser.add_argument('-out', type=str, help='results json', required=True)
+
+    compparser = subparsers.add_parser('compare', help='compare the results of two runs')
+    compparser.add_argument('old', type=str, help='results json of the baseline')
+    compparser.add_argument('new', type=str, help='results json to compare')
+    compparser.add_argument('-thr', type=float, help='new / old time ratio counted as slower',
+                            default=1.2)
+
+    # parse
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        exit(1)
+
+    if args.command == 'run':
+        results = run_benchmarks(args)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("\nwrote {}".format(args.out))
+        return
+
+    with open(args.old, 'r') as f:
+        old = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+
+    nslower = compare(old, new, args.thr)
+    if nslower:
+        print("\n{} timings slower by more than {}x".format(nslower, args.thr))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
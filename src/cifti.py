@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+cifti-2 grayordinate data: a .dtseries.nii fmri (e.g. fmriprep's 91k
+grayordinates) instead of a volume, in regress.py, makemat.py and
+pipeline.py, with .dlabel.nii parcs
+
+the data stays a time x grayordinates array the whole way: it is cleaned
+along time as the masked voxels of a volume are (no smoothing, that would
+need the surfaces), and the parcels are averaged with a sparse regions x
+grayordinates operator, with no resampling and no 3D masking (so no -mask,
+and -space does not apply). the grayordinates of a dlabel are matched to
+those of the dtseries by structure and vertex (or voxel), so a dlabel of
+the cortex only, or with the medial wall, goes with a 91k dtseries
+
+@author: jfaskowi
+
+"""
+
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+cifti2 = lazy_import('nibabel.cifti2')
+sparse = lazy_import('scipy.sparse')
+
+
+def is_cifti(img):
+    """
+    whether img (a file name or an image) is cifti-2
+    """
+    if isinstance(img, str):
+        return img.endswith('.dtseries.nii') or img.endswith('.dlabel.nii')
+
+    return isinstance(img, cifti2.Cifti2Image)
+
+
+def load_dtseries(fname, dtype=np.float64):
+    """
+    returns the image, its time x grayordinates data and its tr (seconds)
+    """
+    img = nib.load(fname)
+    series = img.header.get_axis(0)
+    if not isinstance(series, cifti2.SeriesAxis):
+        print("{} is not a dtseries (first axis is not a series). exiting".format(fname))
+        exit(1)
+
+    tr = series.step
+    if series.unit == 'MILLISECOND':
+        tr = tr / 1000.
+
+    return img, img.get_fdata(dtype=dtype), tr
+
+
+def dtseries_img(data, template, discardvols=0):
+    """
+    a dtseries image of time x grayordinates data, with the grayordinates of
+    the template image, and its time axis minus the discarded volumes
+    """
+    series = template.header.get_axis(0)
+    brainmodel = template.header.get_axis(1)
+    newseries = cifti2.SeriesAxis(series.start + discardvols * series.step, series.step,
+                                  data.shape[0], unit=series.unit)
+
+    return cifti2.Cifti2Image(data, header=(newseries, brainmodel))
+
+
+def save_dtseries(img, outname, outdtype=None):
+    """
+    write a dtseries image, cast to outdtype (float32, float64) if given. a
+    cifti cannot be gzipped, and int16 is written as float32
+    """
+    if outdtype == 'int16':
+        print("no int16 for cifti, writing float32")
+        outdtype = 'float32'
+    if outdtype is not None:
+        img = cifti2.Cifti2Image(np.asarray(img.dataobj, dtype=outdtype), header=img.header)
+
+    nib.save(img, outname)
+    return outname
+
+
+def grayordinate_keys(brainmodel):
+    """
+    (structure, vertex) for the surface, (structure, i, j, k) for the volume
+    grayordinates of a BrainModelAxis
+    """
+    keys = []
+    for name, surf, vert, vox in zip(brainmodel.name, brainmodel.surface_mask,
+                                     brainmodel.vertex, brainmodel.voxel):
+        keys.append((name, int(vert)) if surf else (name,) + tuple(int(v) for v in vox))
+
+    return keys
+
+
+def dlabel_operator(labelimg, brainmodel):
+    """
+    a sparse regions x grayordinates matrix that averages the grayordinates
+    (of the dtseries brainmodel) of each region of a dlabel, so that
+    operator.dot(grayordinates x time) gives the region x time signals
+
+    returns the operator, the regions with grayordinates in the dtseries,
+    and the number of regions of the dlabel
+    """
+    labels = np.asarray(labelimg.get_fdata()[0]).astype(int)
+    labelmodel = labelimg.header.get_axis(1)
+
+    if labelmodel == brainmodel:
+        onseries = labels
+    else:
+        # match the grayordinates up, those not in the dlabel are 0
+        labelof = dict(zip(grayordinate_keys(labelmodel), labels))
+        onseries = np.array([labelof.get(key, 0) for key in grayordinate_keys(brainmodel)],
+                            dtype=int)
+
+    reginparc = np.unique(onseries[onseries != 0])
+    nreginorig = len(np.unique(labels[labels != 0]))
+
+    # row of each labeled grayordinate, weighted by 1 / grayordinates in that region
+    inreg = np.flatnonzero(onseries)
+    rows = np.searchsorted(reginparc, onseries[inreg])
+    counts = np.bincount(rows, minlength=len(reginparc))
+    operator = sparse.csr_matrix((1.0 / counts[rows], (rows, inreg)),
+                                 shape=(len(reginparc), len(onseries)))
+
+    return operator, reginparc, nreginorig
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+connectivity matrices of several kinds from one pass over the time series
+
+the kinds (correlation, partial correlation, covariance) and the shrinkage
+estimators (ledoit-wolf, oas, or none) all come from the same sufficient
+statistics: the centred gram matrix of the regions, and the row sums of
+squares of the centred data (which is all ledoit-wolf needs on top of the
+gram). so the time series are gone over once, as one matrix multiply, for
+any number of kinds. everything works on a time x regions array or on a
+stack of them (subjects x time x regions, batched matrix multiplies), in
+the precision of the input; only the inversion of partial correlation is
+done in float64 (cholesky)
+
+with the default 'lw' estimator the results are those of nilearn's
+ConnectivityMeasure (ledoit-wolf, and for correlation fit on the
+standardized signals), which makemat.py used before
+
+@author: jfaskowi
+
+"""
+
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+lapack = lazy_import('scipy.linalg.lapack')
+
+KINDS = ['correlation', 'partial correlation', 'covariance']
+ESTIMATORS = ['lw', 'oas', 'empirical']
+
+
+def diag_view(mats):
+    """
+    writable view of the diagonals of a (stack of) square matrices
+    """
+    return np.einsum('...ii->...i', mats)
+
+
+def gram_stats(time_series):
+    """
+    the sufficient statistics of a (stack of) time x regions array(s)
+
+    returns a dict of n (frames), cov (the empirical covariance, centred
+    gram / n), rowsq (row sums of squares of the centred data), std (of
+    each region, 1 where ~0, as nilearn's zscore), and rowsqz (rowsq of the
+    standardized data)
+    """
+    x = time_series - time_series.mean(axis=-2, keepdims=True)
+    n = x.shape[-2]
+
+    cov = np.matmul(np.swapaxes(x, -1, -2), x)
+    cov /= n
+
+    std = np.sqrt(diag_view(cov).astype(np.float64))
+    std[std < np.finfo(np.float64).eps] = 1.
+
+    x2 = np.square(x, dtype=np.float64)
+    rowsq = x2.sum(axis=-1)
+    rowsqz = np.matmul(x2, (1. / std ** 2)[..., None])[..., 0]
+
+    return {'n': n, 'cov': cov, 'rowsq': rowsq, 'std': std, 'rowsqz': rowsqz}
+
+
+def lw_shrinkage(cov, n, rowsq):
+    """
+    ledoit-wolf shrinkage, as sklearn.covariance.ledoit_wolf_shrinkage, from
+    the empirical covariance and the row sums of squares of the centred data
+    """
+    p = cov.shape[-1]
+    if p == 1:
+        return np.zeros(cov.shape[:-2])
+
+    trace = np.trace(cov, axis1=-2, axis2=-1).astype(np.float64)
+    mu = trace / p
+    beta_ = np.sum(rowsq ** 2, axis=-1)
+    delta_ = np.sum(np.square(cov, dtype=np.float64), axis=(-2, -1))
+
+    beta = (beta_ / n - delta_) / (n * p)
+    delta = (delta_ - 2. * mu * trace + p * mu ** 2) / p
+    beta = np.minimum(beta, delta)
+
+    return np.where(beta == 0, 0., beta / np.where(delta == 0, 1., delta))
+
+
+def oas_shrinkage(cov, n):
+    """
+    oracle approximating shrinkage, as sklearn.covariance.oas
+    """
+    p = cov.shape[-1]
+    if p == 1:
+        return np.zeros(cov.shape[:-2])
+
+    mu = np.trace(cov, axis1=-2, axis2=-1).astype(np.float64) / p
+    alpha = np.mean(np.square(cov, dtype=np.float64), axis=(-2, -1))
+    num = alpha + mu ** 2
+    den = (n + 1.) * (alpha - mu ** 2 / p)
+
+    return np.where(den == 0, 1., np.minimum(num / np.where(den == 0, 1., den), 1.))
+
+
+def shrink(cov, n, rowsq, estimator='lw'):
+    """
+    the shrunk covariance, (1 - s) cov + s mu I, of estimator (a copy)
+    """
+    if estimator == 'empirical':
+        return cov.copy()
+    elif estimator == 'lw':
+        shrinkage = lw_shrinkage(cov, n, rowsq)
+    elif estimator == 'oas':
+        shrinkage = oas_shrinkage(cov, n)
+    else:
+        raise ValueError("unknown estimator {}".format(estimator))
+
+    mu = np.trace(cov, axis1=-2, axis2=-1).astype(np.float64) / cov.shape[-1]
+    shrunk = cov * np.asarray(1. - shrinkage, dtype=cov.dtype)[..., None, None]
+    diag_view(shrunk)[...] += np.asarray(shrinkage * mu, dtype=cov.dtype)[..., None]
+
+    return shrunk
+
+
+def cov_to_corr(cov):
+    """
+    correlation of a (stack of) covariance(s), in place. diagonal set to 1
+    """
+    invstd = 1. / np.sqrt(diag_view(cov))
+    cov *= invstd[..., :, None]
+    cov *= invstd[..., None, :]
+    diag_view(cov)[...] = 1.
+
+    return cov
+
+
+def precision(cov):
+    """
+    inverse of a (stack of) symmetric positive definite matrix(ces), by
+    cholesky, in float64
+    """
+    stack = np.array(cov, dtype=np.float64).reshape((-1,) + cov.shape[-2:])
+    for n in range(stack.shape[0]):
+        # lower cholesky of the (symmetric) matrix, then its inverse
+        chol, info = lapack.dpotrf(stack[n], lower=True, clean=False)
+        if info != 0:
+            raise np.linalg.LinAlgError("matrix not positive definite")
+        prec, info = lapack.dpotri(chol, lower=True)
+        if info != 0:
+            raise np.linalg.LinAlgError("cholesky inverse failed")
+        # only the lower triangle is filled in
+        lower = np.tril(prec)
+        stack[n] = lower + np.tril(prec, -1).T
+
+    return stack.reshape(cov.shape)
+
+
+def connectivity(time_series, kinds=('correlation',), estimator='lw'):
+    """
+    connectivity matrices of every kind in kinds, for a time x regions
+    array (or a stack of subjects x time x regions), from one gram_stats
+
+    returns a dict of kind: regions x regions matrix (or stack), in the
+    precision of time_series
+    """
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValueError("unknown connectivity kind {}".format(kind))
+
+    stats = gram_stats(time_series)
+    n = stats['n']
+    out = {}
+
+    if 'correlation' in kinds:
+        # as nilearn: the estimator on the standardized signals
+        std = stats['std'].astype(stats['cov'].dtype)
+        covz = stats['cov'] / std[..., :, None]
+        covz /= std[..., None, :]
+        out['correlation'] = cov_to_corr(shrink(covz, n, stats['rowsqz'], estimator))
+
+    if 'covariance' in kinds or 'partial correlation' in kinds:
+        shrunk = shrink(stats['cov'], n, stats['rowsq'], estimator)
+
+        if 'partial correlation' in kinds:
+            partial = -cov_to_corr(precision(shrunk))
+            diag_view(partial)[...] = 1.
+            out['partial correlation'] = partial.astype(time_series.dtype, copy=False)
+
+        if 'covariance' in kinds:
+            out['covariance'] = shrunk
+
+    return out
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+binary connectivity matrix files, and reading many of them at once
+
+a matrix is stored as its upper triangle (above the diagonal, in the order
+of np.triu_indices(nregions, 1)), float32, with the region ids:
+
+    <name>_connMat.npy   the triangle, a 1d array of nregions*(nregions-1)/2
+    <name>_connMat.json  regionids, conntype, ...
+
+or both in one <name>_connMat.hdf5 (datasets triu and regionids, the rest as
+attributes). load_conn gives back the square matrix, load_conn_group the
+triangles of many subjects as one subjects x edges array, reading the raw
+binary (memory mapped for npy), no parsing
+
+    connio.py -out group.npy <subject _connMat.npy/.hdf5 files>
+
+stacks many subjects into one (memory mappable) group.npy + group.json
+
+@author: jfaskowi
+
+"""
+
+import json
+import argparse
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+h5py = lazy_import('h5py')
+
+
+def pack_triu(connmat):
+    """
+    the upper triangle (k=1) of a square matrix, as float32
+    """
+    return connmat[np.triu_indices(connmat.shape[0], 1)].astype(np.float32)
+
+
+def unpack_triu(triu, nregions, diag=0.):
+    """
+    the square (symmetric) matrix of a pack_triu triangle
+    """
+    connmat = np.full((nregions, nregions), diag, dtype=triu.dtype)
+    rows, cols = np.triu_indices(nregions, 1)
+    connmat[rows, cols] = triu
+    connmat[cols, rows] = triu
+
+    return connmat
+
+
+def save_conn(outbase, connmat, regions, conntype, fmt='npy'):
+    """
+    write the triangle of connmat (regions x regions, with ids regions) to
+    outbase_connMat.npy + .json, or outbase_connMat.hdf5 (fmt='hdf5')
+    """
+    triu = pack_triu(connmat)
+    meta = {'regionids': [int(r) for r in regions],
+            'nregions': len(regions),
+            'conntype': conntype,
+            'layout': 'upper triangle, k=1, np.triu_indices order',
+            'dtype': 'float32'}
+
+    if fmt == 'hdf5':
+        with h5py.File(''.join([outbase, '_connMat.hdf5']), 'w') as h5f:
+            h5f.create_dataset('triu', data=triu)
+            h5f.create_dataset('regionids', data=np.array(regions))
+            for key in ['nregions', 'conntype', 'layout', 'dtype']:
+                h5f.attrs[key] = meta[key]
+        return
+
+    np.save(''.join([outbase, '_connMat.npy']), triu)
+    with open(''.join([outbase, '_connMat.json']), 'w') as f:
+        json.dump(meta, f)
+
+
+def read_triu(fname, mmap=True):
+    """
+    the triangle and region ids of a _connMat.npy (memory mapped if mmap)
+    or _connMat.hdf5
+    """
+    if fname.endswith('.hdf5'):
+        with h5py.File(fname, 'r') as h5f:
+            return h5f['triu'][()], h5f['regionids'][()]
+
+    triu = np.load(fname, mmap_mode='r' if mmap else None)
+    with open(''.join([fname.rsplit('.npy', 1)[0], '.json']), 'r') as f:
+        regionids = np.array(json.load(f)['regionids'])
+
+    return triu, regionids
+
+
+def load_conn(fname):
+    """
+    returns the square matrix and region ids of a _connMat.npy or .hdf5
+    """
+    triu, regionids = read_triu(fname, mmap=False)
+
+    return unpack_triu(np.asarray(triu), len(regionids)), regionids
+
+
+def load_conn_group(fnames, regionids=None, out=None):
+    """
+    the triangles of many subjects as one subjects x edges float32 array. if
+    the subjects do not all have the same regions (some interpolated out,
+    see makemat.check_regions), they are lined up on regionids (default:
+    the union of all of them), with nan for the missing edges
+
+    out: if given, the array is a memory mapped out (.npy) instead of being
+    in memory
+
+    returns the array and the regionids
+    """
+    if regionids is None:
+        allids = [read_triu(fname)[1] for fname in fnames]
+        regionids = np.unique(np.concatenate(allids))
+    regionids = np.asarray(regionids)
+    nreg = len(regionids)
+    rows, cols = np.triu_indices(nreg, 1)
+
+    shape = (len(fnames), nreg * (nreg - 1) // 2)
+    if out is not None:
+        group = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32,
+                                          shape=shape)
+    else:
+        group = np.empty(shape, dtype=np.float32)
+
+    for n, fname in enumerate(fnames):
+        triu, subids = read_triu(fname)
+        if np.array_equal(subids, regionids):
+            group[n, :] = triu
+            continue
+
+        # line up the subject regions on regionids
+        pos = np.searchsorted(regionids, subids)
+        if np.any(pos >= nreg) or np.any(regionids[np.minimum(pos, nreg - 1)] != subids):
+            raise ValueError("{} has regions not in regionids".format(fname))
+        full = np.full((nreg, nreg), np.nan, dtype=np.float32)
+        full[np.ix_(pos, pos)] = unpack_triu(np.asarray(triu), len(subids))
+        group[n, :] = full[rows, cols]
+
+    if out is not None:
+        group.flush()
+
+    return group, regionids
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='stack many _connMat files into one '
+                                     'subjects x edges array')
+    parser.add_argument('-out', type=str, help='output group .npy (+ .json)', required=True)
+    parser.add_argument('conns', nargs='+', help='_connMat.npy or _connMat.hdf5 files')
+
+    # parse
+    args = parser.parse_args()
+
+    group, regionids = load_conn_group(args.conns, out=args.out)
+    print("stacked {} subjects x {} edges into {}".format(group.shape[0], group.shape[1], args.out))
+
+    with open(''.join([args.out.rsplit('.npy', 1)[0], '.json']), 'w') as f:
+        json.dump({'subjects': args.conns,
+                   'regionids': [int(r) for r in regionids],
+                   'nregions': len(regionids),
+                   'layout': 'subjects x upper triangle, k=1, np.triu_indices order',
+                   'dtype': 'float32'}, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+small on-disk cache of numpy arrays, one .npz per key, keys made from
+content hashes. least recently used entries are evicted once the cache
+goes over its size limit
+
+@author: jfaskowi
+
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def hash_parts(*parts):
+    """
+    sha1 hex digest of strings, bytes, and numpy arrays (dtype + shape +
+    values)
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(str(part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(str(part).encode())
+        # separator, so that ('ab', 'c') != ('a', 'bc')
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def hash_img(img):
+    """
+    hash of the geometry (affine, shape) and the raw voxel values of a
+    nibabel image
+    """
+    return hash_parts(np.asarray(img.affine, dtype=np.float64),
+                      img.shape,
+                      np.asanyarray(img.dataobj))
+
+
+def cache_get(cachedir, key):
+    """
+    returns a dict of the arrays stored under key, or None if not cached
+    """
+    fname = os.path.join(cachedir, ''.join([key, '.npz']))
+    if not os.path.isfile(fname):
+        return None
+
+    try:
+        with np.load(fname) as npz:
+            out = {k: npz[k] for k in npz.files}
+    except (IOError, ValueError):
+        # partial or corrupt file, treat as not there
+        return None
+
+    # mark as recently used
+    os.utime(fname, None)
+    return out
+
+
+def cache_put(cachedir, key, arrays, maxsize=None):
+    """
+    store a dict of arrays under key, then evict old entries so that the
+    cache stays under maxsize bytes (no limit if None)
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+
+    # write to a temp file and move into place, so that concurrent jobs
+    # sharing the cache never read a half written entry
+    fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    # mkstemp makes the file private, let others sharing the cache read it
+    os.chmod(tmpname, 0o644)
+    os.replace(tmpname, os.path.join(cachedir, ''.join([key, '.npz'])))
+
+    if maxsize is not None:
+        cache_evict(cachedir, maxsize)
+
+
+def cache_evict(cachedir, maxsize):
+    """
+    remove least recently used entries until the cache is <= maxsize bytes
+    """
+    entries = []
+    for fname in os.listdir(cachedir):
+        if not fname.endswith('.npz'):
+            continue
+        fullname = os.path.join(cachedir, fname)
+        try:
+            st = os.stat(fullname)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, fullname))
+
+    total = sum(e[1] for e in entries)
+    for _, size, fullname in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(fullname)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+sliding-window (dynamic) connectivity of region time series, the windowed
+pearson correlation of every pair of regions (makemat.py -dynwindow)
+
+instead of a fresh correlation per window (width x regions^2 each), the sums
+and cross products of the frames in the window are kept and updated as the
+window moves: the frames leaving are subtracted and the frames entering
+added, (step x regions^2 per window). the tapered windows (hann, hamming)
+are a - b cos(2 pi k / (width - 1)) over the frames k of the window, and
+since cos(theta (t - start)) = cos(theta t) cos(theta start) +
+sin(theta t) sin(theta start), their weighted sums come from running sums
+with cos / sin of the absolute frame t, which slide the same way. the sums
+are recomputed from scratch every -dynresync windows, so the rounding of
+the updates does not build up
+
+each window's upper triangle (k=1, np.triu_indices order, float32, see
+connio.py) is written, a buffer of windows at a time, to a chunked hdf5:
+
+    dynconn       windows x edges
+    regionids     the label id of each region
+    windowstart   the first frame of each window
+
+with attributes width, step, taper. nothing of size windows x regions^2 is
+ever held in memory
+
+@author: jfaskowi
+
+"""
+
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+h5py = lazy_import('h5py')
+
+TAPERS = ['none', 'hann', 'hamming']
+
+# w = a - b cos(2 pi k / (width - 1))
+TAPERCOEFS = {'hann': (0.5, 0.5), 'hamming': (0.54, 0.46)}
+
+
+def window_weights(width, taper='none'):
+    """
+    the weight of each frame of a window
+    """
+    if taper == 'none':
+        return np.ones(width)
+    a, b = TAPERCOEFS[taper]
+
+    return a - b * np.cos(2. * np.pi * np.arange(width) / (width - 1))
+
+
+def window_starts(nframes, width, step=1):
+    """
+    first frame of every window that fits in nframes
+    """
+    if width < 2 or width > nframes:
+        raise ValueError("window width {} does not fit {} frames".format(width, nframes))
+
+    return np.arange(0, nframes - width + 1, step)
+
+
+class WindowSums(object):
+    """
+    the (weighted) sums of the frames, and of their cross products, of a
+    window of a time x regions array, that can slide. the running sums of
+    the modulations (1, or 1, cos, sin for the tapers) are stacked, so that
+    an update is one matrix multiply
+    """
+
+    def __init__(self, time_series, width, taper='none'):
+        self.x = np.asarray(time_series, dtype=np.float64)
+        self.width = width
+        self.taper = taper
+        self.theta = 2. * np.pi / (width - 1)
+        self.start = None
+        nmod = 1 if taper == 'none' else 3
+        nreg = self.x.shape[1]
+        self.wsum = np.zeros(nmod)
+        self.xsum = np.zeros((nmod, nreg))
+        self.xx = np.zeros((nmod, nreg, nreg))
+
+    def _mods(self, frames):
+        """
+        the modulations of the running sums for the (absolute) frames, frames
+        x modulations
+        """
+        if self.taper == 'none':
+            return np.ones((len(frames), 1))
+        t = frames * self.theta
+
+        return np.stack([np.ones(len(frames)), np.cos(t), np.sin(t)], axis=1)
+
+    def _add(self, frames, signs):
+        """
+        add (or, with signs -1, subtract) frames to the running sums
+        """
+        x = self.x[frames]
+        mods = self._mods(frames) * signs[:, None]
+        nmod, nreg = self.xsum.shape
+        xm = (mods[:, :, None] * x[:, None, :]).reshape(len(frames), nmod * nreg)
+
+        self.wsum += mods.sum(axis=0)
+        self.xsum += xm.sum(axis=0).reshape(nmod, nreg)
+        xx = self.xx.reshape(nmod * nreg, nreg)
+        xx += xm.T.dot(x)
+
+    def reset(self, start):
+        self.start = start
+        self.wsum[:] = 0.
+        self.xsum[:] = 0.
+        self.xx[:] = 0.
+        frames = np.arange(start, start + self.width)
+        self._add(frames, np.ones(len(frames)))
+
+    def slide(self, start):
+        """
+        move the window to start, by updating the sums if that is cheaper
+        """
+        shift = start - self.start
+        if shift <= 0 or shift >= self.width:
+            self.reset(start)
+            return
+
+        # frames entering and leaving, in one update
+        frames = np.concatenate([np.arange(self.start + self.width, start + self.width),
+                                 np.arange(self.start, start)])
+        self._add(frames, np.repeat([1., -1.], shift))
+        self.start = start
+
+    def window_sums(self):
+        """
+        the weight, frame and cross product sums of the current window
+        """
+        if self.taper == 'none':
+            return self.wsum[0], self.xsum[0], self.xx[0]
+
+        # a - b (cos(theta t) cos(theta s) + sin(theta t) sin(theta s))
+        a, b = TAPERCOEFS[self.taper]
+        coefs = np.array([a,
+                          -b * np.cos(self.theta * self.start),
+                          -b * np.sin(self.theta * self.start)])
+        nmod, nreg = self.xsum.shape
+
+        return (coefs.dot(self.wsum), coefs.dot(self.xsum),
+                coefs.dot(self.xx.reshape(nmod, nreg * nreg)).reshape(nreg, nreg))
+
+    def corr_triu(self, rows, cols, flat):
+        """
+        the upper triangle (rows, cols, and flat = rows * regions + cols) of
+        the weighted correlation matrix of the current window
+        """
+        wsum, xsum, xx = self.window_sums()
+        mean = xsum / wsum
+        std = np.sqrt(np.maximum(np.diag(xx) / wsum - mean ** 2, 0.))
+        std[std < np.finfo(np.float64).eps] = np.inf
+
+        triu = np.take(xx, flat)
+        triu /= wsum
+        triu -= mean[rows] * mean[cols]
+        triu /= std[rows] * std[cols]
+
+        return triu
+
+
+def sliding_window_conn(time_series, outname, width, step=1, taper='none',
+                        regions=None, buffersize=64, resync=500):
+    """
+    the windowed correlation of a time x regions array, for windows of width
+    frames every step frames, written to outname (.hdf5, see the top of this
+    file), buffersize windows at a time. the running sums are recomputed
+    from scratch every resync windows
+
+    returns the number of windows
+    """
+    starts = window_starts(time_series.shape[0], width, step)
+    nreg = time_series.shape[1]
+    rows, cols = np.triu_indices(nreg, 1)
+    flat = rows * nreg + cols
+    nedge = len(rows)
+
+    sums = WindowSums(time_series, width, taper)
+
+    with h5py.File(outname, 'w') as h5f:
+        dset = h5f.create_dataset('dynconn', shape=(len(starts), nedge), dtype=np.float32,
+                                  chunks=(min(len(starts), 64), max(1, min(nedge, 4096))))
+        h5f.create_dataset('windowstart', data=starts)
+        if regions is not None:
+            h5f.create_dataset('regionids', data=np.asarray(regions))
+        h5f.attrs['width'] = width
+        h5f.attrs['step'] = step
+        h5f.attrs['taper'] = taper
+        h5f.attrs['layout'] = 'windows x upper triangle, k=1, np.triu_indices order'
+
+        buf = np.empty((min(len(starts), buffersize), nedge), dtype=np.float32)
+        for n, start in enumerate(starts):
+            if n % resync == 0:
+                sums.reset(start)
+            else:
+                sums.slide(start)
+            buf[n % buffersize] = sums.corr_triu(rows, cols, flat)
+
+            if n % buffersize == buffersize - 1 or n == len(starts) - 1:
+                first = n - n % buffersize
+                dset[first:n + 1] = buf[:n + 1 - first]
+
+    return len(starts)
+
+
+def read_dynconn(fname, windows=None):
+    """
+    the windows x edges array (only the windows asked for, a slice or
+    increasing indices, all by default), the window starts and the region
+    ids of a sliding_window_conn file
+    """
+    if windows is None:
+        windows = slice(None)
+
+    with h5py.File(fname, 'r') as h5f:
+        dynconn = h5f['dynconn'][windows]
+        starts = h5f['windowstart'][windows]
+        regionids = h5f['regionids'][()] if 'regionids' in h5f else None
+
+    return dynconn, starts, regionids
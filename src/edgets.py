@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+edge time series (co-fluctuation) of region time series (makemat.py
+-edgets): for every pair of regions, the frame by frame product of their
+z-scored signals, whose mean over the frames is their correlation
+
+with 400 regions that is ~80k edges per frame, so the edges are made and
+written a block of frames at a time, never all at once. per frame, the rss
+(root sum of squares over the edges, the co-fluctuation amplitude) comes out
+of the same pass, and the matrices of the frames with the top (and bottom)
+-edgetspct % of rss need only the z-scored region signals of those frames.
+all goes to one chunked hdf5:
+
+    edgets        frames x edges, float32, upper triangle (k=1,
+                  np.triu_indices order, see connio.py)
+    rss           per frame
+    frames        the frame (of the time series) of each row, the censored
+                  frames are left out
+    topframes     frames (rows) with the top / bottom pct of rss
+    bottomframes
+    topconn       the mean edge time series (upper triangles) of those frames
+    bottomconn
+    regionids     the label id of each region
+
+@author: jfaskowi
+
+"""
+
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+h5py = lazy_import('h5py')
+
+
+def zscore_frames(time_series):
+    """
+    z-score each region (column) over the frames, ddof 0, regions with no
+    variance left at 0
+    """
+    time_series = np.asarray(time_series, dtype=np.float64)
+    std = time_series.std(axis=0)
+    std[std < np.finfo(np.float64).eps] = np.inf
+
+    return (time_series - time_series.mean(axis=0)) / std
+
+
+def block_frames(nedge, blockmem=64):
+    """
+    frames per block, so a float64 block of edges is about blockmem MB
+    """
+    return int(max(1, blockmem * 1024 * 1024 // (8 * max(1, nedge))))
+
+
+def edge_time_series(time_series, outname, regions=None, censor=None, pct=5.,
+                     blocksize=None):
+    """
+    the edge time series of a time x regions array, written to outname
+    (.hdf5, see the top of this file) blocksize frames at a time (default:
+    see block_frames). censor: boolean frames to keep (see
+    makemat.extract_mat). pct: the percent of frames (by rss) for the top /
+    bottom matrices
+
+    returns the rss of each (kept) frame
+    """
+    frames = np.arange(time_series.shape[0])
+    if censor is not None:
+        frames = frames[censor]
+    z = zscore_frames(np.asarray(time_series)[frames])
+
+    nframe, nreg = z.shape
+    rows, cols = np.triu_indices(nreg, 1)
+    nedge = len(rows)
+    if blocksize is None:
+        blocksize = block_frames(nedge)
+
+    rss = np.empty(nframe)
+    with h5py.File(outname, 'w') as h5f:
+        dset = h5f.create_dataset('edgets', shape=(nframe, nedge), dtype=np.float32,
+                                  chunks=(max(1, min(nframe, 32)), max(1, min(nedge, 2048))))
+        for f0 in range(0, nframe, blocksize):
+            f1 = min(nframe, f0 + blocksize)
+            block = z[f0:f1, rows] * z[f0:f1, cols]
+            rss[f0:f1] = np.sqrt(np.sum(block ** 2, axis=1))
+            dset[f0:f1] = block
+
+        # frames by rss, the matrices straight from the z-scored signals
+        nsel = max(1, int(np.round(nframe * pct / 100.)))
+        order = np.argsort(rss, kind='stable')
+        for name, sel in [('top', order[::-1][:nsel]), ('bottom', order[:nsel])]:
+            sel = np.sort(sel)
+            conn = z[sel].T.dot(z[sel]) / len(sel)
+            h5f.create_dataset(''.join([name, 'frames']), data=sel)
+            h5f.create_dataset(''.join([name, 'conn']),
+                               data=conn[rows, cols].astype(np.float32))
+
+        h5f.create_dataset('rss', data=rss)
+        h5f.create_dataset('frames', data=frames)
+        if regions is not None:
+            h5f.create_dataset('regionids', data=np.asarray(regions))
+        h5f.attrs['pct'] = pct
+        h5f.attrs['layout'] = 'frames x upper triangle, k=1, np.triu_indices order'
+
+    return rss
+
+
+def read_edgets(fname, frames=None, edges=None):
+    """
+    the frames x edges array of an edge_time_series file, only the frames
+    and edges (slices or increasing indices) asked for, all by default
+    """
+    if frames is None:
+        frames = slice(None)
+    if edges is None:
+        edges = slice(None)
+
+    with h5py.File(fname, 'r') as h5f:
+        return h5f['edgets'][frames, edges]
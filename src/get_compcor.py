@@ -4,21 +4,139 @@
 """
 Function using nilearn to write tsv with compcor columns
 
+compcor components of the image itself, for regress.py -compcor, where they
+are made from the voxel data that is loaded for the regression anyway
+(instead of a run of this script, a second load of the image, and
+-add_regressors) and go straight into the get_confounds designs:
+
+    mask      aCompCor: the voxels of -compcormask (e.g. white matter + csf)
+    highvar   tCompCor: the -compcorpct % of the voxels of -mask (all the
+              voxels if none) with the highest variance (as nilearn's
+              high_variance_confounds)
+
+the signals are linearly detrended, and the components are the top left
+singular vectors of the time x voxel matrix, from a randomized svd (a few
+passes over the data with a ncomp + 10 column sketch) for long runs, where
+that is cheaper than the time x time eigenproblem. the highvar variances
+are had from the voxels a block at a time, without a detrended copy of all
+of them. see verify.py compcor
+
 @author: jfaskowi
 
 """
 
 import argparse
-import nibabel as nib
-# import numpy as np
-from nilearn import image
-import pandas as pd
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+pd = lazy_import('pandas')
+linalg = lazy_import('scipy.linalg')
+image = lazy_import('nilearn.image')
+extmath = lazy_import('sklearn.utils.extmath')
+
+COMPCORCHOICES = ['file', 'mask', 'highvar']
+
+
+def detrend_basis(nvol):
+    """
+    orthonormal basis (time x 2) of a constant and a linear trend
+    """
+    basis, _ = np.linalg.qr(np.stack([np.ones(nvol), np.arange(nvol, dtype=np.float64)], axis=1))
+
+    return basis
+
+
+def voxel_blocks(data, maskdat, blocksize=8192):
+    """
+    time x voxels blocks of the voxels of maskdat in a 4D array
+    """
+    coords = np.nonzero(maskdat)
+    for v0 in range(0, len(coords[0]), blocksize):
+        idx = tuple(c[v0:v0 + blocksize] for c in coords)
+        yield np.asarray(data[idx], dtype=np.float64).T
+
+
+def compcor_series(data, maskdat, percentile=None, detrend=True):
+    """
+    the (detrended) time x voxels signals to take the components of: all the
+    voxels of maskdat or, with percentile, the percentile % of them with the
+    highest mean of squares (after detrending, as nilearn)
+    """
+    nvol = data.shape[3]
+    basis = detrend_basis(nvol) if detrend else None
+
+    if percentile is not None:
+        var = []
+        for block in voxel_blocks(data, maskdat):
+            meansq = np.einsum('ij,ij->j', block, block)
+            if detrend:
+                meansq -= np.sum(basis.T.dot(block) ** 2, axis=0)
+            var.append(meansq / nvol)
+        var = np.concatenate(var)
+        coords = np.nonzero(maskdat)
+        maskdat = np.zeros(maskdat.shape, dtype=bool)
+        maskdat[coords] = var > np.nanpercentile(var, 100. - percentile)
+
+    series = np.concatenate(list(voxel_blocks(data, maskdat)), axis=1)
+    if detrend:
+        series -= basis.dot(basis.T.dot(series))
+
+    return series
+
+
+def compcor_components(series, ncomp=5, niter=7, seed=0):
+    """
+    the top ncomp left singular vectors (time x ncomp) of a time x voxels
+    array. by randomized svd (niter power iterations of a ncomp + 10 column
+    sketch) when that is cheaper than the time x time eigenproblem, which is
+    when there are many more frames than columns in all the passes
+    """
+    nvol = series.shape[0]
+    if 4 * (niter + 1) * (ncomp + 10) >= nvol or min(series.shape) <= 5 * (ncomp + 10):
+        s, u = linalg.eigh(series.dot(series.T))
+        return u[:, np.argsort(s)[::-1][:ncomp]]
+
+    u, _, _ = extmath.randomized_svd(series, ncomp, n_iter=niter, random_state=seed)
+
+    return u
+
+
+def compcor_from_img(inputimg, kind='highvar', inputmask=None, compcormask=None,
+                     percentile=2., ncomp=5, detrend=True):
+    """
+    the compcor components (see the top of this file for kind) of a 4D image,
+    as a data frame with a_comp_cor_XX (mask) or t_comp_cor_XX (highvar)
+    columns
+    """
+    data = np.asanyarray(inputimg.dataobj)
+    if kind == 'mask' and compcormask is None:
+        print("-compcor mask needs a -compcormask. exiting")
+        exit(1)
+
+    maskimg = compcormask if kind == 'mask' else inputmask
+    if maskimg is not None:
+        maskimg = image.resample_to_img(maskimg, inputimg.slicer[..., 0], interpolation='nearest')
+        maskdat = np.asanyarray(maskimg.dataobj) != 0
+    else:
+        # all the voxels, as nilearn
+        maskdat = np.ones(data.shape[:3], dtype=bool)
+
+    series = compcor_series(data, maskdat, percentile if kind == 'highvar' else None,
+                            detrend=detrend)
+    print("compcor ({}) from {} voxels".format(kind, series.shape[1]))
+    comps = compcor_components(series, ncomp)
+
+    prefix = 'a_comp_cor_' if kind == 'mask' else 't_comp_cor_'
+    return pd.DataFrame(comps, columns=['{}{:0>2}'.format(prefix, n) for n in range(ncomp)])
 
 
 def runcompcor(inputimg, inputmask, prcntl, numc, detr):
 
-    return image.high_variance_confounds(inputimg, mask_img=inputmask, percentile=prcntl,
-                                         n_confounds=numc, detrend=detr)
+    return compcor_from_img(inputimg, 'highvar', inputmask=inputmask, percentile=prcntl,
+                            ncomp=numc, detrend=detr).values
 
 
 def main():
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+group summaries of the connectivity matrices of many subjects, streamed:
+one subject matrix is read at a time and added to running (welford) sums,
+so memory is a few edge-length arrays no matter the number of subjects
+
+    groupagg.py -out group [-nprocs 4] <_connMatdf.csv / _connMat.npy / _connMat.hdf5 files>
+    groupagg.py -out group -filelist subjects.txt
+
+per edge (the upper triangle, as connio.py) it keeps the number of subjects,
+the mean and the sum of squared deviations of the values and, unless
+-nofisherz, of their fisher z (arctanh, for correlations). subjects that do
+not have all the regions (some interpolated out, see makemat.check_regions)
+are lined up on the union of the region ids of all the files (read from the
+headers first) and only count for the edges they have; nan values do not
+count either
+
+the files are split in -nprocs shards, each summed in its own process, and
+the shards are merged at the end (chan et al.'s pairwise update), which
+gives the same result as one pass, up to rounding. written are
+
+    <out>_groupstats.hdf5   datasets regionids, count, mean, var, zmean,
+                            zvar, rfromz (tanh of zmean), as upper
+                            triangles, var with n - 1
+    <out>_<stat>_connMatdf.csv   (with -csv) the square matrices of those
+
+@author: jfaskowi
+
+"""
+
+import json
+import argparse
+import multiprocessing
+import numpy as np
+
+from lazyimport import lazy_import
+from connio import read_triu, unpack_triu
+
+# imported on first use, see lazyimport.py
+pd = lazy_import('pandas')
+h5py = lazy_import('h5py')
+
+STATS = ['count', 'mean', 'var', 'zmean', 'zvar', 'rfromz']
+
+
+def read_regionids(fname):
+    """
+    the region ids of a subject matrix file, from its header only
+    """
+    if fname.endswith('.csv'):
+        with open(fname, 'r') as f:
+            return np.array([int(float(r)) for r in f.readline().rstrip('\n').split(',')[1:]])
+    if fname.endswith('.hdf5'):
+        with h5py.File(fname, 'r') as h5f:
+            return h5f['regionids'][()]
+    with open(''.join([fname.rsplit('.npy', 1)[0], '.json']), 'r') as f:
+        return np.array(json.load(f)['regionids'])
+
+
+def read_matrix(fname):
+    """
+    the upper triangle and the region ids of a subject matrix file, a
+    makemat.py _connMatdf.csv or a connio.py _connMat.npy / .hdf5
+    """
+    if not fname.endswith('.csv'):
+        triu, regionids = read_triu(fname, mmap=False)
+        return np.asarray(triu, dtype=np.float64), np.asarray(regionids)
+
+    df = pd.read_csv(fname, index_col=0)
+    connmat = df.values.astype(np.float64)
+    regionids = np.array([int(float(r)) for r in df.columns])
+
+    return connmat[np.triu_indices(len(regionids), 1)], regionids
+
+
+def edge_index(rows, cols, nregions):
+    """
+    the position in the upper triangle (k=1) of nregions of edges rows, cols
+    (rows < cols)
+    """
+    return rows * nregions - rows * (rows + 1) // 2 + cols - rows - 1
+
+
+class EdgeMoments(object):
+    """
+    running count, mean and sum of squared deviations (welford) of every
+    edge of the matrices over regionids, and of their fisher z
+    """
+
+    def __init__(self, regionids, fisherz=True):
+        self.regionids = np.asarray(regionids)
+        self.fisherz = fisherz
+        self.nsubjects = 0
+        nedges = len(regionids) * (len(regionids) - 1) // 2
+        self.count = np.zeros(nedges)
+        self.mean = np.zeros(nedges)
+        self.m2 = np.zeros(nedges)
+        if fisherz:
+            self.zmean = np.zeros(nedges)
+            self.zm2 = np.zeros(nedges)
+
+    def edges_of(self, subids):
+        """
+        the positions of the triangle of a subject with regions subids in the
+        triangle of regionids
+        """
+        nreg = len(self.regionids)
+        pos = np.searchsorted(self.regionids, subids)
+        if np.any(pos >= nreg) or np.any(self.regionids[np.minimum(pos, nreg - 1)] != subids):
+            raise ValueError("regions {} not in the group regions".format(
+                             np.setdiff1d(subids, self.regionids)))
+        rows, cols = np.triu_indices(len(subids), 1)
+        rows, cols = pos[rows], pos[cols]
+        if np.any(rows > cols):
+            # subject regions not in ascending order
+            rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+
+        return edge_index(rows, cols, nreg)
+
+    @staticmethod
+    def _update(count, mean, m2, idx, values):
+        # count[idx] already includes values
+        delta = values - mean[idx]
+        mean[idx] += delta / count[idx]
+        m2[idx] += delta * (values - mean[idx])
+
+    def add(self, triu, subids):
+        """
+        add the triangle of one subject, with its region ids
+        """
+        subids = np.asarray(subids)
+        ok = np.isfinite(triu)
+        if np.array_equal(subids, self.regionids) and ok.all():
+            # every edge, no copies
+            idx = slice(None)
+        else:
+            if np.array_equal(subids, self.regionids):
+                idx = np.flatnonzero(ok)
+            else:
+                idx = self.edges_of(subids)[ok]
+            triu = triu[ok]
+        self.count[idx] += 1
+        self._update(self.count, self.mean, self.m2, idx, triu)
+        if self.fisherz:
+            zval = np.arctanh(np.clip(triu, -1 + 1e-7, 1 - 1e-7))
+            self._update(self.count, self.zmean, self.zm2, idx, zval)
+        self.nsubjects += 1
+
+    @staticmethod
+    def _merge(counta, meana, m2a, countb, meanb, m2b):
+        count = counta + countb
+        delta = meanb - meana
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(count > 0, countb / count, 0.)
+        mean = meana + delta * frac
+        m2 = m2a + m2b + delta ** 2 * counta * frac
+
+        return mean, m2
+
+    def merge(self, other):
+        """
+        add the sums of another EdgeMoments (of other subjects) to these
+        """
+        if not np.array_equal(self.regionids, other.regionids):
+            raise ValueError("cannot merge sums over different regions")
+        if self.fisherz:
+            self.zmean, self.zm2 = self._merge(self.count, self.zmean, self.zm2,
+                                               other.count, other.zmean, other.zm2)
+        self.mean, self.m2 = self._merge(self.count, self.mean, self.m2,
+                                         other.count, other.mean, other.m2)
+        self.count = self.count + other.count
+        self.nsubjects += other.nsubjects
+
+    def stats(self):
+        """
+        dict of stat name: upper triangle (see STATS), nan where there are
+        too few subjects
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = {'count': self.count.copy(),
+                   'mean': np.where(self.count > 0, self.mean, np.nan),
+                   'var': np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)}
+            if self.fisherz:
+                out['zmean'] = np.where(self.count > 0, self.zmean, np.nan)
+                out['zvar'] = np.where(self.count > 1, self.zm2 / (self.count - 1), np.nan)
+                out['rfromz'] = np.tanh(out['zmean'])
+
+        return out
+
+
+def aggregate(fnames, regionids, fisherz=True):
+    """
+    the EdgeMoments of the matrix files fnames, read one at a time
+    """
+    moments = EdgeMoments(regionids, fisherz=fisherz)
+    for fname in fnames:
+        triu, subids = read_matrix(fname)
+        moments.add(triu, subids)
+
+    return moments
+
+
+def aggregate_shards(fnames, regionids=None, nprocs=1, fisherz=True):
+    """
+    the EdgeMoments of all of fnames, summed in nprocs shards (processes)
+    and merged. regionids: default the union of those of all the files
+    """
+    if regionids is None:
+        regionids = np.unique(np.concatenate([read_regionids(fname) for fname in fnames]))
+    regionids = np.asarray(regionids)
+
+    nshards = max(1, min(nprocs, len(fnames)))
+    shards = [list(shard) for shard in np.array_split(np.array(fnames, dtype=object), nshards)]
+    if nshards == 1:
+        return aggregate(fnames, regionids, fisherz)
+
+    with multiprocessing.get_context('spawn').Pool(nshards) as pool:
+        parts = pool.starmap(aggregate, [(shard, regionids, fisherz) for shard in shards])
+
+    moments = parts[0]
+    for part in parts[1:]:
+        moments.merge(part)
+
+    return moments
+
+
+def save_group(outbase, moments, csv=False):
+    """
+    write the stats of an EdgeMoments to outbase_groupstats.hdf5 (and the
+    square matrices to csvs)
+    """
+    stats = moments.stats()
+    with h5py.File(''.join([outbase, '_groupstats.hdf5']), 'w') as h5f:
+        h5f.create_dataset('regionids', data=moments.regionids)
+        for name, triu in stats.items():
+            h5f.create_dataset(name, data=triu)
+        h5f.attrs['nsubjects'] = moments.nsubjects
+        h5f.attrs['layout'] = 'upper triangle, k=1, np.triu_indices order'
+
+    if csv:
+        names = [str(r) for r in moments.regionids]
+        for name, triu in stats.items():
+            connmat = unpack_triu(triu, len(names), diag=np.nan)
+            pd.DataFrame(connmat, index=names, columns=names).to_csv(
+                ''.join([outbase, '_', name, '_connMatdf.csv']), float_format='%.6g')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='streamed group mean / variance of many '
+                                     'subject connectivity matrices')
+    parser.add_argument('conns', nargs='*', help='_connMatdf.csv, _connMat.npy or _connMat.hdf5 '
+                        'files')
+    parser.add_argument('-filelist', type=str, help='text file with a matrix file per line '
+                        '(instead of, or as well as, conns)', default=None)
+    parser.add_argument('-out', type=str, help='output base name', required=True)
+    parser.add_argument('-nprocs', type=int, help='processes, each summing a shard of the files',
+                        default=1)
+    parser.add_argument('-nofisherz', help='no fisher z stats (for matrices that are not '
+                        'correlations)', action='store_true')
+    parser.add_argument('-csv', help='also write the square matrices of the stats as csvs',
+                        action='store_true')
+
+    # parse
+    args = parser.parse_args()
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        if arg != 'conns':
+            print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("conns {} files".format(len(args.conns)))
+    print("END ARGS\n")
+
+    fnames = list(args.conns)
+    if args.filelist is not None:
+        with open(args.filelist, 'r') as f:
+            fnames += [line.strip() for line in f if line.strip()]
+    if not fnames:
+        print("no matrix files given. exiting")
+        exit(1)
+
+    moments = aggregate_shards(fnames, nprocs=args.nprocs, fisherz=not args.nofisherz)
+    save_group(args.out, moments, csv=args.csv)
+
+    print("{} subjects, {} regions, {:.0f}% of edges in every subject, written to {}".format(
+          moments.nsubjects, len(moments.regionids),
+          100 * np.mean(moments.count == moments.nsubjects),
+          ''.join([args.out, '_groupstats.hdf5'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+modules that are imported on first use. nilearn, pandas, nibabel, scipy and
+h5py take about a second and a half to import, which is most of the time of
+a -h or of a run that exits on a bad option. the scripts bind them with
+
+    nib = lazy_import('nibabel')
+    signal = lazy_import('nilearn.signal')
+
+instead of import nibabel as nib, so nothing is imported until nib.load(...)
+or signal.clean(...) is first called, and everything after that is a plain
+module attribute
+
+@author: jfaskowi
+
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    stands in for a module until one of its attributes is needed
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        # only called for what is not on this object itself, i.e. the module's
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
+
+def lazy_import(name):
+    """
+    a module (dotted name) that is imported on first attribute access
+    """
+    return LazyModule(name)
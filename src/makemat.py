@@ -11,13 +11,31 @@ copied/adapted from original code here: https://github.com/fliem/sea_zrh_rs
 """
 
 import os
-import json
 import argparse
-import nibabel as nib
+import collections
 import numpy as np
-from nilearn import input_data, connectome
-import pandas as pd
-import h5py
+
+from lazyimport import lazy_import
+from diskcache import hash_img, hash_parts, cache_get, cache_put
+from connio import save_conn
+from connectivity import KINDS, ESTIMATORS, connectivity
+from tsstore import save_timeseries, export_tsv
+from dynconn import TAPERS, sliding_window_conn
+from edgets import edge_time_series
+from profiling import stage, note_array, report
+from cifti import is_cifti, dlabel_operator
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+pd = lazy_import('pandas')
+sparse = lazy_import('scipy.sparse')
+input_data = lazy_import('nilearn.input_data')
+signal = lazy_import('nilearn.signal')
+
+# label operators kept in memory by a process that runs many subjects (see
+# keep_label_operators), key: (operator, reginparc, nreginorig)
+_labelops = collections.OrderedDict()
+_keeplabelops = 0
 
 
 def get_con_df(raw_mat, roi_names):
@@ -31,16 +49,61 @@ def get_con_df(raw_mat, roi_names):
     r3  0.7  0.6  0.0  0.9
     r4  0.2  0.5  0.9  0.0
     """
-    # sanity check if matrix is symmetrical
-    assert np.allclose(raw_mat, raw_mat.T, atol=1e-04, equal_nan=True), "matrix not symmetrical"
-
+    # (symmetrical by construction, see connectivity.py)
     np.fill_diagonal(raw_mat, 0)
     con_df = pd.DataFrame(raw_mat, index=roi_names, columns=roi_names)
     return con_df
 
 
+def check_regions(reginparc, nreginorig):
+    """
+    warn if regions of the original label image (of which there were
+    nreginorig) did not make it through the resampling + masking
+    """
+    if len(reginparc) != nreginorig:
+        print('\n !!!WARNING!!! during resampling of label image, some of the'
+              ' ROIs (likely very small) were interpolated out. Please take '
+              'care to note which ROIs are present in the output data\n')
+        print('ALTERNATIVELY, your parcellation is not in the same space'
+              'as the bold data.\n')
+        if abs(len(reginparc) - nreginorig) > 9:
+            print('\nBASED ON QUICK HEURISTIC...I think your parcellation '
+                  'is not in the right space. Please check that the two '
+                  'images are aligned properly.')
+
+
+def get_conn(time_series, conntype, estimator='lw'):
+    """
+    connectivity matrices from a time x regions array, of one kind
+    (conntype a string) or several (a list), all from one pass over the time
+    series (see connectivity.py). the matrices come back in the precision
+    of the time series (the inversion for partial correlation is done in
+    float64)
+
+    returns a dict of kind: matrix
+    """
+    if isinstance(conntype, str):
+        conntype = [conntype]
+
+    return connectivity(time_series, kinds=conntype, estimator=estimator)
+
+
 def extract_mat(rsimg, maskimg, labelimg, conntype='correlation', space='labels', 
-                savets=False, nomat=False, dtr=False, stdz=False):
+                savets=False, nomat=False, dtr=False, stdz=False, censor=None,
+                dtype=np.float64, estimator='lw'):
+    """
+    conntype, estimator: see get_conn
+
+    censor, if given, is a boolean array of the frames to keep: the others
+    (censored frames, interpolated by the regression) are dropped before
+    making the matrix
+
+    dtype float32 keeps the data in single precision
+
+    returns connmats (dict of kind: matrix, None if nomat), time_series,
+    reginparc
+    """
+    single = np.dtype(dtype) == np.float32
 
     masker = input_data.NiftiLabelsMasker(labelimg,
                                           background_label=0,
@@ -49,163 +112,531 @@ def extract_mat(rsimg, maskimg, labelimg, conntype='correlation', space='labels'
                                           detrend=dtr,
                                           mask_img=maskimg,
                                           resampling_target=space,
+                                          dtype=dtype if single else None,
                                           verbose=1)
 
     # mask the labimg so that there are no regions that dont have data
     from nilearn.image import resample_to_img
-    if space == 'data':
-        # resample_to_image(source, target)
-        # assume here that the mask is also fmri space
-        resamplabs = resample_to_img(labelimg,maskimg,interpolation='nearest')
-        resampmask = resample_to_img(maskimg,maskimg,interpolation='nearest')
-    else:
-        resamplabs = resample_to_img(labelimg,labelimg,interpolation='nearest')
-        resampmask = resample_to_img(maskimg,labelimg,interpolation='nearest')
+    with stage('resample labels'):
+        if space == 'data':
+            # resample_to_image(source, target)
+            # assume here that the mask is also fmri space
+            resamplabs = resample_to_img(labelimg,maskimg,interpolation='nearest')
+            resampmask = maskimg
+        else:
+            resamplabs = resample_to_img(labelimg,labelimg,interpolation='nearest')
+            resampmask = resample_to_img(maskimg,labelimg,interpolation='nearest')
         
-    # mask
-    from nilearn.masking import apply_mask
-    resamplabsmasked = apply_mask(resamplabs,resampmask)
+        # mask
+        from nilearn.masking import apply_mask
+        resamplabsmasked = apply_mask(resamplabs,resampmask)
 
     # get the unique labels list, other than 0, which will be first
     #reginparc = np.unique(resamplabs.get_fdata())[1:].astype(np.int)
-    reginparc = np.unique(resamplabsmasked)[1:].astype(np.int)
-    reglabs = list(reginparc.astype(np.str))
+    reginparc = np.unique(resamplabsmasked)[1:].astype(int)
 
-    reginorigparc = np.unique(labelimg.get_fdata())[1:].astype(np.int)
-    if len(reginparc) != len(reginorigparc):
-        print('\n !!!WARNING!!! during resampling of label image, some of the'
-              ' ROIs (likely very small) were interpolated out. Please take '
-              'care to note which ROIs are present in the output data\n')
-        print('ALTERNATIVELY, your parcellation is not in the same space'
-              'as the bold data.\n')
-        if abs(len(reginparc) - len(reginorigparc)) > 9:
-            print('\nBASED ON QUICK HEURISTIC...I think your parcellation '
-                  'is not in the right space. Please check that the two '
-                  'images are aligned properly.')
+    reginorigparc = np.unique(labelimg.get_fdata())[1:].astype(int)
+    check_regions(reginparc, len(reginorigparc))
 
     # Extract time series
-    time_series = masker.fit_transform(rsimg)
+    with stage('load, resample, average regions (masker)'):
+        time_series = masker.fit_transform(rsimg)
+        if single:
+            time_series = time_series.astype(np.float32, copy=False)
+        note_array('time_series', time_series)
 
     if nomat:
-        connmat = None
-        conndf = None
+        connmats = None
     else:
-        connobj = connectome.ConnectivityMeasure(kind=conntype)
-        connmat = connobj.fit_transform([time_series])[0]
-        conndf = get_con_df(connmat, reglabs)
+        with stage('connectivity'):
+            connmats = get_conn(time_series if censor is None else time_series[censor],
+                                conntype, estimator)
 
 
     # if not saving time series, don't pass anything substantial, save mem
     if not savets:
         time_series = 42
 
-    return conndf, connmat, time_series, reginparc
+    return connmats, time_series, reginparc
 
 
-def main():
+def keep_label_operators(nkeep):
+    """
+    keep the last nkeep label operators made (or read from a cache) in
+    memory, so that later subjects of this process in the same template
+    space get them straight away (worker.py). 0 turns it off
+    """
+    global _keeplabelops
 
-    parser = argparse.ArgumentParser(description='fmri -> adjacency matrix')
-    parser.add_argument('fmri', type=str, help='input fmri to be denoised')
-    parser.add_argument('mask', type=str, help='input mask in same space as fmri')
+    _keeplabelops = nkeep
+    while len(_labelops) > nkeep:
+        _labelops.popitem(last=False)
+
+
+def get_label_operator(labelimg, maskimg, cachedir=None, cachesize=None):
+    """
+    for the 'data' space: resample the labels to the mask (i.e. fmri) grid
+    and make a sparse regions x maskvoxels matrix that averages the masked
+    voxels of each region. the voxel order is that of apply_mask, so
+    operator.dot(voxel x time) gives the region x time average signals
+
+    if cachedir is given, the resampled labels, surviving regions, voxel
+    counts and operator are kept there, keyed by the geometry and content
+    of both images, so that runs in the same template space skip all of this
+    (and with keep_label_operators, the last few are also kept in memory)
+
+    returns the operator and the regions that survived the masking
+    """
+    key = None
+    if cachedir is not None or _keeplabelops:
+        key = hash_parts('labelop', 1, hash_img(labelimg), hash_img(maskimg))
+    if key in _labelops:
+        print("using label operator {} from memory".format(key))
+        _labelops.move_to_end(key)
+        operator, reginparc, nreginorig = _labelops[key]
+        check_regions(reginparc, nreginorig)
+        return operator, reginparc
+    if cachedir is not None:
+        cached = cache_get(cachedir, key)
+        if cached is not None:
+            print("using cached label operator {}".format(key))
+            check_regions(cached['reginparc'], int(cached['nreginorig']))
+            operator = sparse.csr_matrix((cached['opdata'],
+                                          cached['opindices'],
+                                          cached['opindptr']),
+                                         shape=tuple(cached['opshape']))
+            remember_label_operator(key, operator, cached['reginparc'],
+                                    int(cached['nreginorig']))
+            return operator, cached['reginparc']
+
+    from nilearn.image import resample_to_img
+    from nilearn.masking import apply_mask
+
+    # assume here that the mask is also fmri space
+    resamplabs = resample_to_img(labelimg,maskimg,interpolation='nearest')
+    resamplabsmasked = apply_mask(resamplabs,maskimg).astype(int)
+
+    # get the unique labels list, other than 0, which will be first
+    reginparc = np.unique(resamplabsmasked)[1:]
+    nreginorig = len(np.unique(np.asanyarray(labelimg.dataobj))) - 1
+    check_regions(reginparc, nreginorig)
+
+    # row of each labeled voxel, weighted by 1 / voxels in that region
+    voxinreg = np.flatnonzero(resamplabsmasked)
+    rows = np.searchsorted(reginparc, resamplabsmasked[voxinreg])
+    counts = np.bincount(rows, minlength=len(reginparc))
+    operator = sparse.csr_matrix((1.0 / counts[rows], (rows, voxinreg)),
+                                 shape=(len(reginparc), len(resamplabsmasked)))
+
+    if cachedir is not None:
+        cache_put(cachedir, key,
+                  {'resamplabsmasked': resamplabsmasked,
+                   'reginparc': reginparc,
+                   'nreginorig': np.array(nreginorig),
+                   'counts': counts,
+                   'opdata': operator.data,
+                   'opindices': operator.indices,
+                   'opindptr': operator.indptr,
+                   'opshape': np.array(operator.shape)},
+                  maxsize=cachesize)
+    remember_label_operator(key, operator, reginparc, nreginorig)
+
+    return operator, reginparc
+
+
+def remember_label_operator(key, operator, reginparc, nreginorig):
+    """
+    keep a label operator in memory, if keep_label_operators is on
+    """
+    if not _keeplabelops:
+        return
+    _labelops[key] = (operator, reginparc, nreginorig)
+    while len(_labelops) > _keeplabelops:
+        _labelops.popitem(last=False)
+
+
+def extract_mats(rsimg, maskimg, labelimgs, conntype='correlation',
+                 savets=False, nomat=False, dtr=False, stdz=False,
+                 opcache=None, opcachesize=None, precleanfunc=None,
+                 censor=None, dtype=np.float64, estimator='lw'):
+    """
+    extract_mat, space='data', for many parcs at once. the masked voxel x
+    time data is loaded once and the region signals of all the parcs come
+    out of one multiply with the stacked sparse label operators (instead of
+    one NiftiLabelsMasker pass over the 4D image per parc)
+
+    opcache/opcachesize: see get_label_operator
+
+    precleanfunc, if given, is applied to the raw (time x regions) signals of
+    each parc before the usual region cleaning, e.g. the confound regression
+    of the roi-first mode of pipeline.py
+
+    censor, dtype, estimator: see extract_mat
+
+    returns a list of (connmats, time_series, reginparc), one per parc
+    """
+    from nilearn.masking import apply_mask
+
+    with stage('resample labels (label operators)'):
+        ops = [get_label_operator(labimg, maskimg, opcache, opcachesize)
+               for labimg in labelimgs]
+
+    # time x voxels, once
+    with stage('load, mask'):
+        voxts = apply_mask(rsimg, maskimg, dtype=dtype)
+        note_array('voxts', voxts)
+
+    with stage('average regions'):
+        stackedop = sparse.vstack([op for op, _ in ops]).tocsr()
+        if np.dtype(dtype) == np.float32:
+            stackedop = stackedop.astype(np.float32)
+        allts = stackedop.dot(voxts.T).T
+        note_array('allts', allts)
+    del voxts
+
+    return mats_from_region_signals(allts, [reginparc for _, reginparc in ops],
+                                    conntype=conntype, savets=savets,
+                                    nomat=nomat, dtr=dtr, stdz=stdz,
+                                    precleanfunc=precleanfunc, censor=censor,
+                                    dtype=dtype, estimator=estimator)
+
+
+def extract_mats_cifti(rsimg, labelimgs, conntype='correlation', savets=False,
+                       nomat=False, dtr=False, stdz=False, censor=None,
+                       dtype=np.float64, estimator='lw'):
+    """
+    extract_mats for a cifti dtseries (image) and dlabel parcs (see
+    cifti.py): the region signals of all the parcs from one multiply of the
+    time x grayordinates data with the stacked label operators
+
+    returns a list of (connmats, time_series, reginparc), one per parc
+    """
+    brainmodel = rsimg.header.get_axis(1)
+    with stage('label operators'):
+        ops = []
+        for labimg in labelimgs:
+            operator, reginparc, nreginorig = dlabel_operator(labimg, brainmodel)
+            check_regions(reginparc, nreginorig)
+            ops.append((operator, reginparc))
+
+    with stage('load'):
+        data = np.asanyarray(rsimg.dataobj)
+        note_array('data', data)
+
+    with stage('average regions'):
+        stackedop = sparse.vstack([op for op, _ in ops]).tocsr()
+        if np.dtype(dtype) == np.float32:
+            stackedop = stackedop.astype(np.float32)
+        allts = stackedop.dot(np.asarray(data, dtype=dtype).T).T
+        note_array('allts', allts)
+
+    return mats_from_region_signals(allts, [reginparc for _, reginparc in ops],
+                                    conntype=conntype, savets=savets,
+                                    nomat=nomat, dtr=dtr, stdz=stdz,
+                                    censor=censor, dtype=dtype,
+                                    estimator=estimator)
+
+
+def mats_from_region_signals(allts, regions, conntype='correlation',
+                             savets=False, nomat=False, dtr=False, stdz=False,
+                             precleanfunc=None, censor=None, dtype=np.float64,
+                             estimator='lw'):
+    """
+    the second half of extract_mats: split the raw region signals of the
+    stacked parcs (time x all regions) by parc, clean them, and make the
+    matrices. regions is the list of reginparc of each parc. dtype,
+    estimator: see extract_mat
+
+    returns a list of (connmats, time_series, reginparc), one per parc
+    """
+    out = []
+    start = 0
+    for reginparc in regions:
+        stop = start + len(reginparc)
+        time_series = allts[:, start:stop]
+        with stage('clean region signals'):
+            if precleanfunc is not None:
+                time_series = precleanfunc(time_series)
+            # same cleaning as NiftiLabelsMasker does on the region signals
+            time_series = signal.clean(time_series, detrend=dtr,
+                                       standardize=stdz)
+            if np.dtype(dtype) == np.float32:
+                time_series = time_series.astype(np.float32, copy=False)
+            note_array('time_series', time_series)
+        start = stop
+
+        if nomat:
+            connmats = None
+        else:
+            with stage('connectivity'):
+                connmats = get_conn(time_series if censor is None else time_series[censor],
+                                    conntype, estimator)
+
+        # if not saving time series, don't pass anything substantial, save mem
+        if not savets:
+            time_series = 42
+
+        out.append((connmats, time_series, reginparc))
+
+    return out
+
+
+def add_makemat_args(parser):
+    """
+    adds the matrix making options (everything but the input images and -out)
+    to an argparse parser, so that other entry points can share them
+    """
     parser.add_argument('-space', type=str, help='space that the connectivity is computed in',
                         choices=['labels', 'data'], default='labels')
-    parser.add_argument('-type', type=str, help='type of connectivity',
-                        choices=['correlation', 'partial correlation', 'covariance'],
-                        default='correlation')
+    parser.add_argument('-type', type=str, help='type(s) of connectivity, all from one pass '
+                        'over the time series', choices=KINDS, nargs='+', default=['correlation'])
+    parser.add_argument('-covestimator', type=str, help='covariance estimator: lw (ledoit-wolf, as '
+                        'nilearn), oas, or empirical (none)', choices=ESTIMATORS, default='lw')
     parser.add_argument('-detrend', help='bool (default true), detrending timeseries for each region',
                         default=True, type=bool)
     parser.add_argument('-standarize', help='bool (default true), standardize of signals',
                         default=True, type=bool)   
-    parser.add_argument('-out', type=str, help='output base name',
-                        default='output')
     parser.add_argument('-savetimeseries', help='also save average time series from each roi in parcellation',
                         action="store_true")
+    parser.add_argument('-savetsv', help='with -savetimeseries, also write the bids-style tsv.gz + json '
+                        '(or later, with tsstore.py export)', action="store_true")
     parser.add_argument('-nomatrix', help='if you dont want to compute matix (because you just want time series)',
                         action="store_true")
+    parser.add_argument('-matformat', type=str, help='matrix file format(s): csv (full matrix, 3 '
+                        'digits), npy or hdf5 (float32 upper triangle + region ids, see connio.py)',
+                        choices=['csv', 'npy', 'hdf5'], nargs='+', default=['csv'])
+    parser.add_argument('-censorfile', type=str, help='_censor.csv from regress.py -censor, censored '
+                        'frames are dropped before making the matrices', default=None)
+    parser.add_argument('-opcache', type=str, help='directory to cache resampled label operators in, '
+                        'for reuse across runs in the same space (-space data only)', default=None)
+    parser.add_argument('-opcachesize', type=float, help='size limit (MB) of -opcache, least recently '
+                        'used entries are removed past it', default=1024)
+    parser.add_argument('-dynwindow', type=int, help='also make sliding-window (dynamic) '
+                        'correlations, windows of this many frames (see dynconn.py)', default=None)
+    parser.add_argument('-dynstep', type=int, help='frames between the -dynwindow windows',
+                        default=1)
+    parser.add_argument('-dyntaper', type=str, help='taper of the -dynwindow windows',
+                        choices=TAPERS, default='none')
+    parser.add_argument('-dynresync', type=int, help='recompute the running window sums from '
+                        'scratch every this many windows', default=500)
+    parser.add_argument('-edgets', help='also write the edge time series (and per frame rss, '
+                        'see edgets.py)', action="store_true")
+    parser.add_argument('-edgetspct', type=float, help='percent of frames (by rss) for the -edgets '
+                        'top / bottom matrices', default=5.)
     parser.add_argument('-parcs', help='parcs to be used for makin\' matrices. make last arg',
                         nargs='+', required=True)
 
-    # parse
-    args = parser.parse_args()
 
-    # print the args
-    print("\nARGS: ")
-    for arg in vars(args):
-        print("{} {}".format(str(arg), str(getattr(args, arg))))
-    print("END ARGS\n")
+def save_parc_outputs(args, parc, connmats, timeseries, regions, censor=None):
+    """
+    write the matrices (and time series, sliding-window matrices and edge
+    time series, if requested) made from one parc. censor: see extract_mat
+    """
+    # format name
+    baseoutname = (os.path.basename(parc)).rsplit('.nii', 1)[0]
+    if baseoutname.endswith('.dlabel'):
+        baseoutname = baseoutname[:-len('.dlabel')]
+
+    for conntype, connmat in (connmats or {}).items():
+        # write
+        matoutname = ''.join([args.out, '_', baseoutname, '_', ''.join(conntype.split())])
+        with stage('write matrix'):
+            note_array(conntype, connmat)
+            if 'csv' in args.matformat:
+                conndf = get_con_df(connmat, [str(r) for r in regions])
+                conndf.to_csv(''.join([matoutname, '_connMatdf.csv']), float_format='%.3g')
+            for fmt in ['npy', 'hdf5']:
+                if fmt in args.matformat:
+                    save_conn(matoutname, connmat, regions, conntype, fmt=fmt)
+
+    # # format name
+    # with open(''.join([args.out, '_', baseoutname, '_connMat.csv']), "w") as f:
+    #     writer = csv.writer(f)
+    #     writer.writerows(connmat)
+
+    # also write out time series if requested
+    if args.savetimeseries:
+        tsoutname = ''.join([args.out, '_', baseoutname, '_timeseries.hdf5'])
+        with stage('write time series'):
+            save_timeseries(tsoutname, timeseries, regions)
+            if args.savetsv:
+                # from the store, so the same as a later tsstore.py export
+                export_tsv(tsoutname)
+
+    if args.dynwindow is not None:
+        dynoutname = ''.join([args.out, '_', baseoutname, '_dynconn.hdf5'])
+        with stage('sliding-window connectivity'):
+            nwin = sliding_window_conn(timeseries if censor is None else timeseries[censor],
+                                       dynoutname, args.dynwindow, step=args.dynstep,
+                                       taper=args.dyntaper, regions=regions,
+                                       resync=args.dynresync)
+        print("wrote {} windows to {}".format(nwin, dynoutname))
+
+    if args.edgets:
+        edgeoutname = ''.join([args.out, '_', baseoutname, '_edgets.hdf5'])
+        with stage('edge time series'):
+            rss = edge_time_series(timeseries, edgeoutname, regions=regions, censor=censor,
+                                   pct=args.edgetspct)
+        print("wrote {} frames of edge time series to {}".format(len(rss), edgeoutname))
+
+
+def needs_timeseries(args):
+    """
+    whether the outputs asked for in args need the region time series
+    """
+    return args.savetimeseries or args.dynwindow is not None or args.edgets
 
-    # read in the data
-    inputimg = nib.load(args.fmri)
-    inputmask = nib.load(args.mask)
 
-    # if args.savetimeseries:
-    #    # initialize an hd5 group
-    #    h5file = h5py.File(''.join([args.out, '_timeseries.hdf5']), "w")
-    #    h5filegroup = h5file.create_group('timeseries')
+def read_censor(fname):
+    """
+    boolean frames to keep, from a _censor.csv of regress.py
+    """
+    return pd.read_csv(fname)['keep'].values.astype(bool)
+
+
+def extract_from_args(args, inputimg, inputmask, parcs, precleanfunc=None,
+                      censor=None, savets=False, nomat=False):
+    """
+    the matrix making options in parsed args, for the given parcs: yields
+    (parc, (connmats, time_series, reginparc)) one parc at a time.
+    precleanfunc: see extract_mats (-space data only). censor: see
+    extract_mat. a cifti inputimg (with dlabel parcs) goes to
+    extract_mats_cifti
+    """
+    if is_cifti(inputimg):
+        print("\nmaking conn matricies for {} (cifti)".format(str(parcs)))
+        if precleanfunc is not None:
+            print("roi-first cleaning does not go with cifti. exiting")
+            exit(1)
+
+        outs = extract_mats_cifti(inputimg, [nib.load(parc) for parc in parcs],
+                                  conntype=args.type,
+                                  savets=savets,
+                                  nomat=nomat,
+                                  dtr=args.detrend,
+                                  stdz=args.standarize,
+                                  censor=censor,
+                                  dtype=args.dtype,
+                                  estimator=args.covestimator)
+
+        for parc, out in zip(parcs, outs):
+            yield parc, out
+
+        return
+
+    if args.space == 'data':
+        # all parcs from one pass over the data
+        print("\nmaking conn matricies for {}".format(str(parcs)))
+
+        labimgs = [nib.load(parc) for parc in parcs]
+        outs = extract_mats(inputimg, inputmask, labimgs,
+                            conntype=args.type,
+                            savets=savets,
+                            nomat=nomat,
+                            dtr=args.detrend,
+                            stdz=args.standarize,
+                            opcache=args.opcache,
+                            opcachesize=args.opcachesize * 1024 * 1024,
+                            precleanfunc=precleanfunc,
+                            censor=censor,
+                            dtype=args.dtype,
+                            estimator=args.covestimator)
+
+        for parc, out in zip(parcs, outs):
+            yield parc, out
+
+        return
 
     # loop over labels provided
-    for parc in args.parcs:
+    for parc in parcs:
 
         print("\nmaking conn matricies for {}".format(str(parc)))
 
         labimg = nib.load(parc)
                 
-        conndf, connmat, timeseries, regions = extract_mat(inputimg, inputmask, labimg,
-                                                      conntype=args.type, 
-                                                      space=args.space,
-                                                      savets=args.savetimeseries,
-                                                      nomat=args.nomatrix,
-                                                      dtr=args.detrend,
-                                                      stdz=args.standarize)
-
-        # format name
-        baseoutname = (os.path.basename(parc)).rsplit('.nii', 1)[0]
-
-        if conndf is not None:
-            # write
-            conndf.to_csv(''.join([args.out, '_', baseoutname, '_', ''.join(args.type.split()), '_connMatdf.csv']), float_format='%.3g')
-
-        # # format name
-        # with open(''.join([args.out, '_', baseoutname, '_connMat.csv']), "w") as f:
-        #     writer = csv.writer(f)
-        #     writer.writerows(connmat)
-
-        # also write out time series if requested
-        if args.savetimeseries:
-
-            # this method closes file: https://stackoverflow.com/questions/29863342/close-an-open-h5py-data-file
-            with h5py.File(''.join([args.out, '_', baseoutname, '_timeseries.hdf5']), "w")as h5f:
-                h5f.create_dataset('timeseries',
-                                    data=timeseries,
-                                    compression="gzip")
-                h5f.create_dataset('regionids',
-                                    data=np.array(regions))
-                
-            # make full size matrix
-            nogaptimeseries = np.zeros([ timeseries.shape[0], np.max(regions) ])
-            nogaptimeseries[:,([x-1 for x in regions])] = timeseries 
-            # make list of missing regions
-            presentregs = np.zeros(np.max(regions),dtype=int)
-            presentregs[([x-1 for x in regions])] = 1
-                
-            # new timeseries datatype
-            tsdf = pd.DataFrame(nogaptimeseries, columns=[(''.join(['ROI_{}'.format(n)])) 
-                                                for n in range(1,np.max(regions)+1) ],
-                                )
-            outtsdf = ''.join([args.out, '_', baseoutname, '_timeseries.tsv.gz'])
-            tsdf.to_csv(outtsdf,sep='\t', index=False,compression='gzip')                              
-
-            # and the json
-            outtsjson = ''.join([args.out, '_', baseoutname, '_timeseries.json'])
-            tsjson = [] 
-            for n in range(1,np.max(regions)+1):
-                tsjson.append({'column_name': ''.join(['ROI_{}'.format(n)]), 
-                               'label_index': str(n),
-                               'in_parc': int(presentregs[n-1]),
-                               })
-                
-            with open(outtsjson,'w') as writejson:
-                json.dump(tsjson, writejson)
+        yield parc, extract_mat(inputimg, inputmask, labimg,
+                                conntype=args.type, 
+                                space=args.space,
+                                savets=savets,
+                                nomat=nomat,
+                                dtr=args.detrend,
+                                stdz=args.standarize,
+                                censor=censor,
+                                dtype=args.dtype,
+                                estimator=args.covestimator)
+
+
+def makemat_from_args(args, inputimg, inputmask, precleanfunc=None,
+                      censor=None):
+    """
+    loop over the parcs in parsed args, making and writing the outputs for
+    each. inputimg can be an image already in memory (i.e. straight out of
+    regress.nuisance_regress), so no need to go through the disk.
+    precleanfunc: see extract_mats (-space data only). censor (frames to
+    keep, see extract_mat) is read from args.censorfile if not given
+    """
+    if censor is None and args.censorfile is not None:
+        censor = read_censor(args.censorfile)
+
+    # if args.savetimeseries:
+    #    # initialize an hd5 group
+    #    h5file = h5py.File(''.join([args.out, '_timeseries.hdf5']), "w")
+    #    h5filegroup = h5file.create_group('timeseries')
+
+    for parc, (connmats, timeseries, regions) in extract_from_args(
+            args, inputimg, inputmask, args.parcs, precleanfunc=precleanfunc,
+            censor=censor, savets=needs_timeseries(args), nomat=args.nomatrix):
+        save_parc_outputs(args, parc, connmats, timeseries, regions, censor)
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(description='fmri -> adjacency matrix')
+    parser.add_argument('fmri', type=str, help='input fmri to be denoised (nifti, or cifti '
+                        '.dtseries.nii with .dlabel.nii parcs, see cifti.py)')
+    parser.add_argument('mask', type=str, help='input mask in same space as fmri (not for cifti)',
+                        nargs='?', default=None)
+    parser.add_argument('-out', type=str, help='output base name',
+                        default='output')
+    parser.add_argument('-dtype', type=str, help='precision of the data; float32 halves the memory',
+                        choices=['float64', 'float32'], default='float64')
+    parser.add_argument('-profile', type=str, help='write a json report of the time, cpu, memory '
+                        'and i/o of each stage here (see profiling.py)', default=None)
+    add_makemat_args(parser)
+
+    return parser
+
+
+def run_makemat(args):
+    """
+    load the inputs named in parsed get_parser args and make the outputs
+    """
+    with report(args.profile):
+        # read in the data
+        inputimg = nib.load(args.fmri)
+        if args.mask is not None:
+            inputmask = nib.load(args.mask)
+        elif is_cifti(inputimg):
+            inputmask = None
+        else:
+            print("need a mask for a nifti fmri. exiting")
+            exit(1)
+
+        makemat_from_args(args, inputimg, inputmask)
+
+
+def main():
+
+    # parse
+    args = get_parser().parse_args()
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("END ARGS\n")
+
+    run_makemat(args)
 
 
 if __name__ == '__main__':
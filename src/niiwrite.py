@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+writing the cleaned image (regress.py / pipeline.py -outformat, -outdtype,
+-writethreads), faster than nib.save to .nii.gz, which gzips a float64 4D
+image in one thread
+
+    nii.gz    gzip, with -writethreads > 1 the volumes are compressed in
+              blocks in parallel, each block its own gzip member. a file of
+              several members is still one valid gzip stream (gunzip,
+              nibabel, fsl, afni read it as usual)
+    nii       no compression, can be memory mapped (nib.load(mmap=True))
+    none      not written, for when only the matrices are needed
+
+the data can go out as float64, float32 or int16 (scaled by the header's
+scl_slope / scl_inter to the range of the data), converted a block of
+volumes at a time so that no second copy of the whole image is made
+
+@author: jfaskowi
+
+"""
+
+import io
+import gzip
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+OUTFORMATS = ['nii.gz', 'nii', 'none']
+OUTDTYPES = ['float64', 'float32', 'int16']
+
+
+def int16_scaling(data):
+    """
+    the slope and intercept that map the range of data onto int16
+    """
+    mn = float(np.nanmin(data))
+    mx = float(np.nanmax(data))
+    inter = (mx + mn) / 2.
+    slope = (mx - mn) / (2. * np.iinfo(np.int16).max)
+    if slope == 0:
+        slope = 1.
+
+    return slope, inter
+
+
+def header_bytes(hdr):
+    """
+    the header (and extensions) of a single file nifti, padded to its data
+    offset, which is set in hdr
+    """
+    buf = io.BytesIO()
+    hdr.write_to(buf)
+    offset = int(np.ceil(buf.tell() / 16.) * 16)
+    hdr.set_data_offset(offset)
+
+    buf = io.BytesIO()
+    hdr.write_to(buf)
+    buf.write(b'\x00' * (offset - buf.tell()))
+
+    return buf.getvalue()
+
+
+def block_volumes(img, dtype, blockmem=16):
+    """
+    volumes per block, so a block of output is about blockmem MB
+    """
+    volbytes = np.prod(img.shape[:3]) * np.dtype(dtype).itemsize
+
+    return int(max(1, blockmem * 1024 * 1024 // volbytes))
+
+
+def write_nifti(img, outname, outformat='nii.gz', outdtype=None, nthreads=1,
+                compresslevel=1):
+    """
+    write a 4D image to outname (its extension is set from outformat, see the
+    top of this file). outdtype: float64, float32, int16, default that of the
+    header (as nib.save). nthreads: gzip blocks of volumes in parallel (nii.gz only)
+
+    returns the name written, None for outformat none
+    """
+    if outformat == 'none':
+        return None
+    for ext in ['.nii.gz', '.nii']:
+        if outname.endswith(ext):
+            outname = outname[:-len(ext)]
+            break
+    outname = '.'.join([outname, outformat])
+
+    data = np.asanyarray(img.dataobj)
+    if outdtype is None:
+        outdtype = img.get_data_dtype().name
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(outdtype)
+    if outdtype == 'int16':
+        slope, inter = int16_scaling(data)
+    else:
+        slope, inter = np.nan, np.nan
+    hdr.set_slope_inter(slope, inter)
+    outtype = np.dtype(outdtype).newbyteorder(hdr.endianness)
+
+    def encode(v0, v1):
+        block = data[..., v0:v1]
+        if outdtype == 'int16':
+            block = np.round((np.nan_to_num(block) - inter) / slope)
+        out = np.asarray(block, dtype=outtype).tobytes(order='F')
+        if outformat == 'nii.gz' and nthreads > 1:
+            out = gzip.compress(out, compresslevel)
+        return out
+
+    nvol = data.shape[3] if data.ndim > 3 else 1
+    step = block_volumes(img, outtype)
+    blocks = [(v0, min(nvol, v0 + step)) for v0 in range(0, nvol, step)]
+    if data.ndim < 4:
+        blocks = [(0, None)]
+
+    if outformat == 'nii.gz' and nthreads == 1:
+        fobj = gzip.open(outname, 'wb', compresslevel=compresslevel)
+    else:
+        fobj = open(outname, 'wb')
+
+    with fobj:
+        head = header_bytes(hdr)
+        if outformat == 'nii.gz' and nthreads > 1:
+            head = gzip.compress(head, compresslevel)
+        fobj.write(head)
+
+        if nthreads == 1:
+            for v0, v1 in blocks:
+                fobj.write(encode(v0, v1))
+        else:
+            # blocks compressed in parallel (zlib lets go of the gil),
+            # written in order, a few in flight at once
+            with ThreadPoolExecutor(nthreads) as pool:
+                inflight = collections.deque()
+                for v0, v1 in blocks:
+                    inflight.append(pool.submit(encode, v0, v1))
+                    if len(inflight) >= 2 * nthreads:
+                        fobj.write(inflight.popleft().result())
+                while inflight:
+                    fobj.write(inflight.popleft().result())
+
+    return outname
+
+
+def add_write_args(parser):
+    """
+    adds the cleaned image writing options to an argparse parser
+    """
+    parser.add_argument('-outformat', type=str, help='format of the cleaned image: nii.gz, nii '
+                        '(uncompressed, memory mappable) or none (not written). -chunked always '
+                        'writes nii', choices=OUTFORMATS, default='nii.gz')
+    parser.add_argument('-outdtype', type=str, help='data type of the cleaned image, int16 is '
+                        'scaled to the range of the data (default: that of the image header)',
+                        choices=OUTDTYPES, default=None)
+    parser.add_argument('-writethreads', type=int, help='threads to gzip the cleaned image with',
+                        default=1)
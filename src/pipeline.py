@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+regress.py -> makemat.py in one process
+
+the cleaned image from nuisance_regress is handed straight to the matrix
+making, instead of being gzipped to disk and read back by a second python
+call. writing the cleaned image is optional and happens in the background
+
+with -strategies, the matrices of several confound strategies come out of
+one load of the image instead (see fanout_from_args)
+
+with -stagecache, the confounds, cleaned data, region time series and
+matrices are cached by the content of their inputs, and a re-run only
+remakes what changed (see stagecache.py and staged_from_args)
+
+@author: jfaskowi
+
+"""
+
+import argparse
+import numpy as np
+
+from lazyimport import lazy_import
+from regress import NUSCHOICES, add_regress_args, regress_from_args, \
+    roi_clean_from_args, censor_from_args, save_nuisance_img, \
+    save_outlier_stats, save_censor, read_confounds, get_clean_setup, get_filter_setup, \
+    get_temporal_operator, get_lowrank_update, fanout_temporal_blocks
+from makemat import add_makemat_args, makemat_from_args, get_label_operator, \
+    mats_from_region_signals, save_parc_outputs, needs_timeseries, \
+    extract_from_args, get_conn
+from profiling import stage, report
+from cifti import is_cifti
+from niiwrite import add_write_args
+from stagecache import hash_file, stage_key, df_to_arrays, arrays_to_df, \
+    get_stage, put_stage
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+sparse = lazy_import('scipy.sparse')
+nilearn = lazy_import('nilearn')
+input_data = lazy_import('nilearn.input_data')
+masking = lazy_import('nilearn.masking')
+
+
+def fanout_region_signals(args):
+    """
+    the raw region signals (time x regions of all the parcs) of every
+    confound strategy in args.strategies, from one load of the image. the
+    image is masked and smoothed once and the confounds tsv is read once.
+    the cleaning of each strategy is the plain filter (done once per block
+    of voxels) plus a low rank part for its confounds (see
+    regress.fanout_temporal_blocks), and the cleaned blocks go straight into
+    the region sums of all the parcs, so no cleaned image is made
+
+    returns the get_clean_setup outputs and the region signals, per
+    strategy, the regions of each parc, and the frames kept by -censor
+    (lined up with the signals, None if not censoring)
+    """
+    inputimg = nib.load(args.fmri)
+    inputmask = nib.load(args.mask)
+    nvol = inputimg.shape[3]
+
+    # the confounds tsv, parsed once for all strategies
+    confdf = read_confounds(args.confounds)
+
+    setups = []
+    for strategy in args.strategies:
+        print("\nsetting up confounds for {}".format(strategy))
+        setups.append(get_clean_setup(inputimg, confdf, inputtr=args.tr,
+                                      conftype=strategy,
+                                      spikethr=args.spikethr,
+                                      highpassval=args.highpass,
+                                      lowpassval=args.lowpass,
+                                      confoundsjson=args.confjson,
+                                      addregressors=args.add_regressors,
+                                      addlinear=args.add_linear,
+                                      initdum=args.initaldummy,
+                                      censor=args.censor,
+                                      censormincontig=args.censormincontig))
+
+    # tr, filter and censored frames are the same for every strategy
+    _, _, tr, highpassval, lowpassval, keep = setups[0]
+
+    # the filter alone, then each strategy as a low rank difference from it
+    baseops = get_temporal_operator(nvol, None, tr, highpassval, lowpassval,
+                                    addafterdetr=args.add_detrend_after,
+                                    keep=keep)
+    updates = []
+    for strategy, (confounds, _, _, _, _, _) in zip(args.strategies, setups):
+        op, detrop = get_temporal_operator(nvol, confounds, tr, highpassval,
+                                           lowpassval,
+                                           addafterdetr=args.add_detrend_after,
+                                           keep=keep)
+        opupd = get_lowrank_update(op, baseops[0])
+        detropupd = get_lowrank_update(detrop, baseops[1])
+        print("{}: rank {} update of the filter".format(strategy, opupd[0].shape[1]))
+        updates.append((opupd, detropupd))
+
+    # mask + smooth, once
+    single = args.dtype == 'float32'
+    masker = input_data.NiftiMasker(mask_img=inputmask, detrend=False,
+                                    standardize=False,
+                                    smoothing_fwhm=args.fwhm,
+                                    dtype=args.dtype if single else None,
+                                    verbose=1)
+    voxts = masker.fit_transform(inputimg)
+
+    ops = [get_label_operator(nib.load(parc), inputmask, args.opcache,
+                              args.opcachesize * 1024 * 1024)
+           for parc in args.parcs]
+    # csc, for slicing blocks of voxels
+    stackedop = sparse.vstack([op for op, _ in ops]).tocsc()
+
+    allts = [np.zeros((nvol - args.discardvols, stackedop.shape[0]), dtype=args.dtype)
+             for _ in args.strategies]
+    for v0, v1, cleanedblocks in fanout_temporal_blocks(baseops, updates, voxts,
+                                                        discardvols=args.discardvols,
+                                                        keep=keep):
+        blockop = stackedop[:, v0:v1]
+        for n, cleaned in enumerate(cleanedblocks):
+            allts[n] += blockop.dot(cleaned.T).T
+    del voxts
+
+    censor = None if keep is None else keep[args.discardvols:]
+
+    return setups, allts, [reginparc for _, reginparc in ops], censor
+
+
+def fanout_from_args(args):
+    """
+    -strategies: the matrices of every listed confound strategy, from one
+    load of the image (see fanout_region_signals). the outputs of each
+    strategy get _<strategy> added to -out (and -regressout)
+    """
+    setups, allts, regions, censor = fanout_region_signals(args)
+    if censor is not None:
+        save_censor(censor, args.regressout)
+
+    for n, strategy in enumerate(args.strategies):
+        print("\nmaking conn matricies for {}".format(strategy))
+        confounds, outlier_stats, _, _, _, _ = setups[n]
+
+        # same args, outputs named for the strategy
+        stratargs = argparse.Namespace(**vars(args))
+        stratargs.out = '_'.join([args.out, strategy])
+        save_outlier_stats(confounds, outlier_stats,
+                           '_'.join([args.regressout, strategy]))
+
+        outs = mats_from_region_signals(allts[n], regions,
+                                        conntype=args.type,
+                                        savets=needs_timeseries(args),
+                                        nomat=args.nomatrix,
+                                        dtr=args.detrend,
+                                        stdz=args.standarize,
+                                        censor=censor,
+                                        dtype=args.dtype,
+                                        estimator=args.covestimator)
+        for parc, (connmats, timeseries, reginparc) in zip(args.parcs, outs):
+            save_parc_outputs(stratargs, parc, connmats, timeseries, reginparc, censor)
+
+
+def staged_confounds(args, cachesize):
+    """
+    the confounds stage of staged_from_args: confounds, outlier stats and
+    censored frames (as get_clean_setup), from the cache if there, in which
+    case only the filter values and the tr are made (get_filter_setup)
+
+    returns the key and the get_clean_setup outputs (confounds,
+    outlier_stats, tr, highpassval, lowpassval, keep)
+    """
+    cachedir = args.stagecache
+    inputimg = nib.load(args.fmri)
+    key = stage_key('confounds',
+                    hash_file(args.confounds, cachedir),
+                    hash_file(args.confjson, cachedir),
+                    hash_file(args.add_regressors, cachedir),
+                    args.strategy, args.spikethr, args.highpass, args.lowpass,
+                    args.add_linear, args.initaldummy, args.censor,
+                    args.censormincontig, args.tr,
+                    # the tr comes from the header if not given
+                    inputimg.header.get_zooms(), inputimg.shape)
+
+    cached = get_stage(cachedir, key)
+    if cached is not None:
+        keep = cached['keep'] if args.censor else None
+        tr, highpassval, lowpassval, _ = get_filter_setup(inputimg, args.tr, args.highpass,
+                                                          args.lowpass)
+        return key, (arrays_to_df(cached, 'conf'), arrays_to_df(cached, 'outl'), tr,
+                     highpassval, lowpassval, keep)
+
+    setup = get_clean_setup(inputimg, args.confounds,
+                        inputtr=args.tr,
+                        conftype=args.strategy,
+                        spikethr=args.spikethr,
+                        highpassval=args.highpass,
+                        lowpassval=args.lowpass,
+                        confoundsjson=args.confjson,
+                        addregressors=args.add_regressors,
+                        addlinear=args.add_linear,
+                        initdum=args.initaldummy,
+                        censor=args.censor,
+                        censormincontig=args.censormincontig)
+    confounds, outlier_stats, _, _, _, keep = setup
+
+    arrays = df_to_arrays(confounds, 'conf')
+    arrays.update(df_to_arrays(outlier_stats, 'outl'))
+    arrays['keep'] = np.zeros(0, dtype=bool) if keep is None else keep
+    put_stage(cachedir, key, arrays, cachesize)
+
+    return key, setup
+
+
+def cleaned_header(nrimg, inputimg):
+    """
+    the header of the cleaned image nrimg with the tr (and time units) of the
+    fmri inputimg, which nilearn's unmask leaves at 1 (the header is that of
+    the mask). kept with the cleaned stage, so a cached run writes the same
+    header as the run that made it
+    """
+    header = nrimg.header.copy()
+    header.set_zooms(header.get_zooms()[:3] + inputimg.header.get_zooms()[3:4])
+    header.set_xyzt_units(*inputimg.header.get_xyzt_units())
+
+    return header
+
+
+def staged_from_args(args):
+    """
+    -stagecache: the default pipeline (regress -> makemat), with each stage
+    cached under a key of its inputs and parameters (see stagecache.py).
+    only the stages whose key is not in the cache are done, and the cleaned
+    data is made (or read from the cache) only if some parc needs it
+    """
+    cachedir = args.stagecache
+    cachesize = args.stagecachesize * 1024 * 1024
+    maskimg = nib.load(args.mask)
+
+    confkey, setup = staged_confounds(args, cachesize)
+    outldf, outdfstat, keep = setup[0], setup[1], setup[5]
+    save_outlier_stats(outldf, outdfstat, args.regressout)
+    if keep is not None:
+        # lined up with the cleaned image
+        keep = keep[args.discardvols:]
+        save_censor(keep, args.regressout)
+
+    cleankey = stage_key('cleaned', confkey,
+                         hash_file(args.fmri, cachedir),
+                         hash_file(args.mask, cachedir),
+                         args.fwhm, args.discardvols, args.add_detrend_after,
+                         args.fusedop, args.dtype, nilearn.__version__)
+    tskeys = [stage_key('timeseries', cleankey, hash_file(parc, cachedir),
+                        args.space, args.detrend, args.standarize, args.dtype)
+              for parc in args.parcs]
+
+    outs = {}
+    for parc, tskey in zip(args.parcs, tskeys):
+        cached = get_stage(cachedir, tskey)
+        if cached is not None:
+            outs[parc] = (cached['timeseries'], cached['regions'])
+
+    missing = [parc for parc in args.parcs if parc not in outs]
+    writer = None
+    if missing or args.savenuisance:
+        cached = get_stage(cachedir, cleankey)
+        if cached is not None:
+            header = nib.Nifti1Header(binaryblock=cached['header'].tobytes())
+            nrImg = masking.unmask(cached['cleaned'], maskimg)
+            nrImg = nib.Nifti1Image(np.asanyarray(nrImg.dataobj), nrImg.affine, header)
+        else:
+            nrImg, _, _ = regress_from_args(args, args.regressout, setup=setup)
+            header = cleaned_header(nrImg, nib.load(args.fmri))
+            nrImg = nib.Nifti1Image(np.asanyarray(nrImg.dataobj), nrImg.affine, header)
+            put_stage(cachedir, cleankey,
+                      {'cleaned': masking.apply_mask(nrImg, maskimg, dtype=args.dtype),
+                       'header': np.frombuffer(header.binaryblock, dtype=np.uint8)},
+                      cachesize)
+
+        if args.savenuisance:
+            writer = save_nuisance_img(nrImg, args.regressout, background=True,
+                                       outformat=args.outformat, outdtype=args.outdtype,
+                                       nthreads=args.writethreads)
+
+        if missing:
+            for parc, (_, timeseries, regions) in extract_from_args(
+                    args, nrImg, maskimg, missing, censor=keep, savets=True, nomat=True):
+                outs[parc] = (timeseries, regions)
+                put_stage(cachedir, tskeys[args.parcs.index(parc)],
+                          {'timeseries': timeseries, 'regions': regions}, cachesize)
+
+    for parc, tskey in zip(args.parcs, tskeys):
+        timeseries, regions = outs[parc]
+
+        connmats = None
+        if not args.nomatrix:
+            # a key per kind, so adding a -type makes only the new kind
+            matkeys = {kind: stage_key('matrices', tskey, kind, args.covestimator,
+                                       'nocensor' if keep is None else keep)
+                       for kind in args.type}
+            connmats = {}
+            for kind in args.type:
+                cached = get_stage(cachedir, matkeys[kind])
+                if cached is not None:
+                    connmats[kind] = cached['mat']
+            newkinds = [kind for kind in args.type if kind not in connmats]
+            if newkinds:
+                newmats = get_conn(timeseries if keep is None else timeseries[keep],
+                                   newkinds, args.covestimator)
+                for kind in newkinds:
+                    put_stage(cachedir, matkeys[kind], {'mat': newmats[kind]}, cachesize)
+                connmats.update(newmats)
+
+        save_parc_outputs(args, parc, connmats, timeseries, regions, keep)
+
+    if writer is not None:
+        writer.join()
+
+
+def add_stagecache_args(parser):
+
+    parser.add_argument('-stagecache', type=str, help='directory to cache the stages (confounds, '
+                        'cleaned data, time series, matrices) in, so a re-run only remakes the '
+                        'ones whose inputs changed', default=None)
+    parser.add_argument('-stagecachesize', type=float, help='size limit (MB) of -stagecache, least '
+                        'recently used entries are removed past it', default=10240)
+
+
+def add_fanout_args(parser):
+
+    parser.add_argument('-strategies', type=str, help='make the matrices for each of these confound '
+                        'strategies (instead of -strategy) from one load of the image (needs '
+                        '-space data, no cleaned image)', choices=NUSCHOICES, nargs='+', default=None)
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(description='nusiance regression -> adjacency matrix')
+    add_regress_args(parser)
+    add_makemat_args(parser)
+    parser.add_argument('-out', type=str, help='output base name for the matrices',
+                        default='output')
+    parser.add_argument('-regressout', type=str, help='output base name for the regression '
+                        'outputs (default: same as -out)', default=None)
+    parser.add_argument('-savenuisance', help='also write the cleaned image (in the background)',
+                        action="store_true")
+    add_write_args(parser)
+    parser.add_argument('-roifirst', help='clean the region signals instead of every voxel (needs '
+                        '-space data and -fwhm 0, no cleaned image). see verify.py roifirst',
+                        action="store_true")
+    add_fanout_args(parser)
+    add_stagecache_args(parser)
+    parser.add_argument('-profile', type=str, help='write a json report of the time, cpu, memory '
+                        'and i/o of each stage here (see profiling.py)', default=None)
+
+    return parser
+
+
+def pipeline_from_args(args):
+    """
+    run the pipeline for one set of parsed args (of get_parser), profiled if
+    args.profile
+    """
+    with report(args.profile):
+        run_pipeline(args)
+
+
+def run_pipeline(args):
+    """
+    the pipeline of pipeline_from_args
+    """
+    cifti = is_cifti(args.fmri)
+    if args.mask is None and not cifti:
+        print("need a -mask for making the matrices. exiting")
+        exit(1)
+
+    if args.regressout is None:
+        args.regressout = args.out
+
+    if cifti and (args.roifirst or args.strategies is not None
+                  or args.stagecache is not None):
+        print("a cifti fmri does not go with -roifirst, -strategies or -stagecache. exiting")
+        exit(1)
+
+    if args.compcor != 'file' and (args.roifirst or args.strategies is not None
+                                   or args.stagecache is not None):
+        # these make the confounds without the voxel data
+        print("-compcor {} does not go with -roifirst, -strategies or -stagecache. "
+              "exiting".format(args.compcor))
+        exit(1)
+
+    if args.stagecache is not None:
+        if args.roifirst or args.chunked or args.strategies is not None:
+            print("-stagecache does not go with -roifirst, -chunked or -strategies. exiting")
+            exit(1)
+
+        staged_from_args(args)
+        return
+
+    if args.strategies is not None:
+        if args.space != 'data' or args.roifirst or args.chunked:
+            print("-strategies needs -space data, and no -roifirst or -chunked. exiting")
+            exit(1)
+
+        fanout_from_args(args)
+        return
+
+    # frames kept by -censor, straight to the matrices
+    keep = censor_from_args(args)
+    if keep is not None:
+        save_censor(keep, args.regressout)
+
+    if args.roifirst:
+        if args.space != 'data':
+            print("roi-first cleaning needs -space data. exiting")
+            exit(1)
+
+        # get_confounds once, then clean the region signals of every parc
+        cleanfunc, outldf, outdfstat = roi_clean_from_args(args)
+        save_outlier_stats(outldf, outdfstat, args.regressout)
+        makemat_from_args(args, nib.load(args.fmri), nib.load(args.mask),
+                          precleanfunc=cleanfunc, censor=keep)
+        return
+
+    with stage('regress'):
+        nrImg, outldf, outdfstat = regress_from_args(args, args.regressout)
+    save_outlier_stats(outldf, outdfstat, args.regressout)
+
+    # (chunked regression streams the cleaned image to disk anyway)
+    writer = None
+    if args.savenuisance and not args.chunked:
+        writer = save_nuisance_img(nrImg, args.regressout, background=True,
+                                   outformat=args.outformat, outdtype=args.outdtype,
+                                   nthreads=args.writethreads)
+
+    with stage('makemat'):
+        makemat_from_args(args, nrImg, nib.load(args.mask) if args.mask else None,
+                          censor=keep)
+
+    if writer is not None:
+        with stage('wait for cleaned image write'):
+            writer.join()
+
+
+def main():
+
+    # parse
+    args = get_parser().parse_args()
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("END ARGS\n")
+
+    pipeline_from_args(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+checks of the inputs of a run from their headers only (nifti / cifti
+headers, the first line of the tsvs, the jsons), so that a bad subject is
+found in milliseconds instead of after its data has been loaded and
+resampled
+
+    preflight.py <pipeline.py args>
+    preflight.py -manifest manifest.tsv [-report preflight.tsv] [pipeline.py options]
+
+the second checks every subject of a batch.py manifest (batch.py -preflight
+does the same before scheduling anything). checked are
+
+    fmri        4D (or a cifti dtseries), its number of volumes
+    tr          -tr versus the header and the .brainlife.json next to the
+                fmri (meta.RepetitionTime, as run.sh), and the -lowpass
+                versus the nyquist frequency
+    mask        on the same grid (shape, affine) as the fmri
+    parcs       3D, overlapping the field of view of the fmri (or dlabels,
+                for a cifti fmri)
+    confounds   old or new column names, the columns the strategy needs, the
+                compcor columns (and -confjson) of the compcor strategies,
+                cosine columns for -highpass cosine, and a row per volume
+                (also for -add_regressors)
+
+problems are errors (the run would fail, or be wrong) or warnings (worth a
+look, e.g. a parc partly outside of the fmri)
+
+@author: jfaskowi
+
+"""
+
+import os
+import json
+import argparse
+import itertools
+import numpy as np
+
+from lazyimport import lazy_import
+from regress import confound_names, compcor_names
+from cifti import is_cifti
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+pd = lazy_import('pandas')
+
+COMPCORKINDS = ['aCompCor', '24aCompCor', '24aCompCorGsr']
+
+
+def read_tsv_header(fname):
+    """
+    the columns and the number of rows of a tsv, without parsing it
+    """
+    with open(fname, 'r') as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        nrows = sum(1 for line in f if line.strip())
+
+    return columns, nrows
+
+
+def brainlife_tr(fmri):
+    """
+    the meta.RepetitionTime of the .brainlife.json next to fmri, None if none
+    """
+    fname = os.path.join(os.path.dirname(os.path.abspath(fmri)), '.brainlife.json')
+    try:
+        with open(fname, 'r') as f:
+            tr = json.load(f).get('meta', {}).get('RepetitionTime')
+    except (IOError, ValueError):
+        return None
+
+    return float(tr) if tr else None
+
+
+def world_bbox(shape, affine):
+    """
+    the min, max world (mm) coordinates of the corners of a grid
+    """
+    corners = np.array(list(itertools.product(*[[-0.5, n - 0.5] for n in shape[:3]])))
+    world = nib.affines.apply_affine(affine, corners)
+
+    return world.min(axis=0), world.max(axis=0)
+
+
+def bbox_inside(boxa, boxb):
+    """
+    the fraction of the volume of box a that is inside box b
+    """
+    low = np.maximum(boxa[0], boxb[0])
+    high = np.minimum(boxa[1], boxb[1])
+    inside = np.prod(np.maximum(high - low, 0))
+
+    return inside / max(np.prod(boxa[1] - boxa[0]), 1e-12)
+
+
+def same_grid(imga, imgb, atol=1e-3):
+
+    return (tuple(imga.shape[:3]) == tuple(imgb.shape[:3])
+            and np.allclose(imga.affine, imgb.affine, atol=atol))
+
+
+def check_fmri(args, errors, warnings):
+    """
+    returns the image (header) and number of volumes, None if unreadable
+    """
+    try:
+        img = nib.load(args.fmri)
+    except Exception as e:
+        errors.append("fmri {} could not be read: {}".format(args.fmri, e))
+        return None, None
+
+    if is_cifti(img):
+        if not args.fmri.endswith('.dtseries.nii'):
+            errors.append("cifti fmri {} is not a .dtseries.nii".format(args.fmri))
+        return img, img.shape[0]
+
+    if len(img.shape) != 4:
+        errors.append("fmri {} is not 4D (shape {})".format(args.fmri, img.shape))
+        return img, None
+
+    return img, img.shape[3]
+
+
+def check_tr(args, img, errors, warnings):
+
+    if is_cifti(img):
+        series = img.header.get_axis(0)
+        headertr = series.step / 1000. if series.unit == 'MILLISECOND' else series.step
+    else:
+        headertr = float(img.header.get_zooms()[3])
+    bltr = brainlife_tr(args.fmri)
+    tr = args.tr if args.tr else headertr
+
+    if bltr is not None and abs(tr - bltr) > 1e-3:
+        errors.append("tr {} ({}) but .brainlife.json has {}".format(
+                      tr, '-tr' if args.tr else 'from the header', bltr))
+    elif args.tr and headertr and abs(args.tr - headertr) > 1e-3:
+        warnings.append("-tr {} but the header has {}".format(args.tr, headertr))
+
+    if not tr:
+        errors.append("no tr, not given and none in the header")
+        return
+    if tr < 0.1 or tr > 10:
+        warnings.append("tr {} looks off (seconds?)".format(tr))
+    if args.lowpass and args.lowpass >= 0.5 / tr:
+        errors.append("-lowpass {} is over the nyquist frequency {:.3g} of tr {}".format(
+                      args.lowpass, 0.5 / tr, tr))
+
+
+def check_mask(args, img, errors, warnings):
+
+    if is_cifti(img):
+        if args.mask is not None:
+            warnings.append("-mask is not used for a cifti fmri")
+        return
+
+    if args.mask is None:
+        errors.append("no -mask")
+        return
+    try:
+        mask = nib.load(args.mask)
+    except Exception as e:
+        errors.append("mask {} could not be read: {}".format(args.mask, e))
+        return
+
+    if len(mask.shape) > 3 and mask.shape[3] != 1:
+        errors.append("mask {} is not 3D (shape {})".format(args.mask, mask.shape))
+    elif not same_grid(mask, img):
+        errors.append("mask {} is not on the fmri grid (shape {} vs {})".format(
+                      args.mask, mask.shape[:3], img.shape[:3]))
+
+
+def check_parcs(args, img, errors, warnings, mininside=0.9):
+
+    fmribox = None if is_cifti(img) else world_bbox(img.shape, img.affine)
+    for parc in args.parcs:
+        if is_cifti(img):
+            if not parc.endswith('.dlabel.nii'):
+                errors.append("parc {} is not a .dlabel.nii, for a cifti fmri".format(parc))
+            elif not os.path.isfile(parc):
+                errors.append("parc {} not found".format(parc))
+            continue
+
+        if is_cifti(parc):
+            errors.append("parc {} is cifti, but the fmri is not".format(parc))
+            continue
+        try:
+            labimg = nib.load(parc)
+        except Exception as e:
+            errors.append("parc {} could not be read: {}".format(parc, e))
+            continue
+
+        if len(labimg.shape) > 3 and labimg.shape[3] != 1:
+            errors.append("parc {} is not 3D (shape {})".format(parc, labimg.shape))
+            continue
+        inside = bbox_inside(world_bbox(labimg.shape, labimg.affine), fmribox)
+        if inside == 0:
+            errors.append("parc {} does not overlap the fmri at all".format(parc))
+        elif inside < mininside:
+            warnings.append("only {:.0f}% of parc {} is in the fmri field of view".format(
+                            100 * inside, parc))
+        if np.issubdtype(labimg.get_data_dtype(), np.floating):
+            warnings.append("parc {} is stored as {}, not integer labels".format(
+                            parc, labimg.get_data_dtype()))
+
+
+def check_confounds(args, nvol, errors, warnings):
+
+    try:
+        columns, nrows = read_tsv_header(args.confounds)
+    except IOError as e:
+        errors.append("confounds {} could not be read: {}".format(args.confounds, e))
+        return
+
+    names = confound_names(columns)
+    if names is None:
+        errors.append("confounds {} have neither the old nor the new fmriprep "
+                      "column names".format(args.confounds))
+        return
+
+    # get_confounds takes these for every strategy
+    needed = names['p9cols'] + names['globalsignalcol'] + [names['framewisecol']]
+    missing = [col for col in needed if col not in columns]
+    if missing:
+        errors.append("confounds are missing {}".format(', '.join(missing)))
+
+    if args.strategy in COMPCORKINDS and getattr(args, 'compcor', 'file') == 'file':
+        try:
+            compcols = compcor_names(columns, names['compcorregex'], args.confjson)
+        except (IOError, ValueError, KeyError, AttributeError) as e:
+            errors.append("confjson {} could not be read: {}".format(args.confjson, e))
+            compcols = None
+        if compcols is not None:
+            if not compcols:
+                errors.append("no compcor columns for -strategy {}".format(args.strategy))
+            missing = [col for col in compcols if col not in columns]
+            if missing:
+                errors.append("compcor columns {} (of {}) are not in the confounds".format(
+                              ', '.join(missing),
+                              '-confjson' if args.confjson else 'the first five'))
+    elif args.confjson and not os.path.isfile(args.confjson):
+        errors.append("confjson {} not found".format(args.confjson))
+
+    if args.highpass == 'cosine' and not any('cosine' in col for col in columns):
+        errors.append("-highpass cosine but no cosine columns in the confounds")
+
+    if nvol is not None:
+        if nrows != nvol:
+            errors.append("confounds have {} rows but the fmri has {} volumes".format(
+                          nrows, nvol))
+        if args.discardvols >= nvol:
+            errors.append("-discardvols {} leaves no volumes of {}".format(
+                          args.discardvols, nvol))
+        if args.add_regressors:
+            try:
+                _, addrows = read_tsv_header(args.add_regressors)
+            except IOError as e:
+                errors.append("add_regressors {} could not be read: {}".format(
+                              args.add_regressors, e))
+            else:
+                if addrows != nvol:
+                    errors.append("add_regressors have {} rows but the fmri has {} "
+                                  "volumes".format(addrows, nvol))
+
+
+def check_args(args):
+    """
+    the header-only checks of the inputs named in parsed pipeline.py (or
+    regress.py) args
+
+    returns lists of errors and warnings
+    """
+    errors = []
+    warnings = []
+
+    img, nvol = check_fmri(args, errors, warnings)
+    if img is not None:
+        check_tr(args, img, errors, warnings)
+        check_mask(args, img, errors, warnings)
+        if getattr(args, 'parcs', None):
+            check_parcs(args, img, errors, warnings)
+    check_confounds(args, nvol, errors, warnings)
+
+    if getattr(args, 'compcormask', None) and not os.path.isfile(args.compcormask):
+        errors.append("compcormask {} not found".format(args.compcormask))
+
+    return errors, warnings
+
+
+def check_argv(argv):
+    """
+    check_args of a pipeline.py command line, returns errors, warnings
+    """
+    from pipeline import get_parser
+
+    parser = get_parser()
+    # an unparsable command line is an error too, not an exit
+    parser.error = lambda message: (_ for _ in ()).throw(ValueError(message))
+    try:
+        args = parser.parse_args(argv)
+    except ValueError as e:
+        return ["bad options: {}".format(e)], []
+
+    return check_args(args)
+
+
+def main():
+
+    # no -h of its own, it would take -highpass (-h is pipeline.py's help)
+    parser = argparse.ArgumentParser(description='header-only checks of the inputs of a run',
+                                     allow_abbrev=False, add_help=False)
+    parser.add_argument('-manifest', type=str, help='check every subject of a batch.py manifest',
+                        default=None)
+    parser.add_argument('-report', type=str, help='per subject results tsv (with -manifest)',
+                        default='preflight.tsv')
+
+    # parse, the rest are pipeline.py args
+    args, rest = parser.parse_known_args()
+
+    if args.manifest is None:
+        from pipeline import get_parser
+        errors, warnings = check_args(get_parser().parse_args(rest))
+        for warning in warnings:
+            print("WARNING: {}".format(warning))
+        for error in errors:
+            print("ERROR: {}".format(error))
+        if errors:
+            exit(1)
+        print("preflight ok")
+        return
+
+    from batch import read_manifest, manifest_argv
+
+    rows = read_manifest(args.manifest)
+    report = []
+    for row in rows:
+        errors, warnings = check_argv(manifest_argv(row, rest))
+        status = 'failed' if errors else ('warnings' if warnings else 'ok')
+        report.append({'id': row['id'], 'status': status,
+                       'errors': '; '.join(errors), 'warnings': '; '.join(warnings)})
+        if status != 'ok':
+            print("{} {}: {}".format(row['id'], status, '; '.join(errors + warnings)))
+
+    pd.DataFrame(report, columns=['id', 'status', 'errors', 'warnings']).to_csv(
+        args.report, sep='\t', index=False)
+    nfailed = sum(entry['status'] == 'failed' for entry in report)
+    print("\n{} of {} subjects failed preflight, see {}".format(nfailed, len(rows), args.report))
+    if nfailed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
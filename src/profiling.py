@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+where the time and memory of a run go: the -profile option of regress.py,
+makemat.py and pipeline.py writes a json report with, for every stage (image
+load, confounds, masker, filtering, resampling, connectivity, writing...)
+
+    wall, cpu           seconds
+    peakrss_delta_mb    how much the stage raised the peak memory (rss) of
+                        the process, and rss_mb, the memory after it
+    read_bytes,         bytes the process read / wrote from storage during
+    write_bytes         the stage (linux /proc/self/io, null elsewhere)
+    arrays              shape, dtype and MB of the main arrays of the stage
+
+stages can be nested (depth, parent). with no -profile, stage() does nothing
+
+    profiling.py summarize <_profile.json files> [-out summary.tsv]
+
+puts the reports of many subjects side by side: per stage, the median and
+max over subjects, and the subjects more than -madthr scaled MADs over the
+median of a stage, to spot regressions and outliers
+
+@author: jfaskowi
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+from contextlib import contextmanager
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+pd = lazy_import('pandas')
+
+STAGEFIELDS = ['wall', 'cpu', 'peakrss_delta_mb', 'rss_mb', 'read_bytes', 'write_bytes']
+
+# the report being made, None when not profiling
+_current = None
+
+
+def read_io():
+    """
+    bytes read and written to storage by this process so far, (None, None)
+    if not on linux
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss_mb():
+    """
+    peak rss of this process so far (ru_maxrss is KB on linux, bytes on mac)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024. * 1024.)
+    return peak / 1024.
+
+
+def rss_mb():
+    """
+    current rss of this process (peak rss if /proc is not there)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024.)
+    except (IOError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def enabled():
+
+    return _current is not None
+
+
+@contextmanager
+def stage(name):
+    """
+    time a stage of the run (a with block), if profiling
+    """
+    if _current is None:
+        yield
+        return
+
+    parent = _current['open'][-1]['name'] if _current['open'] else None
+    entry = {'name': name, 'parent': parent, 'depth': len(_current['open']),
+             'arrays': {}}
+    _current['stages'].append(entry)
+    _current['open'].append(entry)
+
+    wall0 = time.time()
+    cpu0 = time.process_time()
+    peak0 = peak_rss_mb()
+    read0, write0 = read_io()
+    try:
+        yield
+    finally:
+        read1, write1 = read_io()
+        entry['wall'] = time.time() - wall0
+        entry['cpu'] = time.process_time() - cpu0
+        entry['peakrss_delta_mb'] = peak_rss_mb() - peak0
+        entry['rss_mb'] = rss_mb()
+        entry['read_bytes'] = None if read0 is None else read1 - read0
+        entry['write_bytes'] = None if write0 is None else write1 - write0
+        _current['open'].pop()
+
+
+def note_array(name, arr):
+    """
+    record the shape and dtype of an array in the innermost open stage, if
+    profiling
+    """
+    if _current is None or not _current['open'] or not hasattr(arr, 'shape'):
+        return
+
+    _current['open'][-1]['arrays'][name] = {
+        'shape': [int(n) for n in arr.shape],
+        'dtype': str(arr.dtype),
+        'mb': int(np.prod(arr.shape, dtype=np.int64)) * arr.dtype.itemsize / (1024. * 1024.)}
+
+
+@contextmanager
+def report(fname):
+    """
+    profile the run inside the with block, writing the report to fname
+    (.json) at the end, even if it fails (status then says so). does nothing
+    if fname is None
+    """
+    global _current
+
+    if fname is None:
+        yield
+        return
+
+    _current = {'command': sys.argv, 'host': socket.gethostname(), 'pid': os.getpid(),
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S'), 'status': 'ok',
+                'stages': [], 'open': []}
+    try:
+        with stage('total'):
+            yield
+    except BaseException as e:
+        if not (isinstance(e, SystemExit) and not e.code):
+            _current['status'] = 'failed: {}'.format(repr(e))
+        raise
+    finally:
+        out = _current
+        _current = None
+        del out['open']
+        with open(fname, 'w') as f:
+            json.dump(out, f, indent=1)
+        print("wrote profile to {}".format(fname))
+
+
+def read_reports(fnames):
+    """
+    the stages of many reports as one long data frame, a row per subject
+    (report file) x stage
+    """
+    rows = []
+    for fname in fnames:
+        with open(fname, 'r') as f:
+            rep = json.load(f)
+        # stages repeated in a run (e.g. one per parc) are summed
+        seen = {}
+        for entry in rep['stages']:
+            key = (entry['name'], entry['parent'])
+            if key not in seen:
+                seen[key] = {'report': fname, 'status': rep['status'],
+                             'stage': entry['name'], 'parent': entry['parent'],
+                             'calls': 0}
+                seen[key].update({field: 0. for field in STAGEFIELDS})
+            row = seen[key]
+            row['calls'] += 1
+            for field in STAGEFIELDS:
+                val = entry.get(field)
+                if val is None:
+                    row[field] = np.nan
+                elif field in ['peakrss_delta_mb', 'rss_mb']:
+                    row[field] = max(row[field], val)
+                else:
+                    row[field] += val
+        rows += list(seen.values())
+
+    return pd.DataFrame(rows)
+
+
+def summarize(df, madthr=3.5):
+    """
+    per stage, the median / max over subjects, and the outliers: subjects
+    over median + madthr * 1.4826 * MAD in wall time or peak memory
+
+    returns the summary and the outliers data frames
+    """
+    summary = []
+    outliers = []
+    # top level stages have no parent; '' so that groupby keeps them (no
+    # dropna= before pandas 1.1)
+    df = df.assign(parent=df['parent'].fillna(''))
+    for (stagename, parent), grp in df.groupby(['stage', 'parent'], sort=False):
+        row = {'stage': stagename, 'parent': parent, 'subjects': len(grp)}
+        for field in STAGEFIELDS:
+            row['{}_median'.format(field)] = grp[field].median()
+            row['{}_max'.format(field)] = grp[field].max()
+        summary.append(row)
+
+        for field in ['wall', 'peakrss_delta_mb']:
+            vals = grp[field].values
+            med = np.nanmedian(vals)
+            mad = 1.4826 * np.nanmedian(np.abs(vals - med))
+            if not mad > 0:
+                continue
+            for rep, val in zip(grp['report'], vals):
+                if val > med + madthr * mad:
+                    outliers.append({'stage': stagename, 'parent': parent, 'field': field,
+                                     'report': rep, 'value': val, 'median': med,
+                                     'robustz': (val - med) / mad})
+
+    return pd.DataFrame(summary), pd.DataFrame(outliers)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='profile report tools')
+    subparsers = parser.add_subparsers(dest='command')
+    sumparser = subparsers.add_parser('summarize', help='the stages of many reports side by side')
+    sumparser.add_argument('reports', nargs='+', help='_profile.json files')
+    sumparser.add_argument('-out', type=str, help='summary tsv (+ _outliers.tsv, _long.tsv)',
+                           default=None)
+    sumparser.add_argument('-madthr', type=float, help='outlier threshold, in scaled MADs over '
+                           'the median', default=3.5)
+
+    # parse
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        exit(1)
+
+    df = read_reports(args.reports)
+    summary, outliers = summarize(df, args.madthr)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 160):
+        print(summary[['stage', 'parent', 'subjects', 'wall_median', 'wall_max',
+                       'cpu_median', 'peakrss_delta_mb_median', 'peakrss_delta_mb_max',
+                       'write_bytes_median']].to_string(index=False, float_format='%.3g'))
+        print("\n{} of {} reports did not finish ok".format(
+              sum(df.groupby('report')['status'].first() != 'ok'), df['report'].nunique()))
+        if len(outliers):
+            print("\noutliers:")
+            print(outliers.to_string(index=False, float_format='%.3g'))
+
+    if args.out is not None:
+        base = args.out.rsplit('.tsv', 1)[0]
+        summary.to_csv(args.out, sep='\t', index=False)
+        outliers.to_csv(''.join([base, '_outliers.tsv']), sep='\t', index=False)
+        df.to_csv(''.join([base, '_long.tsv']), sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,14 +10,29 @@ copied/adapted from original code here: https://github.com/fliem/sea_zrh_rs
 
 """
 
+import os
+import re
+import gzip
+import shutil
 import argparse
 import json
-import nibabel as nib
+import threading
 import numpy as np
-from nilearn import input_data, image
-import pandas as pd
 # from scipy import signal
 
+from lazyimport import lazy_import
+from profiling import stage, note_array, report
+from niiwrite import write_nifti, add_write_args
+from get_compcor import COMPCORCHOICES, compcor_from_img, compcor_series, compcor_components
+from cifti import is_cifti, load_dtseries, dtseries_img, save_dtseries
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+pd = lazy_import('pandas')
+input_data = lazy_import('nilearn.input_data')
+image = lazy_import('nilearn.image')
+signal = lazy_import('nilearn.signal')
+
 NUSCHOICES= ["36P", "9P", "6P", 
              "aCompCor", "24aCompCor", "24aCompCorGsr",
              "globalsig", "globalsig4", "linear" ]
@@ -31,29 +46,12 @@ def image_drop_dummy_trs(nib_image, start_from_tr):
     return img_out
 
 
-def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
-    conftype="36P", spikethr=0.25, smoothkern=6.0, discardvols=4,
-    highpassval=0.008, lowpassval=0.08, confoundsjson='',
-    addregressors='', addlinear=False, addafterdetr=False, initdum=0):
+def get_filter_setup(inputimg, inputtr=0, highpassval=0.008, lowpassval=0.08):
     """
-    
-    returns a nibabel.nifti1.Nifti1Image that is cleaned in following ways:
-        detrending, smoothed, motion parameter regress, spike regress, 
-        bandpass filtered, and normalized
-        
-    options for motion paramter regress: 36P, 9P, 6P, or aCompCor
-    
-    signal cleaning params from:
-        
-        Parkes, L., Fulcher, B., Yücel, M., & Fornito, A. (2018). An evaluation 
-        of the efficacy, reliability, and sensitivity of motion correction 
-        strategies for resting-state functional MRI. NeuroImage, 171, 415-436.
-        
-        Ciric, R., Wolf, D. H., Power, J. D., Roalf, D. R., Baum, G. L., 
-        Ruparel, K., ... & Gur, R. C. (2017). Benchmarking of participant-level
-        confound regression strategies for the control of motion artifact in 
-        studies of functional connectivity. Neuroimage, 154, 174-187.
-    
+    the filter values and the tr of get_clean_setup (from the image header,
+    if not provided), what does not need the confounds
+
+    returns tr, highpassval, lowpassval, dct (a cosine basis high pass)
     """
 
     dct = False
@@ -74,16 +72,6 @@ def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
                 print("high and low pass values dont make sense. exiting")
                 exit(1)
 
-    # extract confounds
-    confounds, outlier_stats = get_confounds(confoundsfile,
-                                             kind=conftype,
-                                             spikereg_threshold=spikethr,
-                                             confounds_json=confoundsjson,
-                                             dctbasis=dct,
-                                             addreg=addregressors,
-                                             initdum=initdum,
-                                             addlin=addlinear)
-
     # check tr
     if inputtr == 0:
         # read the tr from the fourth dimension of zooms, this depends on the input
@@ -98,12 +86,170 @@ def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
     else:
         tr = inputtr
 
+    return tr, highpassval, lowpassval, dct
+
+
+def get_clean_setup(inputimg, confoundsfile, inputtr=0, conftype="36P",
+                    spikethr=0.25, highpassval=0.008, lowpassval=0.08,
+                    confoundsjson='', addregressors='', addlinear=False,
+                    initdum=0, censor=False, censormincontig=0, compcor=None):
+    """
+    the part of nuisance_regress that does not touch the image data: sort
+    out the filter values, make the confounds, get the tr (from the image
+    header, if not provided), and, if censoring, the frames to keep.
+    compcor: see get_confounds
+
+    returns confounds, outlier_stats, tr, highpassval, lowpassval, keep
+    (keep is None if not censoring)
+    """
+
+    tr, highpassval, lowpassval, dct = get_filter_setup(inputimg, inputtr, highpassval,
+                                                        lowpassval)
+
+    # extract confounds
+    confounds, outlier_stats = get_confounds(confoundsfile,
+                                             kind=conftype,
+                                             spikereg_threshold=spikethr,
+                                             confounds_json=confoundsjson,
+                                             dctbasis=dct,
+                                             addreg=addregressors,
+                                             initdum=initdum,
+                                             addlin=addlinear,
+                                             censor=censor,
+                                             compcor=compcor)
+
+    keep = None
+    if censor:
+        keep = get_censor_frames(confoundsfile, spikethr, censormincontig)
+        print("censoring {} of {} frames".format(np.sum(~keep), len(keep)))
+
+    return confounds, outlier_stats, tr, highpassval, lowpassval, keep
+
+
+def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
+    conftype="36P", spikethr=0.25, smoothkern=6.0, discardvols=4,
+    highpassval=0.008, lowpassval=0.08, confoundsjson='',
+    addregressors='', addlinear=False, addafterdetr=False, initdum=0,
+    stdz=True, fusedop=False, censor=False, censormincontig=0,
+    dtype=np.float64, compcor='file', compcormask=None, compcorn=5,
+    compcorpct=2., setup=None):
+    """
+    
+    returns a nibabel.nifti1.Nifti1Image that is cleaned in following ways:
+        detrending, smoothed, motion parameter regress, spike regress, 
+        bandpass filtered, and normalized
+        
+    options for motion paramter regress: 36P, 9P, 6P, or aCompCor
+    
+    signal cleaning params from:
+        
+        Parkes, L., Fulcher, B., Yücel, M., & Fornito, A. (2018). An evaluation 
+        of the efficacy, reliability, and sensitivity of motion correction 
+        strategies for resting-state functional MRI. NeuroImage, 171, 415-436.
+        
+        Ciric, R., Wolf, D. H., Power, J. D., Roalf, D. R., Baum, G. L., 
+        Ruparel, K., ... & Gur, R. C. (2017). Benchmarking of participant-level
+        confound regression strategies for the control of motion artifact in 
+        studies of functional connectivity. Neuroimage, 154, 174-187.
+
+    with fusedop, the regression, filtering and detrend after are done as one
+    precomputed time x time matrix (see get_temporal_operator), applied to
+    the voxels in blocks, instead of as separate passes over all the data
+
+    with censor, the frames over spikethr are censored instead of getting a
+    spike regressor each (see get_censored_operator), which means fusedop
+
+    dtype float32 keeps the voxel data in single precision throughout (the
+    masked data, the operator multiply, the output image), also by way of
+    fusedop. the operator itself is still made in float64 (it is only time x
+    time)
+
+    with compcor mask or highvar (see get_compcor.py), the compcor
+    components are made from the image (loaded once, for them and the
+    cleaning) instead of read from the confounds file, compcormask (image),
+    compcorn, compcorpct being the voxels, number of components, percent of
+    highest variance voxels
+
+    setup, if given, is what get_clean_setup returns for these args, made
+    already (e.g. read from the pipeline.py -stagecache), so the confounds
+    are not made again
+    
+    """
+
+    compcorconf = None
+    if compcor != 'file':
+        with stage('load'):
+            inputimg = nib.Nifti1Image(inputimg.get_fdata(dtype=dtype), inputimg.affine,
+                                       inputimg.header)
+        with stage('compcor'):
+            compcorconf = compcor_from_img(inputimg, compcor, inputmask=inputmask,
+                                           compcormask=compcormask, percentile=compcorpct,
+                                           ncomp=compcorn)
+
+    with stage('confounds'):
+        if setup is None:
+            setup = get_clean_setup(inputimg, confoundsfile, inputtr=inputtr,
+                                    conftype=conftype, spikethr=spikethr,
+                                    highpassval=highpassval, lowpassval=lowpassval,
+                                    confoundsjson=confoundsjson,
+                                    addregressors=addregressors, addlinear=addlinear,
+                                    initdum=initdum, censor=censor,
+                                    censormincontig=censormincontig,
+                                    compcor=compcorconf)
+        confounds, outlier_stats, tr, highpassval, lowpassval, keep = setup
+        note_array('confounds', confounds.values)
+
+    single = np.dtype(dtype) == np.float32
+    if fusedop or censor or single:
+        print("cleaning image with fused temporal operator")
+        with stage('temporal operator'):
+            op, detrop = get_temporal_operator(inputimg.shape[3], confounds, tr,
+                                               highpassval, lowpassval,
+                                               addafterdetr=addafterdetr,
+                                               keep=keep)
+            note_array('op', op)
+
+        if inputmask is not None:
+            # masker only masks + smooths here
+            masker = input_data.NiftiMasker(mask_img=inputmask, detrend=False,
+                                            standardize=False,
+                                            smoothing_fwhm=smoothkern,
+                                            dtype=dtype if single else None,
+                                            verbose=1)
+            with stage('load, smooth, mask'):
+                time_series = masker.fit_transform(inputimg)
+                note_array('time_series', time_series)
+            with stage('regress, filter (fused operator)'):
+                time_series = apply_temporal_operator(op, time_series, detrop,
+                                                      stdz=stdz,
+                                                      discardvols=discardvols,
+                                                      keep=keep, dtype=dtype)
+            with stage('unmask'):
+                outimg = masker.inverse_transform(time_series)
+        else:
+            print("cleaning image with no mask")
+            with stage('load'):
+                loadimg = image.load_img(inputimg)
+                data = loadimg.get_fdata(dtype=dtype)
+                note_array('data', data)
+            with stage('regress, filter (fused operator)'):
+                # voxels x time -> time x voxels view, cleaned in place
+                time_series = data.reshape((-1, data.shape[3])).T
+                time_series = apply_temporal_operator(op, time_series, detrop,
+                                                      stdz=stdz,
+                                                      discardvols=discardvols,
+                                                      keep=keep, dtype=dtype)
+                outimg = nib.Nifti1Image(time_series.T.reshape(data.shape[:3] + (-1,)),
+                                         loadimg.affine, loadimg.header)
+
+        return outimg, confounds, outlier_stats
+
     if inputmask is not None:
         print("cleaning image with masker")
 
         # masker params
         masker_params = {"mask_img": inputmask, "detrend": False,
-                         "standardize": True, "low_pass": lowpassval,
+                         "standardize": stdz, "low_pass": lowpassval,
                          "high_pass": highpassval, "t_r": tr,
                          "smoothing_fwhm": smoothkern, "verbose": 1, }
 
@@ -111,10 +257,13 @@ def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
         masker = input_data.NiftiMasker(**masker_params)
 
         # perform the nuisance regression
-        time_series = masker.fit_transform(inputimg, confounds=confounds.values)
+        with stage('load, smooth, mask, regress, filter (masker)'):
+            time_series = masker.fit_transform(inputimg, confounds=confounds.values)
+            note_array('time_series', time_series)
 
         # inverse masker operation to get the nifti object, n.b. this returns a Nifti1Image!!!
-        outimg = masker.inverse_transform(time_series)  # nus regress
+        with stage('unmask'):
+            outimg = masker.inverse_transform(time_series)  # nus regress
 
     else:
         # no mask! so no masker
@@ -122,18 +271,20 @@ def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
 
         # threfore no smoothkernel here is possible
         clean_params = {"confounds": confounds.values,
-                        "detrend": False, "standardize": True,
+                        "detrend": False, "standardize": stdz,
                         "low_pass": lowpassval, "high_pass": highpassval, 
                         "t_r": tr, }
 
-        loadimg = image.load_img(inputimg)
-        outimg = image.clean_img(loadimg, **clean_params)  # nus regress
+        with stage('load, regress, filter (clean_img)'):
+            loadimg = image.load_img(inputimg)
+            outimg = image.clean_img(loadimg, **clean_params)  # nus regress
 
     if addafterdetr:
         print("detrend after confounds")
-        outimg2 = image.clean_img(outimg, detrend=True, standardize=False,
-              confounds=None, low_pass=None, high_pass=None, t_r=None,
-              ensure_finite=False, mask_img=inputmask)
+        with stage('detrend after'):
+            outimg2 = image.clean_img(outimg, detrend=True, standardize=False,
+                  confounds=None, low_pass=None, high_pass=None, t_r=None,
+                  ensure_finite=False, mask_img=inputmask)
         outimg = outimg2 
 
     # get rid of the first N volumes
@@ -146,6 +297,500 @@ def nuisance_regress(inputimg, confoundsfile, inputmask, inputtr=0,
     return outimgtrim, confounds, outlier_stats
 
 
+def clean_timeseries(time_series, confounds, tr, highpassval, lowpassval,
+                     addafterdetr=False, discardvols=0, stdz=True):
+    """
+    the cleaning that nuisance_regress does to each voxel (confound regress,
+    filter, standardize, optional detrend after, discard volumes), for a
+    time x signals array. the confounds, tr, and filter values are the ones
+    returned by get_clean_setup (confounds None for no regression)
+    """
+    if confounds is not None:
+        confounds = confounds.values
+
+    cleaned = signal.clean(time_series, confounds=confounds,
+                           detrend=False, standardize=stdz,
+                           low_pass=lowpassval, high_pass=highpassval, t_r=tr)
+    if addafterdetr:
+        cleaned = signal.clean(cleaned, detrend=True, standardize=False,
+                               confounds=None, low_pass=None, high_pass=None,
+                               t_r=None, ensure_finite=False)
+
+    return cleaned[discardvols:, :]
+
+
+def get_temporal_operator(nvol, confounds, tr, highpassval, lowpassval,
+                          addafterdetr=False, keep=None):
+    """
+    the confound regression + filtering that clean_timeseries does, as one
+    nvol x nvol matrix. those steps are linear in time and the same for every
+    voxel, so cleaning the identity matrix gives the matrix that does them
+    all, and cleaning the voxels becomes one matrix multiply (then the
+    standardizing, which is up to each voxel). the detrend after, which comes
+    after the standardizing, is a second matrix (None if not addafterdetr)
+
+    keep (boolean, frames to keep) makes it the censoring version, see
+    get_censored_operator
+
+    returns op, detrop
+    """
+    if keep is not None and not np.all(keep):
+        return get_censored_operator(confounds, tr, highpassval, lowpassval,
+                                     keep, addafterdetr=addafterdetr)
+
+    op = clean_timeseries(np.eye(nvol), confounds, tr, highpassval,
+                          lowpassval, stdz=False)
+
+    detrop = None
+    if addafterdetr:
+        detrop = signal.clean(op, detrend=True, standardize=False,
+                              confounds=None, low_pass=None, high_pass=None,
+                              t_r=None, ensure_finite=False)
+
+    return op, detrop
+
+
+def get_censored_operator(confounds, tr, highpassval, lowpassval, keep,
+                          addafterdetr=False):
+    """
+    the get_temporal_operator matrices when censoring (scrubbing) the frames
+    that are not in keep, as three linear steps:
+
+        1. regress out the confounds (+ intercept), fit on the kept frames
+        2. fill in the censored frames by linear interpolation between the
+           nearest kept frames, so the filter sees a continuous signal
+        3. band-pass filter (the same nilearn filter as clean_timeseries)
+
+    the detrend after is also fit on the kept frames only. the censored
+    frames come out interpolated and are to be dropped before the
+    connectivity (makemat.py -censorfile)
+
+    returns op, detrop
+    """
+    nvol = len(keep)
+    keptidx = np.flatnonzero(keep)
+    censidx = np.flatnonzero(~keep)
+
+    # 1. confound regression fit on the kept frames
+    if confounds is not None:
+        design = np.column_stack([confounds.values, np.ones(nvol)])
+    else:
+        design = np.ones((nvol, 1))
+    resid = np.eye(nvol)
+    resid[:, keptidx] -= design.dot(np.linalg.pinv(design[keptidx, :]))
+
+    # 2. linear interpolation from the nearest kept frames (nearest at the ends)
+    interp = np.zeros((nvol, nvol))
+    interp[keptidx, keptidx] = 1.
+    after = np.clip(np.searchsorted(keptidx, censidx), 1, len(keptidx) - 1)
+    before = after - 1
+    frac = np.clip((censidx - keptidx[before]) /
+                   (keptidx[after] - keptidx[before]).astype(np.float64), 0., 1.)
+    interp[censidx, keptidx[before]] = 1. - frac
+    interp[censidx, keptidx[after]] += frac
+
+    # 3. the filter alone, as a matrix
+    if lowpassval or highpassval:
+        filt = signal.clean(np.eye(nvol), detrend=False, standardize=False,
+                            confounds=None, low_pass=lowpassval,
+                            high_pass=highpassval, t_r=tr)
+    else:
+        filt = np.eye(nvol)
+
+    op = filt.dot(interp).dot(resid)
+
+    detrop = None
+    if addafterdetr:
+        trend = np.column_stack([np.ones(nvol), np.arange(nvol)])
+        detr = np.eye(nvol)
+        detr[:, keptidx] -= trend.dot(np.linalg.pinv(trend[keptidx, :]))
+        detrop = detr.dot(op)
+
+    return op, detrop
+
+
+def apply_temporal_operator(op, voxts, detrop=None, stdz=True, discardvols=0,
+                            keep=None, blocksize=8192, dtype=np.float64):
+    """
+    clean a time x voxels array with the matrices from get_temporal_operator,
+    in place, a block of voxels at a time (one matrix multiply per block, and
+    only a block is ever in dtype, float64 by default). if keep is given,
+    the standardizing uses the kept frames only
+
+    returns the cleaned voxts minus the discarded volumes (a view)
+    """
+    op = op.astype(dtype, copy=False)
+    if detrop is not None:
+        detrop = detrop.astype(dtype, copy=False)
+
+    for v0 in range(0, voxts.shape[1], blocksize):
+        v1 = min(voxts.shape[1], v0 + blocksize)
+        block = np.asarray(voxts[:, v0:v1], dtype=dtype)
+        cleaned = op.dot(block)
+        detrcleaned = None if detrop is None else detrop.dot(block)
+
+        voxts[:, v0:v1] = stdz_block(cleaned, detrcleaned, stdz, keep)
+
+    return voxts[discardvols:, :]
+
+
+def stdz_block(cleaned, detrcleaned=None, stdz=True, keep=None):
+    """
+    the standardizing step of apply_temporal_operator, for one block of
+    cleaned (time x voxels) data: the 'zscore' of nilearn's signal.clean,
+    on the kept frames if keep is given. if the detrend after is on
+    (detrcleaned, the block through the detrop), that is what gets divided
+    by the std of cleaned, as the detrend comes after the standardizing.
+    cleaned is centered in place
+    """
+    if stdz:
+        kept = cleaned if keep is None else cleaned[keep, :]
+        cleaned -= kept.mean(axis=0)
+        std = kept.std(axis=0)
+        std[std < np.finfo(cleaned.dtype).eps] = 1.
+    else:
+        std = 1.
+
+    if detrcleaned is not None:
+        cleaned = detrcleaned
+
+    return cleaned / std
+
+
+def fanout_temporal_blocks(baseops, updates, voxts, stdz=True, discardvols=0,
+                           keep=None, blocksize=8192):
+    """
+    apply_temporal_operator for several sets of confounds at once. baseops
+    is the (op, detrop) of get_temporal_operator with no confounds (just the
+    filter), updates a list of get_lowrank_update pairs, one (opupd,
+    detropupd) per set of confounds. the full time x time multiply by the
+    base operator is done once per block of voxels, and each set of
+    confounds only adds its thin low rank part
+
+    the blocks are always float64, even for float32 voxts: the low rank part
+    cancels most of the filtered data (the confounds explain much of it),
+    which single precision does not survive
+
+    yields, per block of voxels, v0, v1, and the list of cleaned blocks
+    (time minus discardvols x voxels, float64), in the order of updates
+    """
+    baseop, basedetrop = baseops
+    for v0 in range(0, voxts.shape[1], blocksize):
+        v1 = min(voxts.shape[1], v0 + blocksize)
+        block = np.asarray(voxts[:, v0:v1], dtype=np.float64)
+
+        # the shared part (i.e. the filtering), once
+        basecleaned = baseop.dot(block)
+        basedetr = None if basedetrop is None else basedetrop.dot(block)
+
+        cleanedblocks = []
+        for (updl, updr), detrupd in updates:
+            cleaned = basecleaned + updl.dot(updr.dot(block))
+            detrcleaned = None
+            if basedetr is not None:
+                detrcleaned = basedetr + detrupd[0].dot(detrupd[1].dot(block))
+            cleaned = stdz_block(cleaned, detrcleaned, stdz, keep)
+            cleanedblocks.append(cleaned[discardvols:, :])
+
+        yield v0, v1, cleanedblocks
+
+
+def get_lowrank_update(op, baseop, tol=1e-8):
+    """
+    factor op - baseop as updl.dot(updr), for two get_temporal_operator
+    matrices that differ by a low rank part, e.g. the same filter with and
+    without a set of confounds (the difference is then of rank the number
+    of confounds). with the base (filtered) data at hand, another set of
+    confounds costs two thin multiplies instead of a full time x time one.
+    singular values under tol x the largest are dropped
+
+    returns updl (time x rank), updr (rank x time)
+    """
+    if op is None:
+        return None, None
+
+    u, sv, vt = np.linalg.svd(op - baseop)
+    rank = int(np.sum(sv > tol * max(sv[0], np.finfo(np.float64).tiny)))
+
+    return u[:, :rank] * sv[:rank], vt[:rank, :]
+
+
+def open_nii_memmap(fname, outdir, outbase):
+    """
+    memory map the data of a nifti file. a .nii.gz cannot be mapped, so it is
+    first decompressed (streamed, never fully in memory) to outbase_input.nii
+    in outdir
+
+    returns the image, the unscaled (x, y, z, t) memmap, slope, inter, and the
+    name of the decompressed temp file (None if no decompressing was needed)
+    """
+    tmpname = None
+    if fname.endswith('.gz'):
+        tmpname = os.path.join(outdir, ''.join([os.path.basename(outbase), '_input.nii']))
+        print("decompressing {} to {} for memory mapping".format(fname, tmpname))
+        with gzip.open(fname, 'rb') as fin, open(tmpname, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+        fname = tmpname
+
+    img = nib.load(fname, mmap=True)
+    data = img.dataobj.get_unscaled()
+    if not isinstance(data, np.memmap):
+        print("could not memory map {}. exiting".format(fname))
+        exit(1)
+
+    slope = img.dataobj.slope
+    inter = img.dataobj.inter
+    if slope is None or not np.isfinite(slope) or slope == 0:
+        slope = 1.0
+    if inter is None or not np.isfinite(inter):
+        inter = 0.0
+
+    return img, data, slope, inter, tmpname
+
+
+def create_nii_memmap(fname, refimg, shape, dtype=np.float32):
+    """
+    make an (uncompressed) nifti file on disk with the geometry of refimg and
+    the given shape, filled with zeros, and return a writable memmap of its
+    data. nothing of the size of the image is ever held in memory
+    """
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_zooms(refimg.header.get_zooms()[:len(shape)])
+    hdr.set_xyzt_units(*refimg.header.get_xyzt_units())
+    hdr.set_qform(refimg.affine, int(refimg.header['qform_code']) or 1)
+    hdr.set_sform(refimg.affine, int(refimg.header['sform_code']) or 1)
+    hdr['vox_offset'] = 352
+
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(fname, 'wb') as f:
+        hdr.write_to(f)
+        # 4 bytes of (empty) extension flag up to the vox_offset
+        f.write(b'\0' * (352 - f.tell()))
+        # sparse zeros for the data
+        f.truncate(352 + nbytes)
+
+    return np.memmap(fname, dtype=dtype, mode='r+', offset=352,
+                     shape=tuple(shape), order='F')
+
+
+def nuisance_regress_chunked(inputfname, confoundsfile, inputmask, outname,
+    membudget=2048, inputtr=0, conftype="36P", spikethr=0.25, smoothkern=6.0,
+    discardvols=4, highpassval=0.008, lowpassval=0.08, confoundsjson='',
+    addregressors='', addlinear=False, addafterdetr=False, initdum=0,
+    fusedop=False, censor=False, censormincontig=0, dtype=np.float64):
+    """
+    same cleaning as nuisance_regress with a mask, but streaming: the input
+    is memory mapped, smoothed + masked in blocks of volumes into a (float32)
+    time x voxel temp file, which is then cleaned in blocks of voxels (the
+    regression, filtering and standardizing being independent per voxel) and
+    written to a memory mapped, uncompressed, float32 outname (.nii). the
+    blocks are sized so that the working memory stays around membudget MB,
+    whatever the size of the image. fusedop, censor, dtype: see
+    nuisance_regress
+
+    returns the (memory mapped) output image, confounds, outlier_stats
+    """
+    if inputmask is None:
+        print("chunked regression needs a mask. exiting")
+        exit(1)
+
+    outdir = os.path.dirname(os.path.abspath(outname))
+    outbase = outname.rsplit('.nii', 1)[0]
+    inputimg, indata, slope, inter, tmpinput = open_nii_memmap(inputfname, outdir, outbase)
+
+    with stage('confounds'):
+        confounds, outlier_stats, tr, highpassval, lowpassval, keep = \
+            get_clean_setup(inputimg, confoundsfile, inputtr=inputtr,
+                            conftype=conftype, spikethr=spikethr,
+                            highpassval=highpassval, lowpassval=lowpassval,
+                            confoundsjson=confoundsjson,
+                            addregressors=addregressors, addlinear=addlinear,
+                            initdum=initdum, censor=censor,
+                            censormincontig=censormincontig)
+        note_array('confounds', confounds.values)
+    fusedop = fusedop or censor or np.dtype(dtype) == np.float32
+    itemsize = np.dtype(dtype).itemsize
+
+    from nilearn.image import resample_to_img
+
+    # mask on the data grid, voxels in the (fortran) order of the file
+    maskimg = resample_to_img(inputmask, inputimg.slicer[..., 0], interpolation='nearest')
+    maskdat = np.asanyarray(maskimg.dataobj) != 0
+    maskidx = np.flatnonzero(maskdat.ravel(order='F'))
+    nvox = len(maskidx)
+    nvol = indata.shape[3]
+    budget = membudget * 1024 * 1024
+    print("chunked cleaning of {} voxels x {} volumes, budget {} MB".format(
+          nvox, nvol, membudget))
+
+    # pass 1: volumes -> (smoothed) masked time x voxel temp file
+    voxfname = ''.join([outbase, '_voxtmp.dat'])
+    voxts = np.memmap(voxfname, dtype=np.float32, mode='w+', shape=(nvol, nvox))
+    # ~ 3 copies of each volume while smoothing
+    volblock = int(max(1, budget // (maskdat.size * itemsize * 3)))
+    with stage('load, smooth, mask (volume blocks)'):
+        note_array('voxts', voxts)
+        for t0 in range(0, nvol, volblock):
+            t1 = min(nvol, t0 + volblock)
+            vols = np.asarray(indata[..., t0:t1], dtype=dtype) * slope + inter
+            if smoothkern:
+                vols = image.smooth_img(nib.Nifti1Image(vols, inputimg.affine),
+                                        smoothkern).get_fdata(dtype=dtype)
+            voxts[t0:t1, :] = vols.reshape((-1, t1 - t0), order='F')[maskidx, :].T
+            del vols
+        voxts.flush()
+
+    if fusedop:
+        with stage('temporal operator'):
+            op, detrop = get_temporal_operator(nvol, confounds, tr, highpassval,
+                                               lowpassval, addafterdetr=addafterdetr,
+                                               keep=keep)
+
+    # pass 2: blocks of voxels -> cleaned -> output file
+    outshape = indata.shape[:3] + (nvol - discardvols,)
+    outdata = create_nii_memmap(outname, inputimg, outshape)
+    out2d = outdata.reshape((-1, outshape[3]), order='F')
+    # ~ 6 copies of each voxel time series while cleaning
+    voxblock = int(max(1, budget // (nvol * itemsize * 6)))
+    with stage('regress, filter, write (voxel blocks)'):
+        for v0 in range(0, nvox, voxblock):
+            v1 = min(nvox, v0 + voxblock)
+            block = np.asarray(voxts[:, v0:v1], dtype=dtype)
+            if fusedop:
+                cleaned = apply_temporal_operator(op, block, detrop,
+                                                  discardvols=discardvols,
+                                                  keep=keep, dtype=dtype)
+            else:
+                cleaned = clean_timeseries(block, confounds, tr, highpassval,
+                                           lowpassval, addafterdetr=addafterdetr,
+                                           discardvols=discardvols)
+            out2d[maskidx[v0:v1], :] = cleaned.T
+            del block, cleaned
+        outdata.flush()
+
+    del voxts, outdata, out2d, indata
+    os.remove(voxfname)
+    if tmpinput is not None:
+        os.remove(tmpinput)
+
+    return nib.load(outname, mmap=True), confounds, outlier_stats
+
+
+def nuisance_regress_cifti(inputfname, confoundsfile, inputtr=0, conftype="36P",
+    spikethr=0.25, smoothkern=6.0, discardvols=4, highpassval=0.008,
+    lowpassval=0.08, confoundsjson='', addregressors='', addlinear=False,
+    addafterdetr=False, initdum=0, stdz=True, fusedop=False, censor=False,
+    censormincontig=0, dtype=np.float64, compcor='file', compcorn=5,
+    compcorpct=2.):
+    """
+    the cleaning of nuisance_regress for a cifti dtseries (see cifti.py), on
+    its time x grayordinates array: no mask, and no smoothing. the tr comes
+    from the series axis if not given. compcor: highvar only, from the
+    grayordinates
+
+    returns the cleaned dtseries image, confounds, outlier_stats
+    """
+    with stage('load'):
+        inputimg, time_series, seriestr = load_dtseries(inputfname, dtype=dtype)
+        note_array('time_series', time_series)
+    if inputtr == 0:
+        inputtr = seriestr
+        print("found that tr is: {}".format(str(inputtr)))
+    if smoothkern:
+        print("not smoothing the cifti data (that needs the surfaces)")
+
+    compcorconf = None
+    if compcor == 'mask':
+        print("-compcor mask needs a volume. exiting")
+        exit(1)
+    elif compcor == 'highvar':
+        with stage('compcor'):
+            series = compcor_series(time_series.T[:, None, None, :],
+                                    np.ones((time_series.shape[1], 1, 1), dtype=bool),
+                                    compcorpct)
+            compcorconf = pd.DataFrame(compcor_components(series, compcorn),
+                                       columns=['t_comp_cor_{:0>2}'.format(n)
+                                                for n in range(compcorn)])
+            del series
+
+    with stage('confounds'):
+        confounds, outlier_stats, tr, highpassval, lowpassval, keep = \
+            get_clean_setup(inputimg, confoundsfile, inputtr=inputtr,
+                            conftype=conftype, spikethr=spikethr,
+                            highpassval=highpassval, lowpassval=lowpassval,
+                            confoundsjson=confoundsjson,
+                            addregressors=addregressors, addlinear=addlinear,
+                            initdum=initdum, censor=censor,
+                            censormincontig=censormincontig,
+                            compcor=compcorconf)
+        note_array('confounds', confounds.values)
+
+    if fusedop or censor or np.dtype(dtype) == np.float32:
+        print("cleaning grayordinates with fused temporal operator")
+        with stage('temporal operator'):
+            op, detrop = get_temporal_operator(time_series.shape[0], confounds, tr,
+                                               highpassval, lowpassval,
+                                               addafterdetr=addafterdetr,
+                                               keep=keep)
+        with stage('regress, filter (fused operator)'):
+            time_series = apply_temporal_operator(op, time_series, detrop, stdz=stdz,
+                                                  discardvols=discardvols,
+                                                  keep=keep, dtype=dtype)
+    else:
+        print("cleaning grayordinates")
+        with stage('regress, filter'):
+            time_series = clean_timeseries(time_series, confounds, tr, highpassval,
+                                           lowpassval, addafterdetr=addafterdetr,
+                                           discardvols=discardvols, stdz=stdz)
+
+    return dtseries_img(time_series, inputimg, discardvols), confounds, outlier_stats
+
+
+def read_confounds(confounds_file):
+    """
+    the confounds table, from a fmriprep confounds tsv, or as is if it is
+    already a DataFrame
+    """
+    if isinstance(confounds_file, pd.DataFrame):
+        return confounds_file
+
+    return pd.read_csv(confounds_file, sep="\t")
+
+
+def get_censor_frames(confounds_file, threshold, mincontig=0):
+    """
+    the frames to keep when censoring (scrubbing) instead of spike
+    regressing: frames with framewise displacement over threshold (the same
+    ones get_spikereg_confounds flags) are censored, and so are any runs of
+    kept frames shorter than mincontig
+
+    returns a boolean array, True for the frames to keep
+    """
+    df = read_confounds(confounds_file)
+    if 'FramewiseDisplacement' in df:
+        framewisecol = 'FramewiseDisplacement'
+    else:
+        framewisecol = 'framewise_displacement'
+
+    keep = ~(df[framewisecol].fillna(0).values > threshold)
+
+    if mincontig > 1:
+        # starts and stops of the runs of kept frames
+        edges = np.diff(np.concatenate(([0], keep.astype(int), [0])))
+        for start, stop in zip(np.flatnonzero(edges == 1),
+                               np.flatnonzero(edges == -1)):
+            if stop - start < mincontig:
+                keep[start:stop] = False
+
+    if np.sum(keep) < 2:
+        print("censoring leaves less than 2 frames. exiting")
+        exit(1)
+
+    return keep
+
+
 def get_spikereg_confounds(motion_ts, threshold):
     """
     motion_ts = [0.1, 0.7, 0.2, 0.6, 0.3]
@@ -182,9 +827,72 @@ def get_spikereg_confounds(motion_ts, threshold):
     return outliers, outlier_stats
 
 
+def confound_names(columns):
+    """
+    the names of the confound columns of a fmriprep confounds table, old
+    (CamelCase) or new (snake_case), from its columns: a dict of style,
+    p6cols, p9cols, globalsignalcol, compcorregex, framewisecol. None if
+    neither
+    """
+    if 'GlobalSignal' in columns:
+        # imgsignals = ['CSF', 'WhiteMatter', 'GlobalSignal']
+        return {'style': 'old',
+                'p6cols': ['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ'],
+                'p9cols': ['CSF', 'WhiteMatter', 'GlobalSignal', 'X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ'],
+                'globalsignalcol': ['GlobalSignal'],
+                'compcorregex': 'aCompCor',
+                'framewisecol': 'FramewiseDisplacement'}
+
+    elif 'global_signal' in columns:
+        # imgsignals = ['csf', 'white_matter', 'global_signal']
+        return {'style': 'new',
+                'p6cols': ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'],
+                'p9cols': ['csf', 'white_matter', 'global_signal', 'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'],
+                'globalsignalcol': ['global_signal'],
+                'compcorregex': 'a_comp_cor_',
+                'framewisecol': 'framewise_displacement'}
+
+    return None
+
+
+def compcor_names(columns, compcorregex, confounds_json=''):
+    """
+    the compcor columns that get_confounds uses: all of them if there are 10
+    or fewer, else the 5 'combined' ones with the most variance explained in
+    the confounds json, or, without the json, the first five
+    """
+    compcols = [col for col in columns if re.search(compcorregex, col)]
+    if len(compcols) <= 10:
+        return compcols
+
+    # if the confounds json is available, read the variance explained
+    # from the 'combined' 'Mask' components, and use top 5 of those
+    if confounds_json:
+        # read the confounds json
+        with open(confounds_json, 'r') as json_file:
+            confjson = json.load(json_file)
+        print('read confounds json')
+
+        # initalize lists
+        combokeys = []
+        varex = []
+        for key in confjson:
+            if 'Mask' in confjson[key].keys():
+                if confjson[key]['Mask'] == 'combined':
+                    combokeys.append(key)
+                    varex.append(confjson[key]['VarianceExplained'])
+
+        # get the sort based on variance explained
+        sortvar = np.argsort(varex)
+        return [combokeys[i] for i in sortvar[-5:]]
+
+    # if there are more than 5 columns, take only the first five components
+    return [(''.join([compcorregex, "{:0>2}".format(n)])) for n in range(0, 5)]
+
+
 def get_confounds(confounds_file, kind="36P", spikereg_threshold=None, 
                   confounds_json='', dctbasis=False, addreg='', initdum=0,
-                  addlin=False):
+                  addlin=False, censor=False, compcor=None):
     """
     takes a fmriprep confounds file and creates data frame with regressors.
     kind == "36P" returns Satterthwaite's 36P confound regressors
@@ -195,6 +903,12 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None,
     kind == "24aCompCorGsr"* returns model no. 9 from Parkes
 
     if spikereg_threshold=None, no spike regression is performed
+    if censor, the spike regressors are left out (the frames over
+    spikereg_threshold get censored instead, see get_censor_frames), but
+    the outlier stats are still counted
+    if compcor (a data frame of components, see get_compcor.py), they are
+    the compcor columns of the compcor kinds, instead of those of the file,
+    and are added to the other kinds
 
     Satterthwaite, T. D., Elliott, M. A., Gerraty, R. T., Ruparel, K., 
     Loughead, J., Calkins, M. E., et al. (2013). An improved framework for 
@@ -211,32 +925,19 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None,
     if kind not in NUSCHOICES:
         raise Exception("Confound type unknown {}".format(kind))
 
-    df = pd.read_csv(confounds_file, sep="\t")
+    df = read_confounds(confounds_file)
 
     # check if old/new confound names
-    p6cols = ''
-    p9cols = ''
-    if 'GlobalSignal' in df:
-        print("detected old confounds names")
-        # imgsignals = ['CSF', 'WhiteMatter', 'GlobalSignal']
-        p6cols = ['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']
-        p9cols = ['CSF', 'WhiteMatter', 'GlobalSignal', 'X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']
-        globalsignalcol = ['GlobalSignal']
-        compCorregex = 'aCompCor'
-        framewisecol = 'FramewiseDisplacement'
-
-    elif 'global_signal' in df:
-        print("detected new confounds names")
-        # imgsignals = ['csf', 'white_matter', 'global_signal']
-        p6cols = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
-        p9cols = ['csf', 'white_matter', 'global_signal', 'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
-        globalsignalcol = ['global_signal']
-        compCorregex = 'a_comp_cor_'
-        framewisecol = 'framewise_displacement'
-
-    else:
+    names = confound_names(df.columns)
+    if names is None:
         print("trouble reading necessary columns from confounds file. exiting")
         exit(1)
+    print("detected {} confounds names".format(names['style']))
+    p6cols = names['p6cols']
+    p9cols = names['p9cols']
+    globalsignalcol = names['globalsignalcol']
+    compCorregex = names['compcorregex']
+    framewisecol = names['framewisecol']
 
     # extract nusiance regressors for movement + signal
     p6 = df[p6cols]
@@ -285,38 +986,15 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None,
     else:
         # then we grab compcor stuff
         # get compcor nuisance regressors and combine with 12P
-        aCompC = df.filter(regex=compCorregex)
-        if aCompC.empty:
-            print("could not find compcor columns. exiting")
-            exit(1)
-        elif aCompC.shape[1] > 10:
-
-            # if the confounds json is available, read the variance explained
-            # from the 'combined' 'Mask' components, and use top 5 of those
-            if confounds_json:
-                # read the confounds json
-                with open(confounds_json, 'r') as json_file:
-                    confjson = json.load(json_file)
-                print('read confounds json')
-
-                # initalize lists
-                combokeys = []
-                varex = []
-                for key in confjson:
-                    if 'Mask' in confjson[key].keys():
-                        if confjson[key]['Mask'] == 'combined':
-                            combokeys.append(key)
-                            varex.append(confjson[key]['VarianceExplained'])
-
-                # get the sort based on variance explained
-                sortvar = np.argsort(varex)
-                aCCcolnames = [combokeys[i] for i in sortvar[-5:]]
-                aCompC = aCompC[aCCcolnames]
-
-            else:
-                # if there are more than 5 columns, take only the first five components
-                aCCcolnames = [(''.join([compCorregex, "{:0>2}".format(n)])) for n in range(0, 5)]
-                aCompC = aCompC[aCCcolnames]
+        if compcor is not None:
+            # made from the image
+            aCompC = compcor
+        else:
+            aCCcolnames = compcor_names(df.columns, compCorregex, confounds_json)
+            if not aCCcolnames:
+                print("could not find compcor columns. exiting")
+                exit(1)
+            aCompC = df[aCCcolnames]
 
         p12aCompC = pd.concat((p12, aCompC), axis=1)
         p24aCompC = pd.concat((p12, p12_2, aCompC), axis=1)
@@ -341,6 +1019,10 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None,
     elif kind == "linear" : # it is "linear"
         confounds = pd.DataFrame(list(range(1, df.shape[0]+1)))
 
+    # compcor components from the image, to a non compcor kind
+    if compcor is not None and 'CompCor' not in kind:
+        confounds = pd.concat([confounds, compcor], axis=1)
+
     if spikereg_threshold:
         threshold = spikereg_threshold
     else:
@@ -368,16 +1050,19 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None,
 
     outliers, outlier_stats = get_spikereg_confounds(df[framewisecol].values, threshold)
 
-    if spikereg_threshold:
+    if spikereg_threshold and not censor:
         confounds = pd.concat([confounds, outliers], axis=1)
 
     return confounds, outlier_stats
 
 
-def main():
-
-    parser = argparse.ArgumentParser(description='nusiance regression')
-    parser.add_argument('fmri', type=str, help='input fmri to be denoised')
+def add_regress_args(parser):
+    """
+    adds the nuisance regression options (everything but -out) to an
+    argparse parser, so that other entry points can share them
+    """
+    parser.add_argument('fmri', type=str, help='input fmri to be denoised (nifti, or cifti '
+                        '.dtseries.nii, see cifti.py)')
     parser.add_argument('confounds', type=str, help='input confounds file (from fmriprep)')
     parser.add_argument('-mask', type=str, help='input mask in same space as fmri',
                         default=None)
@@ -397,16 +1082,266 @@ def main():
                         default=0.08)
     parser.add_argument('-confjson', type=str, help='confound json file, output by newer version of fmriprep',
                         default=None)
-    parser.add_argument('-out', type=str, help='ouput base name',
-                        default='output')
     parser.add_argument('-add_regressors', type=str, help='add these regressors')
     parser.add_argument('-add_linear', action="store_true", help='add linear trend to confound regression')
     parser.add_argument('-add_detrend_after', action="store_true", help='add detrend after conf regression ')
     parser.add_argument('-initaldummy', type=int, help='add x regressors to beginning of data',
                         choices=range(1, 50))
+    parser.add_argument('-censor', action="store_true", help='censor the frames over -spikethr instead of '
+                        'adding a spike regressor for each (interpolated for the filtering, and listed in '
+                        '_censor.csv, to drop before making matrices)')
+    parser.add_argument('-censormincontig', type=int, help='with -censor, also censor runs of kept '
+                        'frames shorter than this', default=0)
+    parser.add_argument('-fusedop', action="store_true", help='do the regression + filtering as one '
+                        'precomputed time x time matrix multiply')
+    parser.add_argument('-chunked', action="store_true", help='stream the regression through memory '
+                        'mapped files, in blocks of voxels, writing an uncompressed _nuisance.nii '
+                        '(needs -mask)')
+    parser.add_argument('-membudget', type=float, help='working memory (MB) for the blocks of -chunked',
+                        default=2048)
+    parser.add_argument('-dtype', type=str, help='precision of the voxel data; float32 halves the memory '
+                        '(and goes by way of -fusedop)', choices=['float64', 'float32'], default='float64')
+    parser.add_argument('-compcor', type=str, help='where the compcor components come from: the '
+                        'confounds file, or made from the image, from the voxels of -compcormask '
+                        '(aCompCor) or the highest variance voxels of -mask (tCompCor). see '
+                        'get_compcor.py', choices=COMPCORCHOICES, default='file')
+    parser.add_argument('-compcormask', type=str, help='mask of the -compcor mask voxels (e.g. white '
+                        'matter + csf)', default=None)
+    parser.add_argument('-compcorn', type=int, help='number of -compcor components', default=5)
+    parser.add_argument('-compcorpct', type=float, help='percent of highest variance voxels for '
+                        '-compcor highvar', default=2.)
+
+
+def regress_from_args(args, outbase, setup=None):
+    """
+    load the inputs named in parsed args and run nuisance_regress on them.
+    with args.chunked, the cleaned image is streamed to outbase_nuisance.nii
+    (and returned memory mapped). a cifti fmri goes to nuisance_regress_cifti.
+    setup: the get_clean_setup outputs, if made already (see nuisance_regress,
+    not used for -chunked or a cifti)
+    """
+    if is_cifti(args.fmri):
+        if args.chunked:
+            print("-chunked does not go with a cifti fmri. exiting")
+            exit(1)
+        return nuisance_regress_cifti(args.fmri, args.confounds,
+                                      inputtr=args.tr,
+                                      conftype=args.strategy,
+                                      spikethr=args.spikethr,
+                                      smoothkern=args.fwhm,
+                                      discardvols=args.discardvols,
+                                      highpassval=args.highpass,
+                                      lowpassval=args.lowpass,
+                                      confoundsjson=args.confjson,
+                                      addregressors=args.add_regressors,
+                                      addlinear=args.add_linear,
+                                      addafterdetr=args.add_detrend_after,
+                                      initdum=args.initaldummy,
+                                      fusedop=args.fusedop,
+                                      censor=args.censor,
+                                      censormincontig=args.censormincontig,
+                                      dtype=args.dtype,
+                                      compcor=args.compcor,
+                                      compcorn=args.compcorn,
+                                      compcorpct=args.compcorpct)
+
+    if args.mask is not None:
+        inputMask = nib.load(args.mask)
+    else:
+        inputMask = None
+
+    if args.chunked:
+        if args.compcor != 'file':
+            print("-compcor {} does not go with -chunked. exiting".format(args.compcor))
+            exit(1)
+        return nuisance_regress_chunked(args.fmri, args.confounds, inputMask,
+                                        ''.join([outbase, '_nuisance.nii']),
+                                        membudget=args.membudget,
+                                        inputtr=args.tr,
+                                        conftype=args.strategy,
+                                        spikethr=args.spikethr,
+                                        smoothkern=args.fwhm,
+                                        discardvols=args.discardvols,
+                                        highpassval=args.highpass,
+                                        lowpassval=args.lowpass,
+                                        confoundsjson=args.confjson,
+                                        addregressors=args.add_regressors,
+                                        addlinear=args.add_linear,
+                                        addafterdetr=args.add_detrend_after,
+                                        initdum=args.initaldummy,
+                                        fusedop=args.fusedop,
+                                        censor=args.censor,
+                                        censormincontig=args.censormincontig,
+                                        dtype=args.dtype)
+
+    # read in the data
+    inputImg = nib.load(args.fmri)
+    compcorMask = nib.load(args.compcormask) if args.compcormask else None
+
+    # call nuisance regress, get a nib Nifti1Image
+    return nuisance_regress(inputImg, args.confounds,
+                            inputmask=inputMask,
+                            inputtr=args.tr,
+                            conftype=args.strategy,
+                            spikethr=args.spikethr,
+                            smoothkern=args.fwhm,
+                            discardvols=args.discardvols,
+                            highpassval=args.highpass,
+                            lowpassval=args.lowpass,
+                            confoundsjson=args.confjson,
+                            addregressors=args.add_regressors,
+                            addlinear=args.add_linear,
+                            addafterdetr=args.add_detrend_after,
+                            initdum=args.initaldummy,
+                            fusedop=args.fusedop,
+                            censor=args.censor,
+                            censormincontig=args.censormincontig,
+                            dtype=args.dtype,
+                            compcor=args.compcor,
+                            compcormask=compcorMask,
+                            compcorn=args.compcorn,
+                            compcorpct=args.compcorpct,
+                            setup=setup)
+
+
+def roi_clean_from_args(args, stdz=True):
+    """
+    for the roi-first mode: set up the cleaning named in parsed args once
+    (confounds, tr, filter) and return a function that does that cleaning to
+    a time x signals array (the region signals), plus confounds and
+    outlier_stats. the cleaning being linear in time, regressing the region
+    averages is the same as averaging the regressed voxels, minus the voxel
+    standardizing. no smoothing though, that has to happen to the voxels
+    """
+    if args.fwhm:
+        print("roi-first cleaning cannot smooth, use -fwhm 0. exiting")
+        exit(1)
+
+    confounds, outlier_stats, tr, highpassval, lowpassval, keep = \
+        get_clean_setup(nib.load(args.fmri), args.confounds,
+                        inputtr=args.tr,
+                        conftype=args.strategy,
+                        spikethr=args.spikethr,
+                        highpassval=args.highpass,
+                        lowpassval=args.lowpass,
+                        confoundsjson=args.confjson,
+                        addregressors=args.add_regressors,
+                        addlinear=args.add_linear,
+                        initdum=args.initaldummy,
+                        censor=args.censor,
+                        censormincontig=args.censormincontig)
+
+    if args.censor:
+        op, detrop = get_temporal_operator(len(keep), confounds, tr,
+                                           highpassval, lowpassval,
+                                           addafterdetr=args.add_detrend_after,
+                                           keep=keep)
+
+        def cleanfunc(time_series):
+            return apply_temporal_operator(op, np.array(time_series, dtype=np.float64),
+                                           detrop, stdz=stdz,
+                                           discardvols=args.discardvols,
+                                           keep=keep)
+
+        return cleanfunc, confounds, outlier_stats
+
+    def cleanfunc(time_series):
+        return clean_timeseries(time_series, confounds, tr, highpassval,
+                                lowpassval, addafterdetr=args.add_detrend_after,
+                                discardvols=args.discardvols, stdz=stdz)
+
+    return cleanfunc, confounds, outlier_stats
+
+
+def censor_from_args(args):
+    """
+    the frames kept by -censor, minus the discarded volumes (so, lined up
+    with the cleaned image), or None if not censoring
+    """
+    if not args.censor:
+        return None
+
+    keep = get_censor_frames(args.confounds, args.spikethr, args.censormincontig)
+    return keep[args.discardvols:]
+
+
+def save_censor(keep, outbase):
+
+    pd.DataFrame({'keep': keep.astype(int)}).to_csv(''.join([outbase, '_censor.csv']),
+                                                    index=False)
+
+
+def save_nuisance_img(nrimg, outbase, background=False, outformat='nii.gz', outdtype=None,
+                      nthreads=1):
+    """
+    write the cleaned image to outbase_nuisance.nii.gz (or .nii, or not at
+    all, see niiwrite.py for outformat, outdtype, nthreads; a cifti goes to
+    outbase_nuisance.dtseries.nii). with
+    background=True the write happens in a thread that is returned, so that
+    the caller can keep working on the in-memory image and join() it at the
+    end
+    """
+    if outformat == 'none':
+        return None
+    if is_cifti(nrimg):
+        # always .dtseries.nii
+        outname = ''.join([outbase, '_nuisance.dtseries.nii'])
+        writefunc = save_dtseries
+        writeargs = {'outdtype': outdtype}
+    else:
+        outname = ''.join([outbase, '_nuisance.', outformat])
+        writefunc = write_nifti
+        writeargs = {'outformat': outformat, 'outdtype': outdtype, 'nthreads': nthreads}
+    if not background:
+        with stage('write cleaned image'):
+            writefunc(nrimg, outname, **writeargs)
+        return None
+
+    print("writing {} in background".format(outname))
+    writer = threading.Thread(target=writefunc, args=(nrimg, outname), kwargs=writeargs)
+    writer.start()
+    return writer
+
+
+def save_outlier_stats(outldf, outdfstat, outbase):
+
+    outldf.to_csv(''.join([outbase, '_outlierdf.csv']))
+    outdfstat.to_csv(''.join([outbase, '_outlierstat.csv']))
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(description='nusiance regression')
+    add_regress_args(parser)
+    add_write_args(parser)
+    parser.add_argument('-out', type=str, help='ouput base name',
+                        default='output')
+    parser.add_argument('-profile', type=str, help='write a json report of the time, cpu, memory '
+                        'and i/o of each stage here (see profiling.py)', default=None)
+
+    return parser
+
+
+def run_regress(args):
+    """
+    the regression and its outputs for parsed get_parser args
+    """
+    with report(args.profile):
+        nrImg, outldf, outdfstat = regress_from_args(args, args.out)
+
+        # write it (chunked has already)
+        if not args.chunked:
+            save_nuisance_img(nrImg, args.out, outformat=args.outformat,
+                              outdtype=args.outdtype, nthreads=args.writethreads)
+        save_outlier_stats(outldf, outdfstat, args.out)
+        if args.censor:
+            save_censor(censor_from_args(args), args.out)
+
+
+def main():
 
     # parse
-    args = parser.parse_args()
+    args = get_parser().parse_args()
 
     # print the args
     print("\nARGS: ")
@@ -414,34 +1349,7 @@ def main():
         print("{} {}".format(str(arg), str(getattr(args, arg))))
     print("END ARGS\n")
 
-    # read in the data
-    inputImg = nib.load(args.fmri)
-
-    if args.mask is not None:
-        inputMask = nib.load(args.mask)
-    else:
-        inputMask = None
-
-    # call nuisance regress, get a nib Nifti1Image
-    nrImg, outldf, outdfstat = nuisance_regress(inputImg, args.confounds,
-                                                inputmask=inputMask, 
-                                                inputtr=args.tr,
-                                                conftype=args.strategy,
-                                                spikethr=args.spikethr,
-                                                smoothkern=args.fwhm,
-                                                discardvols=args.discardvols,
-                                                highpassval=args.highpass,
-                                                lowpassval=args.lowpass,
-                                                confoundsjson=args.confjson,
-                                                addregressors=args.add_regressors,
-                                                addlinear=args.add_linear,
-                                                addafterdetr=args.add_detrend_after,
-                                                initdum=args.initaldummy)
-
-    # write it
-    nib.save(nrImg, ''.join([args.out, '_nuisance.nii.gz']))
-    outldf.to_csv(''.join([args.out, '_outlierdf.csv']))
-    outdfstat.to_csv(''.join([args.out, '_outlierstat.csv']))
+    run_regress(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+the stage cache of pipeline.py -stagecache: each stage of a run (the
+confound design, the cleaned data, the region time series of each parc, each
+kind of matrix of each parc) is kept in a diskcache.py directory under a key
+made from the content of its inputs and the parameters that matter to it,
+chained (the key of the cleaned data includes the key of the confounds, the
+key of the time series that of the cleaned data, and so on). a re-run only
+does the stages whose key is not there: adding a parc skips the regression,
+adding a -type only makes the matrices of the new kind, and a run that
+failed after the regression picks up from the cleaned data
+
+the inputs are keyed by their content, not their name. the hash of a big
+file is remembered (in filehashes.json in the cache) by its path, size and
+modification time, so it is read only once. STAGEVERSIONS go into the keys,
+bump one when the code of that stage changes what it makes
+
+@author: jfaskowi
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+from lazyimport import lazy_import
+
+from diskcache import hash_parts, cache_get, cache_put
+
+# imported on first use, see lazyimport.py
+pd = lazy_import('pandas')
+
+STAGEVERSIONS = {'confounds': 1, 'cleaned': 2, 'timeseries': 1, 'matrices': 2}
+
+
+def hash_file(fname, cachedir=None, blocksize=1 << 24):
+    """
+    sha1 of the content of a file (None if fname is empty / None), remembered
+    in cachedir by path, size and mtime
+    """
+    if not fname:
+        return None
+
+    st = os.stat(fname)
+    stamp = [st.st_size, st.st_mtime_ns]
+    fullname = os.path.abspath(fname)
+
+    known = {}
+    indexname = None
+    if cachedir is not None:
+        indexname = os.path.join(cachedir, 'filehashes.json')
+        try:
+            with open(indexname, 'r') as f:
+                known = json.load(f)
+        except (IOError, ValueError):
+            known = {}
+        if fullname in known and known[fullname][:2] == stamp:
+            return known[fullname][2]
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    digest = h.hexdigest()
+
+    if indexname is not None:
+        known[fullname] = stamp + [digest]
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(known, f)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, indexname)
+
+    return digest
+
+
+def stage_key(stage, *parts):
+    """
+    the cache key of a stage, from its (hashes of) inputs and parameters
+    """
+    return '_'.join([stage, hash_parts(stage, STAGEVERSIONS[stage], *parts)])
+
+
+def df_to_arrays(df, prefix):
+    """
+    the columns (and index) of a data frame as a dict of arrays, for
+    cache_put
+    """
+    arrays = {''.join([prefix, 'columns']): np.array([str(c) for c in df.columns]),
+              ''.join([prefix, 'index']): np.asarray(df.index)}
+    for n, col in enumerate(df.columns):
+        arrays['{}col{}'.format(prefix, n)] = np.asarray(df[col])
+
+    return arrays
+
+
+def arrays_to_df(arrays, prefix):
+    """
+    the data frame of df_to_arrays
+    """
+    columns = arrays[''.join([prefix, 'columns'])]
+    data = {col: arrays['{}col{}'.format(prefix, n)] for n, col in enumerate(columns)}
+
+    return pd.DataFrame(data, columns=list(columns), index=arrays[''.join([prefix, 'index'])])
+
+
+def get_stage(cachedir, key):
+    """
+    cache_get, saying so
+    """
+    cached = cache_get(cachedir, key)
+    if cached is not None:
+        print("using cached {}".format(key))
+
+    return cached
+
+
+def put_stage(cachedir, key, arrays, maxsize=None):
+    """
+    cache_put, saying so
+    """
+    print("caching {}".format(key))
+    cache_put(cachedir, key, arrays, maxsize=maxsize)
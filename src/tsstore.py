@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+the region time series store of makemat.py -savetimeseries: one hdf5 file
+per parc, with
+
+    timeseries  frames x regions, float32, chunked + compressed, so that a
+                few regions or a range of frames can be read without
+                decompressing the rest
+    regionids   the label id of each column
+
+read_timeseries / read_group_timeseries read selected regions and frames of
+one or many subjects. the bids-style tsv.gz (one ROI_<id> column for every
+id up to the largest, zeros for the ids not in the parc) + json is written
+on demand only (makemat.py -savetsv), or from a store afterwards:
+
+    tsstore.py export <out_parc_timeseries.hdf5 files>
+
+@author: jfaskowi
+
+"""
+
+import json
+import argparse
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+pd = lazy_import('pandas')
+h5py = lazy_import('h5py')
+
+
+def save_timeseries(fname, timeseries, regions):
+    """
+    write a frames x regions array and its region ids to fname (.hdf5)
+    """
+    timeseries = np.asarray(timeseries, dtype=np.float32)
+    # ~64k chunks, a block of frames x a block of regions
+    chunks = (max(1, min(timeseries.shape[0], 256)),
+              max(1, min(timeseries.shape[1], 64)))
+
+    with h5py.File(fname, 'w') as h5f:
+        h5f.create_dataset('timeseries', data=timeseries, chunks=chunks,
+                           compression='gzip', compression_opts=4,
+                           shuffle=True)
+        h5f.create_dataset('regionids', data=np.asarray(regions))
+
+
+def read_timeseries(fname, regions=None, frames=None):
+    """
+    read the time series of a store, only the regions (label ids) and frames
+    (a slice) asked for, all by default. regions not in this store come back
+    as nan columns
+
+    returns the frames x regions array and the region ids
+    """
+    if frames is None:
+        frames = slice(None)
+
+    with h5py.File(fname, 'r') as h5f:
+        dset = h5f['timeseries']
+        regionids = h5f['regionids'][()]
+        if regions is None:
+            return dset[frames, :], regionids
+
+        regions = np.asarray(regions)
+        colof = {r: n for n, r in enumerate(regionids)}
+        cols = np.array([colof.get(r, -1) for r in regions])
+        present = np.flatnonzero(cols >= 0)
+
+        nframes = len(range(*frames.indices(dset.shape[0])))
+        out = np.full((nframes, len(regions)), np.nan, dtype=dset.dtype)
+        if len(present):
+            # h5py wants increasing, unique column indices
+            readcols, inverse = np.unique(cols[present], return_inverse=True)
+            out[:, present] = dset[frames, list(readcols)][:, inverse]
+
+    return out, regions
+
+
+def read_group_timeseries(fnames, regions=None, frames=None):
+    """
+    read_timeseries for many subjects. with regions given, every subject
+    comes back with the same columns (nan where missing)
+
+    returns a list of frames x regions arrays (np.stack them if the
+    subjects have the same number of frames)
+    """
+    return [read_timeseries(fname, regions, frames)[0] for fname in fnames]
+
+
+def write_tsv(outbase, timeseries, regions):
+    """
+    the bids-style outbase.tsv.gz, with a ROI_<id> column for each id from 1
+    to the largest (zeros for the ids not in regions), and outbase.json
+    """
+    regions = np.asarray(regions)
+
+    # make full size matrix
+    nogaptimeseries = np.zeros([ timeseries.shape[0], np.max(regions) ],
+                               dtype=timeseries.dtype)
+    nogaptimeseries[:,([x-1 for x in regions])] = timeseries
+    # make list of missing regions
+    presentregs = np.zeros(np.max(regions),dtype=int)
+    presentregs[([x-1 for x in regions])] = 1
+
+    # new timeseries datatype
+    tsdf = pd.DataFrame(nogaptimeseries, columns=[(''.join(['ROI_{}'.format(n)]))
+                                        for n in range(1,np.max(regions)+1) ],
+                        )
+    tsdf.to_csv(''.join([outbase, '.tsv.gz']), sep='\t', index=False, compression='gzip')
+
+    # and the json
+    tsjson = []
+    for n in range(1,np.max(regions)+1):
+        tsjson.append({'column_name': ''.join(['ROI_{}'.format(n)]),
+                       'label_index': str(n),
+                       'in_parc': int(presentregs[n-1]),
+                       })
+
+    with open(''.join([outbase, '.json']),'w') as writejson:
+        json.dump(tsjson, writejson)
+
+
+def export_tsv(fname):
+    """
+    write_tsv of a store, next to it (same name, .tsv.gz + .json)
+    """
+    timeseries, regionids = read_timeseries(fname)
+    write_tsv(fname.rsplit('.hdf5', 1)[0], timeseries, regionids)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='time series store tools')
+    subparsers = parser.add_subparsers(dest='command')
+    exportparser = subparsers.add_parser('export', help='write the bids-style tsv.gz + json of stores')
+    exportparser.add_argument('stores', nargs='+', help='_timeseries.hdf5 files')
+
+    # parse
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        exit(1)
+
+    for fname in args.stores:
+        print("exporting {}".format(fname))
+        export_tsv(fname)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,737 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+check, on your own data, that a faster path gives the same answer as the
+plain path it replaces
+
+    verify.py roifirst <pipeline.py args, with -fwhm 0 -space data>
+
+        cleaning the region signals (pipeline.py -roifirst) versus cleaning
+        every voxel and then averaging (regress.py -> makemat.py). confound
+        regression, filtering and detrending are linear in time, so they
+        commute with the averaging over a region and the two should agree to
+        floating point precision. the one step that does not commute is the
+        standardizing of each voxel before averaging (it weights the voxels
+        by 1 / their std), so it is left out of both sides of the check; how
+        much it changes the matrices is printed for information
+
+    verify.py fusedop <regress.py args>
+
+        regress.py -fusedop (the regression + filtering as one precomputed
+        time x time matrix) versus the separate nilearn passes, comparing the
+        cleaned images and timing both. nilearn's butterworth filter (filtfilt
+        on b, a coefficients) is itself only linear to ~1e-9 of the signal
+        scale, which the standardizing blows up to ~1e-6, so the default
+        -tol here is looser. not with -censor, which always goes by way of
+        the fused operator (see censor)
+
+    verify.py censor <regress.py args, with a -mask>
+
+        the censored cleaning (regress.py -censor, get_censored_operator as
+        one time x time matrix) versus the same steps done directly on the
+        masked voxels: the confounds fit on the kept frames and regressed
+        out, the censored frames filled in by linear interpolation (np.interp)
+        from the kept ones, the nilearn filter, the detrend after and the
+        standardizing on the kept frames. same -tol caveat as fusedop
+
+    verify.py fanout <pipeline.py args, with -space data -strategies ...>
+
+        the region signals of each strategy from the one-load fan-out
+        (pipeline.py -strategies) versus a regress.py -> makemat.py run per
+        strategy. same -tol caveat as fusedop
+
+    verify.py dtype <pipeline.py args, with -space data>
+
+        -dtype float32 versus float64 (both by way of the fused operator),
+        from the image as stored to the matrices, printing the time and the
+        peak (numpy, tracemalloc) memory of each. float32 carries ~7
+        significant digits, so the default -tol is looser still
+
+    verify.py fusedopspeed [-nvols 200 600 1200] [-nvox 20000 100000]
+
+        times the two on random data (no images needed) for a table of
+        volumes x voxels, to see the speedup for typical runs
+
+    verify.py connspeed [-nrois 1000 3000] [-nvols 1200]
+
+        the connectivity engine (connectivity.py, all -type kinds from one
+        gram matrix) versus nilearn's ConnectivityMeasure one kind at a time,
+        on random data, timing both (ledoit-wolf, as nilearn)
+
+    verify.py dynspeed [-nrois 100 400] [-nvols 1200] [-width 60] [-step 1]
+
+        the sliding-window correlations (makemat.py -dynwindow, running sums
+        updated as the window moves, see dynconn.py) versus a fresh weighted
+        correlation of every window, on random data, timing both, for each
+        taper
+
+    verify.py compcor [-nvox 50000 200000] [-nvols 600] [-pct 2 20]
+
+        the compcor components of regress.py -compcor highvar (block-wise
+        variances, randomized svd for long runs, see get_compcor.py) versus
+        nilearn's high_variance_confounds, on a random low rank + noise
+        image, timing both. the components are compared as subspaces
+        (the difference is 1 - the cosine of the largest principal angle
+        between them), since their signs and, for close singular values,
+        their order can differ
+
+    verify.py groupagg [-nsubjects 200] [-nrois 100 400] [-nprocs 2]
+
+        the streamed group stats (groupagg.py: welford sums, one subject at
+        a time, in -nprocs shards that are merged) versus nanmean / nanvar
+        of all the subjects stacked in memory, on random matrix files with
+        some regions missing from some subjects, timing both
+
+the checks exit 1 if the largest difference is over -tol
+
+@author: jfaskowi
+
+"""
+
+import time
+import argparse
+import tracemalloc
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from nilearn import signal, input_data
+from nilearn.masking import apply_mask
+from regress import add_regress_args, nuisance_regress, roi_clean_from_args, \
+    clean_timeseries, get_temporal_operator, apply_temporal_operator, get_clean_setup
+from connectivity import KINDS, connectivity, cov_to_corr
+from dynconn import TAPERS, sliding_window_conn, read_dynconn
+from makemat import add_makemat_args, extract_mats, mats_from_region_signals
+from pipeline import add_fanout_args, fanout_region_signals
+
+
+def load_float64(fname):
+    """
+    load an image with its data as float64 in memory, so that the comparisons
+    are not swamped by float32 rounding
+    """
+    img = nib.load(fname)
+    out = nib.Nifti1Image(img.get_fdata(dtype=np.float64), img.affine, img.header)
+    out.set_data_dtype(np.float64)
+    return out
+
+
+def max_diff(outsa, outsb, what):
+    """
+    largest absolute difference between two extract_mats outputs, per parc
+    """
+    worst = 0.0
+    for n, (outa, outb) in enumerate(zip(outsa, outsb)):
+        matsa, tsa, rega = outa
+        matsb, tsb, regb = outb
+        if not np.array_equal(rega, regb):
+            print("{} parc {}: different regions".format(what, n))
+            return np.inf
+        diff = np.max(np.abs(tsa - tsb))
+        for kind in (matsa or {}):
+            diff = max(diff, np.nanmax(np.abs(matsa[kind] - matsb[kind])))
+        print("{} parc {}: max abs diff {:.3g}".format(what, n, diff))
+        worst = max(worst, diff)
+
+    return worst
+
+
+def regress_args(args, inputimg, inputmask, stdz=True, fusedop=False,
+                 strategy=None, dtype=np.float64):
+
+    return nuisance_regress(inputimg, args.confounds, inputmask,
+                            inputtr=args.tr,
+                            conftype=strategy or args.strategy,
+                            spikethr=args.spikethr,
+                            smoothkern=args.fwhm,
+                            discardvols=args.discardvols,
+                            highpassval=args.highpass,
+                            lowpassval=args.lowpass,
+                            confoundsjson=args.confjson,
+                            addregressors=args.add_regressors,
+                            addlinear=args.add_linear,
+                            addafterdetr=args.add_detrend_after,
+                            initdum=args.initaldummy,
+                            stdz=stdz,
+                            fusedop=fusedop,
+                            censor=args.censor,
+                            censormincontig=args.censormincontig,
+                            dtype=dtype)
+
+
+def voxelwise_mats(args, inputimg, inputmask, labimgs, stdz):
+
+    nrimg, _, _ = regress_args(args, inputimg, inputmask, stdz=stdz)
+
+    return extract_mats(nrimg, inputmask, labimgs, conntype=args.type,
+                        savets=True, nomat=args.nomatrix, dtr=args.detrend,
+                        stdz=args.standarize)
+
+
+def roifirst_mats(args, inputimg, inputmask, labimgs, stdz):
+
+    cleanfunc, _, _ = roi_clean_from_args(args, stdz=stdz)
+
+    return extract_mats(inputimg, inputmask, labimgs, conntype=args.type,
+                        savets=True, nomat=args.nomatrix, dtr=args.detrend,
+                        stdz=args.standarize, precleanfunc=cleanfunc)
+
+
+def check_roifirst(args):
+    """
+    returns the largest absolute difference between the region time series
+    and matrices of the roi-first and voxelwise paths (no voxel standardizing)
+    """
+    if args.fwhm or args.space != 'data' or args.mask is None:
+        print("roifirst check needs -fwhm 0, -space data and a -mask. exiting")
+        exit(1)
+
+    inputimg = load_float64(args.fmri)
+    inputmask = nib.load(args.mask)
+    labimgs = [nib.load(parc) for parc in args.parcs]
+
+    voxouts = voxelwise_mats(args, inputimg, inputmask, labimgs, stdz=False)
+    roiouts = roifirst_mats(args, inputimg, inputmask, labimgs, stdz=False)
+    worst = max_diff(voxouts, roiouts, 'roifirst vs voxelwise')
+
+    # for information, the effect of standardizing the voxels
+    voxouts = voxelwise_mats(args, inputimg, inputmask, labimgs, stdz=True)
+    max_diff(voxouts, roiouts, '(info) roifirst vs voxelwise with voxel standardizing')
+
+    return worst
+
+
+def check_fusedop(args):
+    """
+    returns the largest absolute difference between the images cleaned with
+    the fused operator and with the separate nilearn passes
+    """
+    if args.censor:
+        # censoring is always fused, the check would compare it with itself
+        print("fusedop check does not go with -censor, see verify.py censor. exiting")
+        exit(1)
+
+    inputimg = load_float64(args.fmri)
+    inputmask = nib.load(args.mask) if args.mask is not None else None
+
+    start = time.time()
+    plainimg, _, _ = regress_args(args, inputimg, inputmask)
+    plaintime = time.time() - start
+
+    start = time.time()
+    fusedimg, _, _ = regress_args(args, inputimg, inputmask, fusedop=True)
+    fusedtime = time.time() - start
+
+    worst = np.max(np.abs(plainimg.get_fdata() - fusedimg.get_fdata()))
+    print("separate passes {:.2f}s, fused operator {:.2f}s, max abs diff "
+          "{:.3g}".format(plaintime, fusedtime, worst))
+
+    return worst
+
+
+def censored_clean(voxts, confounds, tr, highpassval, lowpassval, keep,
+                   addafterdetr=False, stdz=True, discardvols=0):
+    """
+    the censored cleaning of a time x voxels array, step by step: regress
+    the confounds (+ intercept) fit on the kept frames, fill in the censored
+    frames by linear interpolation between the kept ones, filter, detrend
+    after (fit on the kept frames) and standardize by the kept frames
+    """
+    nvol = len(keep)
+    keptidx = np.flatnonzero(keep)
+
+    if confounds is not None:
+        design = np.column_stack([confounds.values, np.ones(nvol)])
+    else:
+        design = np.ones((nvol, 1))
+    beta = np.linalg.lstsq(design[keptidx, :], voxts[keptidx, :], rcond=None)[0]
+    resid = voxts - design.dot(beta)
+
+    # np.interp holds the nearest kept frame at the ends, as the operator
+    filled = np.empty_like(resid)
+    for v in range(resid.shape[1]):
+        filled[:, v] = np.interp(np.arange(nvol), keptidx, resid[keptidx, v])
+
+    if lowpassval or highpassval:
+        filled = signal.clean(filled, detrend=False, standardize=False, confounds=None,
+                              low_pass=lowpassval, high_pass=highpassval, t_r=tr)
+
+    out = filled - filled[keptidx, :].mean(axis=0)
+    if addafterdetr:
+        trend = np.column_stack([np.ones(nvol), np.arange(nvol)])
+        beta = np.linalg.lstsq(trend[keptidx, :], filled[keptidx, :], rcond=None)[0]
+        out = filled - trend.dot(beta)
+    if stdz:
+        std = filled[keptidx, :].std(axis=0)
+        std[std < np.finfo(filled.dtype).eps] = 1.
+        out = out / std
+
+    return out[discardvols:, :]
+
+
+def check_censor(args):
+    """
+    returns the largest absolute difference between the voxels cleaned with
+    the censoring operator and with censored_clean
+    """
+    if args.mask is None:
+        print("censor check needs a -mask. exiting")
+        exit(1)
+    args.censor = True
+
+    inputimg = load_float64(args.fmri)
+    inputmask = nib.load(args.mask)
+
+    confounds, _, tr, highpassval, lowpassval, keep = \
+        get_clean_setup(inputimg, args.confounds, inputtr=args.tr,
+                        conftype=args.strategy, spikethr=args.spikethr,
+                        highpassval=args.highpass, lowpassval=args.lowpass,
+                        confoundsjson=args.confjson,
+                        addregressors=args.add_regressors,
+                        addlinear=args.add_linear, initdum=args.initaldummy,
+                        censor=True, censormincontig=args.censormincontig)
+    if keep.all():
+        print("no frames over -spikethr {}, nothing censored to check. exiting".format(
+              args.spikethr))
+        exit(1)
+
+    start = time.time()
+    masker = input_data.NiftiMasker(mask_img=inputmask, detrend=False, standardize=False,
+                                    smoothing_fwhm=args.fwhm)
+    voxts = masker.fit_transform(inputimg)
+    directts = censored_clean(voxts, confounds, tr, highpassval, lowpassval, keep,
+                              addafterdetr=args.add_detrend_after,
+                              discardvols=args.discardvols)
+    directtime = time.time() - start
+
+    start = time.time()
+    censimg, _, _ = regress_args(args, inputimg, inputmask)
+    censtime = time.time() - start
+
+    # (not masker.transform, which would smooth it again)
+    worst = np.max(np.abs(apply_mask(censimg, inputmask, dtype=np.float64) - directts))
+    print("{} of {} frames censored. step by step {:.2f}s, censoring operator {:.2f}s, "
+          "max abs diff {:.3g}".format(np.sum(~keep), len(keep), directtime, censtime, worst))
+
+    return worst
+
+
+def check_fanout(args):
+    """
+    returns the largest absolute difference between the region signals and
+    matrices of the fan-out and of a plain regression per strategy
+    """
+    if args.space != 'data' or args.mask is None or args.strategies is None:
+        print("fanout check needs -space data, a -mask and -strategies. exiting")
+        exit(1)
+
+    setups, allts, regions, censor = fanout_region_signals(args)
+
+    inputimg = nib.load(args.fmri)
+    inputmask = nib.load(args.mask)
+    labimgs = [nib.load(parc) for parc in args.parcs]
+
+    worst = 0.0
+    for n, strategy in enumerate(args.strategies):
+        fanouts = mats_from_region_signals(allts[n], regions, conntype=args.type,
+                                           savets=True, nomat=args.nomatrix,
+                                           dtr=args.detrend, stdz=args.standarize,
+                                           censor=censor)
+
+        nrimg, _, _ = regress_args(args, inputimg, inputmask, strategy=strategy)
+        plainouts = extract_mats(nrimg, inputmask, labimgs, conntype=args.type,
+                                 savets=True, nomat=args.nomatrix,
+                                 dtr=args.detrend, stdz=args.standarize,
+                                 censor=censor)
+        worst = max(worst, max_diff(fanouts, plainouts,
+                                    '{} fanout vs plain'.format(strategy)))
+
+    return worst
+
+
+def timed_peak(func, *args, **kwargs):
+    """
+    run func, returns its output, the seconds it took, and its peak traced
+    memory (MB)
+    """
+    tracemalloc.start()
+    start = time.time()
+    out = func(*args, **kwargs)
+    seconds = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return out, seconds, peak / (1024 * 1024)
+
+
+def check_dtype(args):
+    """
+    returns the largest absolute difference between the region time series
+    and matrices made in float32 and in float64
+    """
+    if args.space != 'data' or args.mask is None:
+        print("dtype check needs -space data and a -mask. exiting")
+        exit(1)
+
+    inputmask = nib.load(args.mask)
+    labimgs = [nib.load(parc) for parc in args.parcs]
+
+    def run(dtype):
+        nrimg, _, _ = regress_args(args, nib.load(args.fmri), inputmask,
+                                   fusedop=True, dtype=dtype)
+        return extract_mats(nrimg, inputmask, labimgs, conntype=args.type,
+                            savets=True, nomat=args.nomatrix, dtr=args.detrend,
+                            stdz=args.standarize, dtype=dtype)
+
+    doubleouts, doubletime, doublemem = timed_peak(run, np.float64)
+    singleouts, singletime, singlemem = timed_peak(run, np.float32)
+
+    print("float64 {:.2f}s, peak {:.0f} MB".format(doubletime, doublemem))
+    print("float32 {:.2f}s, peak {:.0f} MB ({:.2f}x time, {:.2f}x memory)".format(
+          singletime, singlemem, singletime / doubletime, singlemem / doublemem))
+
+    return max_diff(doubleouts, singleouts, 'float32 vs float64')
+
+
+def fusedop_speed(nvols, nvoxs, nconf=36, tr=2.0, highpassval=0.008,
+                  lowpassval=0.08):
+    """
+    time the separate passes and the fused operator (building it included)
+    on random data, print a table, return the largest abs difference
+    """
+    rng = np.random.RandomState(0)
+    worst = 0.0
+
+    print("{:>6} {:>8} {:>10} {:>10} {:>8} {:>10}".format(
+          'nvols', 'nvox', 'separate', 'fused', 'speedup', 'maxdiff'))
+    for nvol in nvols:
+        confounds = pd.DataFrame(rng.randn(nvol, nconf))
+        for nvox in nvoxs:
+            voxts = 100 + rng.randn(nvol, nvox)
+
+            start = time.time()
+            plain = clean_timeseries(voxts.copy(), confounds, tr,
+                                     highpassval, lowpassval)
+            plaintime = time.time() - start
+
+            start = time.time()
+            op, _ = get_temporal_operator(nvol, confounds, tr, highpassval,
+                                          lowpassval)
+            fused = apply_temporal_operator(op, voxts.copy())
+            fusedtime = time.time() - start
+
+            diff = np.max(np.abs(plain - fused))
+            worst = max(worst, diff)
+            print("{:>6} {:>8} {:>9.2f}s {:>9.2f}s {:>7.1f}x {:>10.3g}".format(
+                  nvol, nvox, plaintime, fusedtime, plaintime / fusedtime, diff))
+
+    return worst
+
+
+def conn_speed(nrois, nvols, kinds=KINDS):
+    """
+    time nilearn's ConnectivityMeasure and the connectivity engine (float64
+    and float32) on random data, print a table, return the largest abs
+    difference of the float64 engine
+    """
+    from nilearn.connectome import ConnectivityMeasure
+
+    rng = np.random.RandomState(0)
+    worst = 0.0
+
+    print("{:>6} {:>6} {:>9} {:>9} {:>9} {:>8} {:>10} {:>10}".format(
+          'nvols', 'nrois', 'nilearn', 'engine', 'engine32', 'speedup', 'maxdiff', 'maxdiff32'))
+    for nvol in nvols:
+        for nroi in nrois:
+            time_series = rng.randn(nvol, nroi)
+
+            start = time.time()
+            plain = {kind: ConnectivityMeasure(kind=kind).fit_transform([time_series])[0]
+                     for kind in kinds}
+            plaintime = time.time() - start
+
+            start = time.time()
+            fast = connectivity(time_series, kinds)
+            fasttime = time.time() - start
+
+            start = time.time()
+            single = connectivity(time_series.astype(np.float32), kinds)
+            singletime = time.time() - start
+
+            diff = max(np.max(np.abs(plain[k] - fast[k])) for k in kinds)
+            diff32 = max(np.max(np.abs(plain[k] - single[k])) for k in kinds)
+            worst = max(worst, diff)
+            print("{:>6} {:>6} {:>8.2f}s {:>8.2f}s {:>8.2f}s {:>7.1f}x {:>10.3g} {:>10.3g}".format(
+                  nvol, nroi, plaintime, fasttime, singletime, plaintime / fasttime,
+                  diff, diff32))
+
+    return worst
+
+
+def dyn_speed(nrois, nvols, width, step=1, tapers=TAPERS):
+    """
+    time the sliding-window correlations against one np.cov per window on
+    random data, print a table, return the largest abs difference
+    """
+    import os
+    import tempfile
+    from dynconn import window_weights, window_starts
+
+    rng = np.random.RandomState(0)
+    worst = 0.0
+    tmpdir = tempfile.mkdtemp()
+    outname = os.path.join(tmpdir, 'dynconn.hdf5')
+
+    print("{:>6} {:>6} {:>8} {:>9} {:>9} {:>8} {:>10}".format(
+          'nvols', 'nrois', 'taper', 'plain', 'running', 'speedup', 'maxdiff'))
+    for nvol in nvols:
+        for nroi in nrois:
+            time_series = rng.randn(nvol, nroi)
+            rows, cols = np.triu_indices(nroi, 1)
+            for taper in tapers:
+                weights = window_weights(width, taper)
+
+                start = time.time()
+                plain = np.array([cov_to_corr(np.cov(time_series[s:s + width].T,
+                                                     aweights=weights))[rows, cols]
+                                  for s in window_starts(nvol, width, step)])
+                plaintime = time.time() - start
+
+                start = time.time()
+                sliding_window_conn(time_series, outname, width, step=step, taper=taper)
+                fasttime = time.time() - start
+
+                diff = np.max(np.abs(plain - read_dynconn(outname)[0]))
+                worst = max(worst, diff)
+                print("{:>6} {:>6} {:>8} {:>8.2f}s {:>8.2f}s {:>7.1f}x {:>10.3g}".format(
+                      nvol, nroi, taper, plaintime, fasttime, plaintime / fasttime, diff))
+
+    os.remove(outname)
+    os.rmdir(tmpdir)
+
+    return worst
+
+
+def compcor_speed(nvoxs, nvols, pcts, ncomp=5, rank=20):
+    """
+    time the compcor components against nilearn's on random data, print a
+    table, return the largest subspace difference
+    """
+    from nilearn.image import high_variance_confounds
+    from get_compcor import compcor_from_img
+
+    rng = np.random.RandomState(0)
+    worst = 0.0
+
+    print("{:>6} {:>7} {:>5} {:>9} {:>9} {:>8} {:>10}".format(
+          'nvols', 'nvox', 'pct', 'nilearn', 'compcor', 'speedup', 'diff'))
+    for nvol in nvols:
+        for nvox in nvoxs:
+            # a few strong shared signals, with decaying weight, plus noise,
+            # in a cube with a border outside of the mask
+            side = int(np.ceil(nvox ** (1. / 3)))
+            data = np.zeros((side + 2, side + 2, side + 2, nvol))
+            data[1:-1, 1:-1, 1:-1] = ((rng.randn(nvol, rank) * np.linspace(5, 1, rank)).dot(
+                rng.randn(rank, side ** 3)) + rng.randn(nvol, side ** 3) * 3.).T.reshape(
+                (side, side, side, nvol))
+            img = nib.Nifti1Image(data, np.eye(4))
+            mask = np.zeros(data.shape[:3], dtype=np.uint8)
+            mask[1:-1, 1:-1, 1:-1] = 1
+            maskimg = nib.Nifti1Image(mask, np.eye(4))
+            for pct in pcts:
+                start = time.time()
+                plain = high_variance_confounds(img, n_confounds=ncomp, percentile=pct,
+                                                mask_img=maskimg)
+                plaintime = time.time() - start
+
+                start = time.time()
+                comps = compcor_from_img(img, 'highvar', inputmask=maskimg, percentile=pct,
+                                         ncomp=ncomp).values
+                fasttime = time.time() - start
+
+                diff = 1. - np.linalg.svd(plain.T.dot(comps), compute_uv=False).min()
+                worst = max(worst, diff)
+                print("{:>6} {:>7} {:>5} {:>8.2f}s {:>8.2f}s {:>7.1f}x {:>10.3g}".format(
+                      nvol, side ** 3, pct, plaintime, fasttime, plaintime / fasttime, diff))
+
+    return worst
+
+
+def groupagg_speed(nsubjects, nrois, nprocs=2, pmissing=0.2):
+    """
+    time the streamed group stats against those of the stacked subjects on
+    random matrix files, print a table, return the largest difference
+    """
+    import os
+    import shutil
+    import tempfile
+    from connio import save_conn, load_conn_group
+    from groupagg import aggregate_shards
+
+    rng = np.random.RandomState(0)
+    worst = 0.0
+
+    print("{:>5} {:>9} {:>9} {:>9} {:>10}".format('nrois', 'nsubjects', 'stacked', 'streamed',
+                                                  'diff'))
+    for nroi in nrois:
+        tmpdir = tempfile.mkdtemp()
+        fnames = []
+        for sub in range(nsubjects):
+            # a few subjects lose a few regions
+            regions = np.arange(1, nroi + 1)
+            if rng.rand() < pmissing:
+                regions = np.setdiff1d(regions, rng.choice(regions, 3, replace=False))
+            ts = rng.randn(100, len(regions))
+            outbase = os.path.join(tmpdir, 'sub{}'.format(sub))
+            save_conn(outbase, np.corrcoef(ts.T), regions, 'correlation')
+            fnames.append(''.join([outbase, '_connMat.npy']))
+
+        start = time.time()
+        group, _ = load_conn_group(fnames)
+        group = group.astype(np.float64)
+        zgroup = np.arctanh(np.clip(group, -1 + 1e-7, 1 - 1e-7))
+        plain = [np.nanmean(group, axis=0), np.nanvar(group, axis=0, ddof=1),
+                 np.nanmean(zgroup, axis=0), np.nanvar(zgroup, axis=0, ddof=1)]
+        plaintime = time.time() - start
+
+        start = time.time()
+        stats = aggregate_shards(fnames, nprocs=nprocs).stats()
+        fasttime = time.time() - start
+        shutil.rmtree(tmpdir)
+
+        diff = max(np.max(np.abs(a - b)) for a, b in
+                   zip(plain, [stats['mean'], stats['var'], stats['zmean'], stats['zvar']]))
+        diff = max(diff, np.max(np.abs(np.sum(np.isfinite(group), axis=0) - stats['count'])))
+        worst = max(worst, diff)
+        print("{:>5} {:>9} {:>8.2f}s {:>8.2f}s {:>10.3g}".format(
+              nroi, nsubjects, plaintime, fasttime, diff))
+
+    return worst
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='check the faster paths against the plain ones')
+    subparsers = parser.add_subparsers(dest='check')
+
+    roiparser = subparsers.add_parser('roifirst', help='roi-first versus voxelwise cleaning')
+    add_regress_args(roiparser)
+    add_makemat_args(roiparser)
+    roiparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                           default=1e-6)
+
+    fusedparser = subparsers.add_parser('fusedop', help='fused temporal operator versus separate passes')
+    add_regress_args(fusedparser)
+    fusedparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                             default=1e-4)
+
+    censparser = subparsers.add_parser('censor', help='censoring operator versus the steps done '
+                                       'directly')
+    add_regress_args(censparser)
+    censparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                            default=1e-4)
+
+    fanparser = subparsers.add_parser('fanout', help='one-load fan-out versus a run per strategy')
+    add_regress_args(fanparser)
+    add_makemat_args(fanparser)
+    add_fanout_args(fanparser)
+    fanparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                           default=1e-4)
+
+    dtypeparser = subparsers.add_parser('dtype', help='float32 versus float64, time and memory')
+    add_regress_args(dtypeparser)
+    add_makemat_args(dtypeparser)
+    dtypeparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                             default=1e-3)
+
+    speedparser = subparsers.add_parser('fusedopspeed', help='time the fused operator on random data')
+    speedparser.add_argument('-nvols', type=int, nargs='+', help='numbers of volumes',
+                             default=[200, 600, 1200])
+    speedparser.add_argument('-nvox', type=int, nargs='+', help='numbers of voxels',
+                             default=[20000, 100000])
+    speedparser.add_argument('-nconf', type=int, help='number of confounds', default=36)
+    speedparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                             default=1e-4)
+
+    connparser = subparsers.add_parser('connspeed', help='time the connectivity engine on random data')
+    connparser.add_argument('-nrois', type=int, nargs='+', help='numbers of regions',
+                            default=[1000, 3000])
+    connparser.add_argument('-nvols', type=int, nargs='+', help='numbers of volumes',
+                            default=[1200])
+    connparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                            default=1e-8)
+
+    dynparser = subparsers.add_parser('dynspeed', help='time the sliding-window correlations '
+                                      'on random data')
+    dynparser.add_argument('-nrois', type=int, nargs='+', help='numbers of regions',
+                           default=[100, 400])
+    dynparser.add_argument('-nvols', type=int, nargs='+', help='numbers of volumes',
+                           default=[1200])
+    dynparser.add_argument('-width', type=int, help='window width (frames)', default=60)
+    dynparser.add_argument('-step', type=int, help='frames between windows', default=1)
+    dynparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                           default=1e-6)
+
+    compparser = subparsers.add_parser('compcor', help='time the compcor components on random data')
+    compparser.add_argument('-nvox', type=int, nargs='+', help='numbers of voxels',
+                            default=[50000, 200000])
+    compparser.add_argument('-nvols', type=int, nargs='+', help='numbers of volumes',
+                            default=[600])
+    compparser.add_argument('-pct', type=float, nargs='+', help='percents of highest variance voxels',
+                            default=[2., 20.])
+    compparser.add_argument('-tol', type=float, help='largest allowed subspace difference',
+                            default=1e-4)
+
+    groupparser = subparsers.add_parser('groupagg', help='streamed group stats versus stacked, on '
+                                        'random matrices')
+    groupparser.add_argument('-nsubjects', type=int, help='number of subjects', default=200)
+    groupparser.add_argument('-nrois', type=int, nargs='+', help='numbers of regions',
+                             default=[100, 400])
+    groupparser.add_argument('-nprocs', type=int, help='shards (processes)', default=2)
+    groupparser.add_argument('-tol', type=float, help='largest allowed abs difference',
+                             default=1e-8)
+
+    # parse
+    args = parser.parse_args()
+
+    if args.check is None:
+        parser.print_help()
+        exit(1)
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("END ARGS\n")
+
+    if args.check == 'roifirst':
+        worst = check_roifirst(args)
+    elif args.check == 'fusedop':
+        worst = check_fusedop(args)
+    elif args.check == 'censor':
+        worst = check_censor(args)
+    elif args.check == 'fanout':
+        worst = check_fanout(args)
+    elif args.check == 'dtype':
+        worst = check_dtype(args)
+    elif args.check == 'connspeed':
+        worst = conn_speed(args.nrois, args.nvols)
+    elif args.check == 'dynspeed':
+        worst = dyn_speed(args.nrois, args.nvols, args.width, args.step)
+    elif args.check == 'compcor':
+        worst = compcor_speed(args.nvox, args.nvols, args.pct)
+    elif args.check == 'groupagg':
+        worst = groupagg_speed(args.nsubjects, args.nrois, nprocs=args.nprocs)
+    else:
+        worst = fusedop_speed(args.nvols, args.nvox, nconf=args.nconf)
+
+    if worst > args.tol:
+        print("\nFAIL: {} check, max abs diff {:.3g} > {:.3g}".format(args.check, worst, args.tol))
+        exit(1)
+
+    print("\nPASS: {} check, max abs diff {:.3g}".format(args.check, worst))
+
+
+if __name__ == '__main__':
+    main()
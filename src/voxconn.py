@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+voxelwise connectome, the correlation of every pair of (masked) voxels of a
+cleaned image, too big to hold (200k voxels -> 200k x 200k), kept sparse
+
+    voxconn.py out_nuisance.nii.gz mask.nii.gz -out sub01 -topk 100
+
+the voxels are standardized once (unit norm columns, so that a block of
+correlations is one matrix multiply), and the matrix is computed in tiles:
+for a block of rows, one block of columns at a time, keeping for each row
+only its -topk strongest edges and/or the ones over -thresh. the tile size
+comes from -membudget, the row blocks run on -nthreads threads (the
+multiplies release the gil), and the rows are written, in order, as they
+come, to <out>_voxconn.hdf5:
+
+    indptr, indices, data   the csr matrix (voxels x voxels, float32)
+    voxelindices            flat (c order) index in the image grid of each
+                            voxel (row / column)
+
+with attributes shape (of the image grid) and affine. load_voxconn gives
+back a scipy.sparse.csr_matrix. n.b. with -topk every row keeps its own top
+k, so the matrix is not symmetric
+
+@author: jfaskowi
+
+"""
+
+import os
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from lazyimport import lazy_import
+
+# imported on first use, see lazyimport.py
+nib = lazy_import('nibabel')
+sparse = lazy_import('scipy.sparse')
+h5py = lazy_import('h5py')
+
+
+def standardize_voxels(voxts, blocksize=8192):
+    """
+    center each voxel (column) of a time x voxels array and scale it to unit
+    norm, in place, so that z[:, a].T.dot(z[:, b]) are correlations. voxels
+    with no variance are left at zero
+    """
+    for v0 in range(0, voxts.shape[1], blocksize):
+        v1 = min(voxts.shape[1], v0 + blocksize)
+        block = np.asarray(voxts[:, v0:v1], dtype=np.float64)
+        block -= block.mean(axis=0)
+        norm = np.sqrt(np.sum(block ** 2, axis=0))
+        norm[norm < np.finfo(np.float32).eps] = np.inf
+        voxts[:, v0:v1] = block / norm
+
+    return voxts
+
+
+def tile_size(nvol, nvox, membudget, nthreads):
+    """
+    the side of the square tiles, so that nthreads of them (each about three
+    float32 copies of a tile, plus the rows of data) fit in membudget MB
+    """
+    perthread = membudget * 1024 * 1024 / nthreads
+    # 12 s^2 + 4 nvol s <= perthread
+    side = (-4. * nvol + np.sqrt(16. * nvol ** 2 + 48. * perthread)) / 24.
+
+    return int(min(nvox, max(64, side)))
+
+
+def row_block_edges(z, r0, r1, colblock, topk=None, thresh=None,
+                    absolute=False):
+    """
+    the edges of rows r0:r1 of the voxelwise correlation matrix of the
+    standardized time x voxels z, one tile of colblock columns at a time.
+    each row keeps its topk strongest edges (by value, or by abs value if
+    absolute), and of those (or of all, without topk) the ones over thresh
+
+    returns the csr pieces of the block: counts (edges per row), indices,
+    data (sorted by column within each row)
+    """
+    nvox = z.shape[1]
+    nrow = r1 - r0
+    zr = np.ascontiguousarray(z[:, r0:r1])
+    rowids = np.arange(nrow)
+
+    if topk is not None:
+        topk = min(topk, nvox - 1)
+        bestscore = np.full((nrow, topk), -np.inf, dtype=np.float32)
+        bestval = np.zeros((nrow, topk), dtype=np.float32)
+        bestidx = np.full((nrow, topk), -1, dtype=np.int64)
+    else:
+        parts = []
+
+    for c0 in range(0, nvox, colblock):
+        c1 = min(nvox, c0 + colblock)
+        tile = zr.T.dot(z[:, c0:c1])
+        score = np.abs(tile) if absolute else tile.copy()
+
+        # no self edges
+        diag = np.arange(max(r0, c0), min(r1, c1))
+        score[diag - r0, diag - c0] = -np.inf
+
+        if topk is not None:
+            candscore = np.concatenate([bestscore, score], axis=1)
+            candval = np.concatenate([bestval, tile], axis=1)
+            candidx = np.concatenate([bestidx, np.broadcast_to(np.arange(c0, c1), (nrow, c1 - c0))],
+                                     axis=1)
+            sel = np.argpartition(-candscore, topk - 1, axis=1)[:, :topk]
+            bestscore = np.take_along_axis(candscore, sel, axis=1)
+            bestval = np.take_along_axis(candval, sel, axis=1)
+            bestidx = np.take_along_axis(candidx, sel, axis=1)
+        else:
+            rows, cols = np.nonzero(score > thresh)
+            parts.append((rows, cols + c0, tile[rows, cols]))
+
+    if topk is not None:
+        keep = bestidx >= 0
+        if thresh is not None:
+            keep &= bestscore > thresh
+        rows = np.broadcast_to(rowids[:, None], bestidx.shape)[keep]
+        cols = bestidx[keep]
+        vals = bestval[keep]
+    else:
+        rows = np.concatenate([p[0] for p in parts])
+        cols = np.concatenate([p[1] for p in parts])
+        vals = np.concatenate([p[2] for p in parts])
+
+    order = np.lexsort((cols, rows))
+    counts = np.bincount(rows, minlength=nrow)
+
+    return counts, cols[order].astype(np.int32), vals[order].astype(np.float32)
+
+
+def voxel_connectome(voxts, outname, topk=None, thresh=None, absolute=False,
+                     membudget=2048, nthreads=None, voxelindices=None,
+                     imgshape=None, affine=None):
+    """
+    the sparse voxelwise connectome of a time x voxels array (standardized
+    in place, see standardize_voxels), written incrementally to outname
+    (.hdf5, see the top of this file)
+
+    returns the number of edges written
+    """
+    if topk is None and thresh is None:
+        print("need a topk and/or a thresh, the full matrix is too big. exiting")
+        exit(1)
+
+    if nthreads is None:
+        nthreads = os.cpu_count()
+
+    nvol, nvox = voxts.shape
+    z = standardize_voxels(voxts)
+    side = tile_size(nvol, nvox, membudget, nthreads)
+    print("voxelwise connectome of {} voxels, {} x {} tiles on {} threads".format(
+          nvox, side, side, nthreads))
+
+    indptr = np.zeros(nvox + 1, dtype=np.int64)
+    with h5py.File(outname, 'w') as h5f:
+        indices = h5f.create_dataset('indices', shape=(0,), maxshape=(None,),
+                                     dtype=np.int32, chunks=(1 << 16,))
+        data = h5f.create_dataset('data', shape=(0,), maxshape=(None,),
+                                  dtype=np.float32, chunks=(1 << 16,))
+        if voxelindices is not None:
+            h5f.create_dataset('voxelindices', data=voxelindices)
+        if imgshape is not None:
+            h5f.attrs['shape'] = imgshape
+        if affine is not None:
+            h5f.attrs['affine'] = affine
+        h5f.attrs['topk'] = -1 if topk is None else topk
+        h5f.attrs['thresh'] = np.nan if thresh is None else thresh
+        h5f.attrs['absolute'] = absolute
+
+        def write(r0, r1, result):
+            counts, cols, vals = result
+            nnz = indptr[r0]
+            indptr[r0 + 1:r1 + 1] = nnz + np.cumsum(counts)
+            indices.resize((nnz + len(cols),))
+            data.resize((nnz + len(vals),))
+            indices[nnz:] = cols
+            data[nnz:] = vals
+
+        # row blocks in parallel, written in order, a few in flight at once
+        with ThreadPoolExecutor(nthreads) as pool:
+            inflight = collections.deque()
+            for r0 in range(0, nvox, side):
+                r1 = min(nvox, r0 + side)
+                inflight.append((r0, r1, pool.submit(row_block_edges, z, r0, r1, side,
+                                                     topk, thresh, absolute)))
+                if len(inflight) >= 2 * nthreads:
+                    b0, b1, future = inflight.popleft()
+                    write(b0, b1, future.result())
+            while inflight:
+                b0, b1, future = inflight.popleft()
+                write(b0, b1, future.result())
+
+        h5f.create_dataset('indptr', data=indptr)
+
+    print("wrote {} edges to {}".format(indptr[-1], outname))
+    return indptr[-1]
+
+
+def load_voxconn(fname):
+    """
+    returns the csr matrix of a voxel_connectome file, and the voxel indices
+    (None if not stored)
+    """
+    with h5py.File(fname, 'r') as h5f:
+        nvox = len(h5f['indptr']) - 1
+        mat = sparse.csr_matrix((h5f['data'][()], h5f['indices'][()], h5f['indptr'][()]),
+                                shape=(nvox, nvox))
+        voxelindices = h5f['voxelindices'][()] if 'voxelindices' in h5f else None
+
+    return mat, voxelindices
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='cleaned fmri -> sparse voxelwise connectome')
+    parser.add_argument('fmri', type=str, help='cleaned fmri (e.g. regress.py _nuisance.nii.gz)')
+    parser.add_argument('mask', type=str, help='mask of the voxels, in the space of fmri')
+    parser.add_argument('-out', type=str, help='output base name', default='output')
+    parser.add_argument('-topk', type=int, help='keep the k strongest edges of each voxel', default=None)
+    parser.add_argument('-thresh', type=float, help='keep the edges over this', default=None)
+    parser.add_argument('-absolute', help='rank / threshold by the abs value of the edges',
+                        action="store_true")
+    parser.add_argument('-membudget', type=float, help='working memory (MB) for the tiles',
+                        default=2048)
+    parser.add_argument('-nthreads', type=int, help='threads for the tiles (default: all cpus)',
+                        default=None)
+    parser.add_argument('-censorfile', type=str, help='_censor.csv from regress.py -censor, censored '
+                        'frames are dropped', default=None)
+
+    # parse
+    args = parser.parse_args()
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("END ARGS\n")
+
+    from nilearn.masking import apply_mask
+    from makemat import read_censor
+
+    inputimg = nib.load(args.fmri)
+    maskimg = nib.load(args.mask)
+    maskdat = np.asanyarray(maskimg.dataobj) != 0
+
+    # time x voxels, float32
+    voxts = apply_mask(inputimg, maskimg)
+    if args.censorfile is not None:
+        voxts = voxts[read_censor(args.censorfile)]
+
+    voxel_connectome(voxts, ''.join([args.out, '_voxconn.hdf5']),
+                     topk=args.topk, thresh=args.thresh, absolute=args.absolute,
+                     membudget=args.membudget, nthreads=args.nthreads,
+                     voxelindices=np.flatnonzero(maskdat),
+                     imgshape=maskdat.shape, affine=maskimg.affine)
+
+
+if __name__ == '__main__':
+    main()
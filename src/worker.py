@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+a long-lived local worker, so that short runs do not each pay for starting
+python and importing nilearn, pandas, nibabel, h5py (about a second and a
+half, twice per run.sh without -fused)
+
+    worker.py serve -queue /tmp/fmri2mat [-keepops 16] [-idle 0]
+    worker.py submit -queue /tmp/fmri2mat [-wait] regress|makemat|pipeline <its args>
+    worker.py stop -queue /tmp/fmri2mat
+
+the queue is a directory: submit writes a job (the command, its args and the
+working directory) to new/, a worker takes it by moving it to running/
+(a rename, so several workers can serve one queue), runs it in the worker
+process itself, where the libraries are already loaded (in the job's
+working directory, its output going to logs/<job>.txt), and moves it to
+done/ or failed/ with the status and time. the args are those of
+regress.py, makemat.py or pipeline.py, so run.sh -worker <queue> sends its
+usual commands this way
+
+a job that fails (raises, exits) is recorded as failed and the worker goes
+on, but one that takes the interpreter down (a segfault, os._exit, killed
+for running out of memory) takes the worker with it, and stays in running/
+
+a worker also keeps the last -keepops label operators (the parc resampled
+to the fmri grid, see makemat.get_label_operator) in memory, so subjects in
+the same template space skip the resampling
+
+submit -wait waits for the job and prints its log, exiting 1 if it failed.
+if no worker is serving the queue it runs the job itself instead. stop asks
+the workers of a queue to exit after their current job
+
+@author: jfaskowi
+
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+QUEUEDIRS = ['new', 'running', 'done', 'failed', 'logs', 'workers']
+COMMANDS = ['regress', 'makemat', 'pipeline']
+
+# what the worker imports up front, all of what the commands use
+PRELOAD = ['numpy', 'pandas', 'h5py', 'nibabel', 'scipy.sparse', 'scipy.linalg', 'sklearn',
+           'nilearn.input_data', 'nilearn.image', 'nilearn.signal', 'nilearn.masking',
+           'regress', 'makemat', 'pipeline']
+
+# a worker that has not been heard from in this long (seconds) is gone
+ALIVE = 30.
+
+
+def queue_dirs(queue):
+    """
+    makes (if needed) and returns the sub directories of a queue
+    """
+    # absolute, the jobs run in their own working directories
+    queue = os.path.abspath(queue)
+    dirs = {name: os.path.join(queue, name) for name in QUEUEDIRS}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+
+    return dirs
+
+
+def write_json(fname, obj):
+    """
+    write a json so that it appears all at once (a reader never sees half)
+    """
+    tmpname = ''.join([fname, '.tmp'])
+    with open(tmpname, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.rename(tmpname, fname)
+
+
+def live_workers(dirs):
+    """
+    the workers that have been heard from in the last ALIVE seconds
+    """
+    now = time.time()
+    live = []
+    for fname in os.listdir(dirs['workers']):
+        path = os.path.join(dirs['workers'], fname)
+        try:
+            if now - os.path.getmtime(path) < ALIVE:
+                live.append(fname)
+        except OSError:
+            pass
+
+    return live
+
+
+def command_funcs(command):
+    """
+    the parser and the run function of a command
+    """
+    if command == 'regress':
+        from regress import get_parser, run_regress
+        return get_parser, run_regress
+    if command == 'makemat':
+        from makemat import get_parser, run_makemat
+        return get_parser, run_makemat
+
+    from pipeline import get_parser, pipeline_from_args
+    return get_parser, pipeline_from_args
+
+
+def run_command(command, argv):
+    """
+    parse argv with the parser of command and run it, as its main does
+    """
+    get_parser, runfunc = command_funcs(command)
+    args = get_parser().parse_args(argv)
+
+    # print the args
+    print("\nARGS: ")
+    for arg in vars(args):
+        print("{} {}".format(str(arg), str(getattr(args, arg))))
+    print("END ARGS\n")
+
+    runfunc(args)
+
+
+def run_job(job, logname):
+    """
+    run a job (dict of command, argv, cwd) in this process, in its working
+    directory, logging to logname
+
+    returns status ('ok' or 'failed'), seconds, and an error message
+    """
+    start = time.time()
+    status = 'ok'
+    error = ''
+    olddir = os.getcwd()
+    oldargv = sys.argv
+    with open(logname, 'w') as logf, redirect_stdout(logf), redirect_stderr(logf):
+        try:
+            os.chdir(job['cwd'])
+            # as if it were run from the command line (e.g. for -profile)
+            sys.argv = ['{}.py'.format(job['command'])] + job['argv']
+            run_command(job['command'], job['argv'])
+        except SystemExit as e:
+            # argparse errors and the exit(1)s
+            if e.code:
+                status = 'failed'
+                error = 'exited with {} (see log)'.format(e.code)
+        except Exception as e:
+            status = 'failed'
+            error = repr(e)
+            traceback.print_exc()
+        finally:
+            sys.argv = oldargv
+            os.chdir(olddir)
+
+    return status, time.time() - start, error
+
+
+def next_job(dirs):
+    """
+    take the oldest job in new/, returns its running/ file name and the job,
+    or None, None if there is none (or another worker took it first)
+    """
+    names = sorted(fname for fname in os.listdir(dirs['new']) if fname.endswith('.json'))
+    for fname in names:
+        running = os.path.join(dirs['running'], fname)
+        try:
+            os.rename(os.path.join(dirs['new'], fname), running)
+        except OSError:
+            continue
+        with open(running, 'r') as f:
+            return running, json.load(f)
+
+    return None, None
+
+
+def serve(queue, keepops=16, idle=0, poll=0.2):
+    """
+    run the jobs of a queue as they come, until stopped (worker.py stop), or
+    idle seconds without a job if idle > 0
+    """
+    import gc
+    import importlib
+
+    dirs = queue_dirs(queue)
+    start = time.time()
+    for name in PRELOAD:
+        importlib.import_module(name)
+    from makemat import keep_label_operators
+    keep_label_operators(keepops)
+    print("loaded in {:.1f}s, serving {}".format(time.time() - start, queue))
+
+    me = os.path.join(dirs['workers'], '{}_{}'.format(socket.gethostname(), os.getpid()))
+    stopfile = os.path.join(queue, 'stop')
+    done = threading.Event()
+
+    def heartbeat():
+        # so that submit knows someone is here, also during long jobs
+        while not done.is_set():
+            with open(me, 'w') as f:
+                f.write(str(time.time()))
+            done.wait(ALIVE / 3.)
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    lastjob = time.time()
+    try:
+        while True:
+            if os.path.isfile(stopfile):
+                print("asked to stop")
+                break
+
+            running, job = next_job(dirs)
+            if job is None:
+                if idle > 0 and time.time() - lastjob > idle:
+                    print("idle for {}s, stopping".format(idle))
+                    break
+                time.sleep(poll)
+                continue
+
+            print("running {} {}".format(job['id'], job['command']))
+            logname = os.path.join(dirs['logs'], ''.join([job['id'], '.txt']))
+            job['status'], job['seconds'], job['error'] = run_job(job, logname)
+            job['log'] = logname
+            job['worker'] = os.path.basename(me)
+            state = 'done' if job['status'] == 'ok' else 'failed'
+            write_json(os.path.join(dirs[state], os.path.basename(running)), job)
+            os.remove(running)
+            print("{} {} ({:.1f}s)".format(job['id'], job['status'], job['seconds']))
+
+            gc.collect()
+            lastjob = time.time()
+    finally:
+        done.set()
+        beat.join()
+        os.remove(me)
+
+
+def submit(queue, command, argv):
+    """
+    put a job on a queue, returns its id
+    """
+    dirs = queue_dirs(queue)
+    # time first, so that the jobs sort in the order they came
+    jobid = '{:.6f}_{}'.format(time.time(), uuid.uuid4().hex[:8])
+    job = {'id': jobid, 'command': command, 'argv': argv, 'cwd': os.getcwd(),
+           'submitted': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    write_json(os.path.join(dirs['new'], ''.join([jobid, '.json'])), job)
+
+    return jobid
+
+
+def wait_job(queue, jobid, poll=0.2):
+    """
+    wait for a job to be done, returns the finished job, or None if all the
+    workers of the queue went away before it was
+    """
+    dirs = queue_dirs(queue)
+    fname = ''.join([jobid, '.json'])
+    while True:
+        for state in ['done', 'failed']:
+            path = os.path.join(dirs[state], fname)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    return json.load(f)
+        if not live_workers(dirs):
+            return None
+        time.sleep(poll)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='a warm worker for regress.py, makemat.py and '
+                                     'pipeline.py jobs')
+    subparsers = parser.add_subparsers(dest='action')
+
+    serveparser = subparsers.add_parser('serve', help='run the jobs of a queue')
+    serveparser.add_argument('-queue', type=str, help='queue directory', required=True)
+    serveparser.add_argument('-keepops', type=int, help='label operators to keep in memory',
+                             default=16)
+    serveparser.add_argument('-idle', type=float, help='stop after this many seconds without a '
+                             'job (0: never)', default=0)
+
+    submitparser = subparsers.add_parser('submit', help='put a job on a queue')
+    submitparser.add_argument('-queue', type=str, help='queue directory', required=True)
+    submitparser.add_argument('-wait', help='wait for the job, print its log, exit 1 if it failed',
+                              action='store_true')
+    submitparser.add_argument('command', type=str, help='the script to run', choices=COMMANDS)
+    submitparser.add_argument('argv', nargs=argparse.REMAINDER, help='its args')
+
+    stopparser = subparsers.add_parser('stop', help='stop the workers of a queue')
+    stopparser.add_argument('-queue', type=str, help='queue directory', required=True)
+
+    # parse
+    args = parser.parse_args()
+
+    if args.action is None:
+        parser.print_help()
+        exit(1)
+
+    if args.action == 'serve':
+        stopfile = os.path.join(args.queue, 'stop')
+        if os.path.isfile(stopfile):
+            os.remove(stopfile)
+        serve(args.queue, keepops=args.keepops, idle=args.idle)
+
+    elif args.action == 'stop':
+        with open(os.path.join(args.queue, 'stop'), 'w') as f:
+            f.write(str(time.time()))
+        print("asked the workers of {} to stop".format(args.queue))
+
+    elif not args.wait:
+        print(submit(args.queue, args.command, args.argv))
+
+    elif not live_workers(queue_dirs(args.queue)):
+        print("no worker serving {}, running here".format(args.queue))
+        run_command(args.command, args.argv)
+
+    else:
+        jobid = submit(args.queue, args.command, args.argv)
+        job = wait_job(args.queue, jobid)
+        if job is None:
+            print("the workers of {} went away before job {} was done. exiting".format(
+                  args.queue, jobid))
+            exit(1)
+        with open(job['log'], 'r') as f:
+            sys.stdout.write(f.read())
+        print("{} {} ({:.1f}s on {})".format(jobid, job['status'], job['seconds'],
+                                             job['worker']))
+        if job['status'] != 'ok':
+            print(job['error'])
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()